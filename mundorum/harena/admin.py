@@ -4,10 +4,17 @@ from django.utils import timezone
 from django.urls import path
 from django.shortcuts import redirect
 from django.contrib import messages
+from django.db.models import Count, Q
 
-from .models import Person, Institution, InstitutionDomain, ProfessorInviteToken, Quest, QuestViewerInviteToken, QuestCase, Case 
+from .models import (Person, Institution, InstitutionDomain, ProfessorInviteToken, Quest, QuestViewerInviteToken,
+                     QuestInviteRedemption, QuestMembership, QuestCase, Case, SlowQuery)
 
-admin.site.register(Person)
+@admin.register(Person)
+class PersonAdmin(admin.ModelAdmin):
+    search_fields = ('user__username', 'user__email')
+    # a person is shown by its username
+    list_select_related = ('user',)
+    changelist_query_budget = 6
 
 
 class InstitutionDomainInline(admin.TabularInline):
@@ -17,6 +24,7 @@ class InstitutionDomainInline(admin.TabularInline):
 @admin.register(Institution)
 class InstitutionAdmin(admin.ModelAdmin):
     list_display = ('name', 'active')
+    changelist_query_budget = 5
     inlines = [InstitutionDomainInline]
 
     change_form_template = "admin/harena/institution/change_form.html"
@@ -55,12 +63,17 @@ class InstitutionAdmin(admin.ModelAdmin):
 @admin.register(ProfessorInviteToken)
 class ProfessorInviteTokenAdmin(admin.ModelAdmin):
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('used_by__user')
+
     def used_by_list_display(self, obj):
-        return ", ".join(p.user.username for p in obj.used_by.all()) if obj.used_by.exists() else 'N/A'
+        # from the prefetched people, not a query per token
+        return ", ".join(p.user.username for p in obj.used_by.all()) or 'N/A'
     
     list_display = ('token', 'institution', 'expires_at', 'created_at', 'used_by_list_display', 'is_valid')
     list_filter = ('institution',)
     search_fields = ('token',)
+    changelist_query_budget = 8
 
 
 @admin.action(description='Gerar token de convite para professores')
@@ -75,9 +88,18 @@ def generate_professor_invite_token(modeladmin, request, queryset):
             f"Token gerado para {institution.name}: {token.token}"
         )
 
+class QuestMembershipInline(admin.TabularInline):
+    model = QuestMembership
+    extra = 1
+    autocomplete_fields = ('person',)
+
+
 @admin.register(Quest)
 class QuestAdmin(admin.ModelAdmin):
     list_display = ('name', 'institution', 'owner', 'visible_to_institution')
+    list_select_related = ('institution', 'owner__user')
+    changelist_query_budget = 5
+    inlines = [QuestMembershipInline]
     change_form_template = "admin/harena/quest/change_form.html"
 
     def get_urls(self):
@@ -104,21 +126,108 @@ class QuestAdmin(admin.ModelAdmin):
         return redirect(f'/admin/harena/quest/{quest_id}/change/')        
     
 
+class QuestInviteRedemptionInline(admin.TabularInline):
+    model = QuestInviteRedemption
+    extra = 0
+    fields = ('person', 'redeemed_at')
+    readonly_fields = ('person', 'redeemed_at')
+    can_delete = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('person__user')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(QuestViewerInviteToken)
+class QuestViewerInviteTokenAdmin(admin.ModelAdmin):
+    list_display = ('token', 'quest', 'expires_at', 'max_uses', 'redemption_count', 'is_valid')
+    # a quest is shown with its institution
+    list_select_related = ('quest__institution',)
+    search_fields = ('token', 'quest__name')
+    readonly_fields = ('token', 'uses')
+    changelist_query_budget = 5
+    inlines = [QuestInviteRedemptionInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(redemption_total=Count('redemptions'))
+
+    def redemption_count(self, obj):
+        return obj.redemption_total
+
+    redemption_count.short_description = "Redemptions"
+    redemption_count.admin_order_field = 'redemption_total'
+
+
 class QuestCaseInline(admin.TabularInline):
     model = QuestCase
     extra = 1
 
 
+# Only the people who own cases, fetched with their users
+class CaseOwnerListFilter(admin.RelatedFieldListFilter):
+    def field_choices(self, field, request, model_admin):
+        owners = (Person.objects.filter(pk__in=Case.objects.values('case_owner'))
+                  .select_related('user').order_by('user__username'))
+        return [(owner.pk, str(owner)) for owner in owners]
+
+
 @admin.register(Case)
 class CaseAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'case_owner', 'created_at', 'complexity', 'specialty', 
                     'content', 'answer', 'possible_answers', 'quest_count')
-    list_filter = ('complexity', 'specialty', 'case_owner')
+    list_filter = ('complexity', 'specialty', ('case_owner', CaseOwnerListFilter))
+    list_select_related = ('case_owner__user',)
     search_fields = ('name', 'description', 'content', 'answer')
+    changelist_query_budget = 8
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(quest_total=Count('quest_cases'))
+
+    # the full-text index instead of an icontains scan over every case body;
+    # answers are not indexed (nor searchable through the API) and are matched
+    # as substrings
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        matches = Case.objects.search(search_term).values('pk')
+        return queryset.filter(Q(pk__in=matches) | Q(answer__icontains=search_term)), False
 
     def quest_count(self, obj):
-        return obj.quest_cases.count()
+        return obj.quest_total
 
     quest_count.short_description = "Number of Quests"
+    quest_count.admin_order_field = 'quest_total'
     
     inlines = [QuestCaseInline]
+
+
+# The slow-query log, read only: rows are written by harena/slowlog.py
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ('recorded_at', 'view', 'method', 'user_id', 'duration_ms', 'request_duration_ms', 'statement')
+    list_filter = ('view', 'method')
+    search_fields = ('sql',)
+    readonly_fields = ('recorded_at', 'view', 'method', 'user_id', 'request_duration', 'duration', 'sql', 'params', 'plan')
+    changelist_query_budget = 7
+
+    def duration_ms(self, obj):
+        return round(obj.duration * 1000, 1)
+
+    duration_ms.short_description = "Query (ms)"
+    duration_ms.admin_order_field = 'duration'
+
+    def request_duration_ms(self, obj):
+        return round(obj.request_duration * 1000, 1)
+
+    request_duration_ms.short_description = "Request (ms)"
+
+    def statement(self, obj):
+        return obj.sql if len(obj.sql) <= 120 else obj.sql[:120] + '...'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
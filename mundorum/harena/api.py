@@ -1,16 +1,21 @@
 from rest_framework import routers, serializers, viewsets
 from django.contrib.auth.models import User
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
 
+from .authentication import CachedTokenAuthentication
+from .caching import cached_response
+from .metrics import TimedViewSetMixin
 from .models import Person
+from .pagination import PersonPagination
+from .permissions import get_quest_permissions
+from .serializers import SparseFieldsMixin
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['username', 'first_name', 'last_name', 'email']
 
-class PersonSerializer(serializers.HyperlinkedModelSerializer):
+class PersonSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
     first_name = serializers.CharField(source='user.first_name', read_only=True)
     last_name = serializers.CharField(source='user.last_name', read_only=True)
@@ -20,11 +25,49 @@ class PersonSerializer(serializers.HyperlinkedModelSerializer):
         model = Person
         fields = ['user_id', 'username', 'first_name', 'last_name', 'email', 'birth', 'google_id', 'profile_picture']
 
-class PersonViewSet(viewsets.ModelViewSet):
-    authentication_classes = [TokenAuthentication]
+    summary_fields = ['user_id', 'username', 'first_name', 'last_name']
+    field_columns = {
+        'user_id': ['user'],
+        'username': ['user__username'],
+        'first_name': ['user__first_name'],
+        'last_name': ['user__last_name'],
+        'email': ['user__email'],
+    }
+
+class PersonViewSet(TimedViewSetMixin, viewsets.ModelViewSet):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = {'get': 6}
     queryset = Person.objects.all()
     serializer_class = PersonSerializer
+    pagination_class = PersonPagination
+
+    @cached_response
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        response.cache_tags = {f'people:{get_quest_permissions(request.user).institution_id}'}
+        return response
+
+    def get_queryset(self):
+        # only the people of the caller's institution, optionally by role
+        queryset = Person.objects.in_institution_of(self.request.user)
+        role = self.request.query_params.get('role')
+        if role in dict(Person.ROLE_CHOICES):
+            queryset = queryset.filter(role=role)
+        fields = self.requested_fields()
+        if fields is not None:
+            queryset = PersonSerializer.restrict(queryset, fields)
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def requested_fields(self):
+        # sparse fieldsets only apply to reads
+        if self.request.method not in SAFE_METHODS:
+            return None
+        return PersonSerializer.requested_fields(self.request)
 
 router = routers.DefaultRouter()
 router.register(r'person', PersonViewSet, basename='harena')
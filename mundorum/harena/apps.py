@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class HarenaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'harena'
+
+    def ready(self):
+        # connects the signal receivers (cache invalidation, images, uploads) and the bus listener
+        from . import authentication, bus, caching, domains, images, permissions, uploads, versions  # noqa: F401
@@ -0,0 +1,150 @@
+import copy
+import threading
+from datetime import timedelta
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from . import bus
+from .models import USER_TRACKED_FIELDS, Institution, Person, user_has_changed
+
+
+TOKEN_CACHE_TTL = getattr(settings, 'TOKEN_CACHE_TTL', 300)
+TOKEN_CACHE_SIZE = getattr(settings, 'TOKEN_CACHE_SIZE', 10000)
+
+# token key -> (user, person, institution, token created_at), least recently used evicted first
+_tokens = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+_lock = threading.Lock()
+# bumped by every invalidation, so a load that raced with a write is not cached
+_generation = 0
+
+
+# Drop-in replacement for DRF's TokenAuthentication that resolves the token,
+# its user, person and institution in one query and then serves them from a
+# bounded in-process cache, so a cache hit costs no query at all. When
+# TOKEN_LIFETIME (seconds) is set, older tokens are rejected and deleted.
+class CachedTokenAuthentication(TokenAuthentication):
+
+    def authenticate_credentials(self, key):
+        with _lock:
+            entry = _tokens.get(key)
+        if entry is None:
+            entry = self.load(key)
+
+        user, person, institution, created = entry
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        if self.is_expired(created):
+            Token.objects.filter(key=key).delete()
+            raise exceptions.AuthenticationFailed('Token has expired.')
+
+        # every request gets its own copies, so per-request state never leaks
+        user = copy.copy(user)
+        if person is not None:
+            person = copy.copy(person)
+            person.institution = copy.copy(institution) if institution is not None else None
+            user.person = person
+        return (user, key)
+
+    def load(self, key):
+        with _lock:
+            generation = _generation
+        try:
+            token = Token.objects.select_related('user__person__institution').get(key=key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+
+        user = token.user
+        person = getattr(user, 'person', None)
+        institution = person.institution if person is not None else None
+        entry = (user, person, institution, token.created)
+        with _lock:
+            if generation == _generation:
+                _tokens[key] = entry
+        return entry
+
+    @staticmethod
+    def is_expired(created):
+        lifetime = getattr(settings, 'TOKEN_LIFETIME', None)
+        return lifetime is not None and created + timedelta(seconds=lifetime) < timezone.now()
+
+
+# Both scan the cache, which holds at most TOKEN_CACHE_SIZE entries, rather
+# than keep an index by user that could fall out of step with its evictions.
+@bus.handler('authentication.user')
+def invalidate_user(user_id):
+    global _generation
+    with _lock:
+        _generation += 1
+        for key, (user, person, institution, created) in list(_tokens.items()):
+            if user.pk == user_id:
+                _tokens.pop(key, None)
+
+
+@bus.handler('authentication.institution')
+def invalidate_institution(institution_id):
+    global _generation
+    with _lock:
+        _generation += 1
+        for key, (user, person, institution, created) in list(_tokens.items()):
+            if institution is not None and institution.pk == institution_id:
+                _tokens.pop(key, None)
+
+
+@bus.reset_handler
+def clear():
+    global _generation
+    with _lock:
+        _generation += 1
+        _tokens.clear()
+
+
+def user_changed(user_id):
+    """
+    Drops the user's cached token here and in the other workers, and here
+    again when the transaction commits: a request that loaded it in between
+    read the user from before the commit (still active, say).
+    """
+    bus.broadcast('authentication.user', user_id)
+    transaction.on_commit(lambda: invalidate_user(user_id))
+
+
+def institution_changed(institution_id):
+    bus.broadcast('authentication.institution', institution_id)
+    transaction.on_commit(lambda: invalidate_institution(institution_id))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    user_changed(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_row_changed(sender, instance, signal, **kwargs):
+    # the cached user is request.user; its last login is not worth a drop
+    if signal is post_delete or user_has_changed(instance, *USER_TRACKED_FIELDS):
+        user_changed(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Person)
+def person_row_changed(sender, instance, **kwargs):
+    user_changed(instance.pk)
+
+
+@receiver(post_save, sender=Institution)
+def institution_saved(sender, instance, **kwargs):
+    if instance.has_changed('name', 'active'):
+        institution_changed(instance.pk)
+
+
+@receiver(post_delete, sender=Institution)
+def institution_deleted(sender, instance, **kwargs):
+    institution_changed(instance.pk)
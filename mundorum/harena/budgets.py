@@ -0,0 +1,68 @@
+from django.conf import settings
+
+
+# Query budgets: the most SQL queries a view may run per request, whatever the
+# size of the data, so an N+1 loop fails the tests instead of reaching
+# production. A view declares it as a `query_budget` attribute (a number, or a
+# {method: number} dict) or with the @query_budget decorator, on the view
+# class, one of its handler methods or a function view; a ModelAdmin declares
+# `changelist_query_budget` for its changelist. The metrics middleware counts
+# the queries and, with ENFORCE_QUERY_BUDGETS (DEBUG by default, and in the
+# tests), raises QueryBudgetExceeded listing them.
+
+
+# the budget of views whose queries grow with the request by design
+UNLIMITED = float('inf')
+
+
+class QueryBudgetExceeded(AssertionError):
+    def __init__(self, view, budget, statements):
+        self.view = view
+        self.budget = budget
+        self.statements = statements
+        listing = '\n'.join(f'{n}. {sql}' for n, sql in enumerate(statements, 1))
+        super().__init__(f'{view} ran {len(statements)} queries, its budget is {budget}:\n{listing}')
+
+
+def query_budget(budget):
+    """
+    Sets the query budget of a view class, handler method or function view.
+    """
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def enforced():
+    return getattr(settings, 'ENFORCE_QUERY_BUDGETS', settings.DEBUG)
+
+
+def budget_for(match, method):
+    """
+    The query budget of the view a request resolved to, or None if it has none.
+    """
+    if match is None:
+        return None
+    func = match.func
+    model_admin = getattr(func, 'model_admin', None)
+    if model_admin is not None:
+        if (match.url_name or '').endswith('_changelist'):
+            return getattr(model_admin, 'changelist_query_budget', None)
+        return None
+
+    view = getattr(func, 'view_class', None) or getattr(func, 'cls', None)
+    candidates = [getattr(view, method.lower(), None), view] if view is not None else [func]
+    for candidate in candidates:
+        budget = getattr(candidate, 'query_budget', None)
+        if isinstance(budget, dict):
+            budget = budget.get(method.lower())
+        if budget is not None:
+            return budget
+    return None
+
+
+def check(match, method, statements):
+    budget = budget_for(match, method)
+    if budget is not None and len(statements) > budget:
+        raise QueryBudgetExceeded(match.url_name or match.view_name, budget, statements)
@@ -0,0 +1,342 @@
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import Max
+from django.dispatch import receiver
+
+from .models import InvalidationEvent
+
+
+logger = logging.getLogger(__name__)
+
+# Every worker keeps its own caches (domains, permissions, tokens, the local
+# response tier), so a write handled by one worker has to reach the others. The
+# events published in a transaction are sent together once it commits, and
+# dropped on rollback: with PostgreSQL in one statement of pg_notify calls to a
+# thread LISTENing in each worker, with other databases (sqlite in development
+# and tests) in one INSERT into the InvalidationEvent table, which that thread
+# polls instead.
+CHANNEL = getattr(settings, 'INVALIDATION_BUS_CHANNEL', 'harena_invalidation')
+POLL_INTERVAL = getattr(settings, 'INVALIDATION_BUS_POLL_INTERVAL', 1.0)
+# seconds polled events are kept before being pruned
+RETENTION = getattr(settings, 'INVALIDATION_BUS_RETENTION', 600)
+# deliveries slower than this (seconds) are logged
+LAG_WARNING = getattr(settings, 'INVALIDATION_BUS_LAG_WARNING', 5.0)
+KEEPALIVE = 30
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7900
+# asks every other worker to drop all of its caches
+RESET = 'reset'
+
+_handlers = {}
+_resets = []
+
+
+def enabled():
+    return getattr(settings, 'INVALIDATION_BUS', False)
+
+
+def register(name, handler):
+    _handlers[name] = handler
+
+
+def handler(name):
+    """
+    Registers the decorated function as what other workers run for `name` events.
+    """
+    def decorator(function):
+        register(name, function)
+        return function
+    return decorator
+
+
+def reset_handler(function):
+    """
+    Registers a function that drops a whole cache, run when events may have been missed.
+    """
+    _resets.append(function)
+    return function
+
+
+def reset():
+    for function in _resets:
+        function()
+
+
+_sender = (None, None)
+
+
+def sender_id():
+    # a forked worker is a new sender
+    global _sender
+    pid = os.getpid()
+    if _sender[0] != pid:
+        _sender = (pid, f'{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}')
+    return _sender[1]
+
+
+def broadcast(name, *args):
+    """
+    Runs the `name` handler here right away and in the other workers once the
+    current transaction commits.
+    """
+    _handlers[name](*args)
+    publish(name, *args)
+
+
+# The events of a transaction, sent by its on_commit callback
+class Batch:
+    def __init__(self):
+        self.events = []
+        self.sent = False
+
+    def __call__(self):
+        self.sent = True
+        send(self.events)
+
+
+def current_batch():
+    # the batch registered in this transaction, unless a rollback dropped it
+    # (or tests ran it early, with captureOnCommitCallbacks)
+    for _, callback, _ in connection.run_on_commit:
+        if isinstance(callback, Batch) and not callback.sent:
+            return callback
+    batch = Batch()
+    transaction.on_commit(batch)
+    return batch
+
+
+def publish(name, *args):
+    """
+    Sends an event to the other workers when the current transaction commits
+    (or right away outside of one). An event published twice is sent once.
+    """
+    if not enabled():
+        return
+    event = (name, json.loads(json.dumps(args, cls=DjangoJSONEncoder)))
+    if not connection.in_atomic_block:
+        send([event])
+        return
+    batch = current_batch()
+    if event not in batch.events:
+        batch.events.append(event)
+
+
+def send(events):
+    sender, sent_at = sender_id(), time.time()
+    if connection.vendor == 'postgresql':
+        payloads = []
+        for name, args in events:
+            payload = json.dumps({'sender': sender, 'sent_at': sent_at, 'name': name, 'args': args})
+            if len(payload.encode()) > MAX_PAYLOAD:
+                payload = json.dumps({'sender': sender, 'sent_at': sent_at, 'name': RESET, 'args': []})
+            payloads.append(payload)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT ' + ', '.join(['pg_notify(%s, %s)'] * len(payloads)),
+                           [value for payload in payloads for value in (CHANNEL, payload)])
+    else:
+        InvalidationEvent.objects.bulk_create(
+            [InvalidationEvent(sender=sender, sent_at=sent_at, name=name, args=args) for name, args in events])
+    metrics.published(len(events))
+
+
+def receive(sender, sent_at, name, args):
+    # our own events were applied when they were published
+    if sender == sender_id():
+        return
+    metrics.received(time.time() - sent_at)
+    try:
+        if name == RESET:
+            reset()
+        else:
+            _handlers[name](*args)
+    except Exception:
+        metrics.failed()
+        logger.exception("Could not apply invalidation event %s%r", name, tuple(args))
+
+
+# Delivery counters and lag (publish to apply, so it includes clock skew between
+# hosts) of this worker, with cumulative lag buckets as Prometheus histograms use.
+class BusMetrics:
+    LAG_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.published_count = 0
+            self.received_count = 0
+            self.failed_count = 0
+            self.reconnect_count = 0
+            self.lag_sum = 0.0
+            self.lag_max = 0.0
+            self.last_lag = None
+            self.lag_buckets = [0] * len(self.LAG_BUCKETS)
+
+    def published(self, count=1):
+        with self._lock:
+            self.published_count += count
+
+    def failed(self):
+        with self._lock:
+            self.failed_count += 1
+
+    def reconnected(self):
+        with self._lock:
+            self.reconnect_count += 1
+
+    def received(self, lag):
+        with self._lock:
+            self.received_count += 1
+            self.lag_sum += lag
+            self.lag_max = max(self.lag_max, lag)
+            self.last_lag = lag
+            for i, bound in enumerate(self.LAG_BUCKETS):
+                if lag <= bound:
+                    self.lag_buckets[i] += 1
+        if lag > LAG_WARNING:
+            logger.warning("Invalidation event delivered %.1fs after it was published", lag)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'published': self.published_count,
+                'received': self.received_count,
+                'failed': self.failed_count,
+                'reconnects': self.reconnect_count,
+                'lag_sum': self.lag_sum,
+                'lag_max': self.lag_max,
+                'last_lag': self.last_lag,
+                'lag_buckets': dict(zip(self.LAG_BUCKETS, self.lag_buckets)),
+            }
+
+
+metrics = BusMetrics()
+
+
+class Listener(threading.Thread):
+    def __init__(self):
+        super().__init__(name='invalidation-bus', daemon=True)
+        self.pid = os.getpid()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+
+# LISTENs on a connection of its own, waking up as soon as a notification arrives.
+class NotifyListener(Listener):
+
+    def run(self):
+        wrapper = connections[DEFAULT_DB_ALIAS]
+        connected_before = False
+        while not self.stopped:
+            raw = None
+            try:
+                raw = wrapper.get_new_connection(wrapper.get_connection_params())
+                raw.autocommit = True
+                with raw.cursor() as cursor:
+                    cursor.execute(f'LISTEN {wrapper.ops.quote_name(CHANNEL)}')
+                if connected_before:
+                    # whatever was sent while we were away is lost
+                    metrics.reconnected()
+                    reset()
+                connected_before = True
+                self.listen(raw)
+            except Exception:
+                logger.exception("Invalidation bus connection lost")
+                self._stop_event.wait(POLL_INTERVAL)
+            finally:
+                if raw is not None:
+                    raw.close()
+
+    def listen(self, raw):
+        idle_since = time.monotonic()
+        while not self.stopped:
+            if select.select([raw], [], [], POLL_INTERVAL)[0]:
+                raw.poll()
+                while raw.notifies:
+                    message = json.loads(raw.notifies.pop(0).payload)
+                    receive(message['sender'], message['sent_at'], message['name'], message['args'])
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since > KEEPALIVE:
+                # a dropped connection is only noticed when used
+                with raw.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                idle_since = time.monotonic()
+
+
+# Polls the InvalidationEvent table for events newer than the last one applied.
+class PollingListener(Listener):
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, last_id=None):
+        super().__init__()
+        if last_id is None:
+            last_id = InvalidationEvent.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+        self.last_id = last_id
+        self.prune_at = 0
+
+    def poll(self):
+        events = InvalidationEvent.objects.filter(pk__gt=self.last_id).order_by('pk')
+        for event in events[:1000]:
+            self.last_id = event.pk
+            receive(event.sender, event.sent_at, event.name, event.args)
+        if time.monotonic() >= self.prune_at:
+            InvalidationEvent.objects.filter(sent_at__lt=time.time() - RETENTION).delete()
+            self.prune_at = time.monotonic() + self.PRUNE_INTERVAL
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Could not poll invalidation events")
+                connections[DEFAULT_DB_ALIAS].close()
+            self._stop_event.wait(POLL_INTERVAL)
+        connections[DEFAULT_DB_ALIAS].close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start_listener():
+    """
+    Starts this worker's listener, once per process: a worker forked after the
+    parent started its listener gets its own.
+    """
+    global _listener
+    if _listener is not None and _listener.pid == os.getpid():
+        return _listener
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            if _listener is not None:
+                # caches copied from the parent may have missed events since the fork
+                reset()
+            listener_class = NotifyListener if connection.vendor == 'postgresql' else PollingListener
+            _listener = listener_class()
+            _listener.start()
+    return _listener
+
+
+@receiver(request_started)
+def ensure_listening(sender, **kwargs):
+    if enabled():
+        start_listener()
@@ -0,0 +1,267 @@
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.response import Response
+
+from . import bus
+from .etags import not_modified
+from .models import Case, Institution, Person, Quest, QuestCase, user_has_changed
+from .permissions import get_quest_permissions
+
+
+# Two-tier cache for API read responses. The local tier is this process' memory;
+# the shared tier (files or Redis, see CACHES) is seen by every worker. Each entry is
+# tagged with what it was built from (quest:<id>, institution:<id>, ...; a case
+# is covered by the quests it is in, so a page carries a tag per quest, not per
+# case) and every tag keeps the time it was last invalidated, so an entry is
+# served only while it is newer than all of its tags.
+LOCAL_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_LOCAL_TIMEOUT', 30)
+SHARED_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_SHARED_TIMEOUT', 300)
+# how long a worker trusts its local copy of a tag time
+TAG_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_TAG_TIMEOUT', 5)
+# how long the shared tier keeps a tag time: longer than any entry it can make
+# stale lives (a local copy of a shared entry can outlive it by LOCAL_TIMEOUT)
+TAG_LIFETIME = 2 * (SHARED_TIMEOUT + LOCAL_TIMEOUT)
+# the User fields served with people and quest owners
+PEOPLE_USER_FIELDS = {'username', 'first_name', 'last_name', 'email'}
+
+
+def local_cache():
+    return caches['default']
+
+
+def shared_cache():
+    return caches['shared']
+
+
+def tag_times(tags, default):
+    """
+    When each tag was last invalidated. A tag the shared tier does not know
+    (never used, or evicted) starts at `default`, so an evicted tag can only
+    make older entries stale, never bring them back.
+    """
+    keys = {f'tag:{tag}': tag for tag in tags}
+    times = local_cache().get_many(keys)
+    missing = [key for key in keys if key not in times]
+    if missing:
+        fetched = shared_cache().get_many(missing)
+        for key in missing:
+            if key not in fetched:
+                # keeps a concurrently stored time if there is one
+                shared_cache().add(key, default, timeout=TAG_LIFETIME)
+                fetched[key] = shared_cache().get(key, default)
+        local_cache().set_many(fetched, timeout=TAG_TIMEOUT)
+        times.update(fetched)
+    return {keys[key]: value for key, value in times.items()}
+
+
+def invalidate_tags(*tags):
+    """
+    Drops every cached response built from any of `tags`, once the current
+    transaction commits.
+    """
+    def apply():
+        now = time.time()
+        times = {f'tag:{tag}': now for tag in tags}
+        shared_cache().set_many(times, timeout=TAG_LIFETIME)
+        local_cache().set_many(times, timeout=TAG_TIMEOUT)
+    transaction.on_commit(apply)
+    # sent with the transaction's other events
+    bus.publish('caching.tags', sorted(tags))
+
+
+@bus.handler('caching.tags')
+def tags_invalidated(tags):
+    # another worker's invalidation, applied here without waiting for
+    # TAG_TIMEOUT (the shared tier has it already). It arrives after the
+    # commit, so its own time is late enough.
+    now = time.time()
+    times = {f'tag:{tag}': now for tag in tags}
+    known = local_cache().get_many(times)
+    local_cache().set_many({key: value for key, value in times.items() if value > known.get(key, 0)},
+                           timeout=TAG_TIMEOUT)
+
+
+def get_response(key):
+    entry = local_cache().get(key)
+    if entry is None:
+        entry = shared_cache().get(key)
+        if entry is not None:
+            local_cache().set(key, entry, timeout=LOCAL_TIMEOUT)
+    if entry is None:
+        return None
+    built_at, tags, payload = entry
+    if any(invalidated > built_at for invalidated in tag_times(tags, time.time()).values()):
+        return None
+    return payload
+
+
+def set_response(key, payload, tags, built_at):
+    """
+    Stores a response built from data read after `built_at`.
+    """
+    tags = sorted(tags)
+    tag_times(tags, built_at)
+    entry = (built_at, tags, payload)
+    local_cache().set(key, entry, timeout=LOCAL_TIMEOUT)
+    shared_cache().set(key, entry, timeout=SHARED_TIMEOUT)
+
+
+def get_or_build(key, tags, build):
+    """
+    A cached value other than a response, built by `build()` on a miss and
+    tagged like responses are.
+    """
+    value = get_response(key)
+    if value is None:
+        built_at = time.time()
+        value = build()
+        set_response(key, value, tags, built_at)
+    return value
+
+
+def clear():
+    local_cache().clear()
+    shared_cache().clear()
+
+
+@bus.reset_handler
+def clear_local():
+    local_cache().clear()
+
+
+def response_key(view, method, request, kwargs):
+    # what the caller may see, what was asked for and how it is rendered
+    parts = (
+        get_quest_permissions(request.user).fingerprint,
+        sorted(kwargs.items()),
+        sorted(request.query_params.lists()),
+        request.accepted_media_type,
+    )
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()
+    return f'response:{type(view).__module__}.{type(view).__qualname__}.{method}:{digest}'
+
+
+def cached_response(method):
+    """
+    Caches the 200 responses of an APIView read method. The method tags what it
+    served by setting `response.cache_tags`; entries are shared by users whose
+    quest access is the same.
+    """
+    @functools.wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        key = response_key(view, method.__name__, request, kwargs)
+        payload = get_response(key)
+        if payload is not None:
+            data, headers = payload
+            if 'ETag' in headers:
+                response = not_modified(request, headers['ETag'])
+                if response is not None:
+                    return response
+            return Response(data, headers=headers)
+
+        # a write committed while the method runs is newer than this and invalidates it
+        built_at = time.time()
+        response = method(view, request, *args, **kwargs)
+        if response.status_code == 200:
+            headers = {'ETag': response['ETag']} if response.has_header('ETag') else {}
+            set_response(key, (response.data, headers), getattr(response, 'cache_tags', ()), built_at)
+        return response
+    return wrapper
+
+
+def catalog_tags(*institution_ids):
+    # the case catalog of each institution, see Case.objects.in_catalog_of
+    return [f'catalog:{institution_id}' for institution_id in set(institution_ids) if institution_id is not None]
+
+
+@receiver([post_save, post_delete], sender=Quest)
+def quest_changed(sender, instance, signal, **kwargs):
+    tags = [f'quest:{instance.pk}']
+    if signal is post_delete:
+        # its quest rows went first, but told nothing to a catalog (see below)
+        if instance.visible_to_institution:
+            tags += catalog_tags(instance.institution_id)
+    elif instance.has_changed('institution_id', 'visible_to_institution'):
+        # shares its cases with a different institution catalog
+        tags += catalog_tags(instance.initial_value('institution_id'), instance.institution_id)
+    invalidate_tags(*tags)
+
+
+@receiver([post_save, post_delete], sender=QuestCase)
+def quest_case_changed(sender, instance, origin=None, **kwargs):
+    tags = [f'quest:{instance.quest_id}']
+    if getattr(origin, 'model', type(origin)) is not Quest:
+        # the quest is at hand when the row was reached through it
+        # (quest.quest_cases), as the views do
+        if QuestCase.quest.is_cached(instance):
+            quests = [(instance.quest.institution_id, instance.quest.visible_to_institution)]
+        else:
+            quests = Quest.objects.filter(pk=instance.quest_id).values_list('institution_id', 'visible_to_institution')
+        tags += catalog_tags(*(institution_id for institution_id, visible in quests if visible))
+    invalidate_tags(*tags)
+
+
+def owner_institutions(case, owner_ids):
+    if owner_ids == {case.case_owner_id} and Case.case_owner.is_cached(case):
+        return [case.case_owner.institution_id]
+    return list(Person.objects.filter(pk__in=owner_ids).values_list('institution_id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Case)
+def case_changed(sender, instance, signal, created=False, **kwargs):
+    # Served in the pages of its quests, in the catalog of its owner's
+    # institution and in those its quests share it with
+    tags, institution_ids = [], []
+    previous_owner_id = instance.initial_value('case_owner_id')
+    if created or signal is post_delete:
+        # in no quest: a deleted case's quest rows go first, with their own signals
+        institution_ids += owner_institutions(instance, {instance.case_owner_id, previous_owner_id})
+    else:
+        for owner_institution_id, quest_id, quest_institution_id, visible in Case.objects.filter(
+                pk=instance.pk).values_list('case_owner__institution_id', 'quest_cases__quest_id',
+                                            'quest_cases__quest__institution_id', 'quest_cases__quest__visible_to_institution'):
+            institution_ids.append(owner_institution_id)
+            if quest_id is not None:
+                tags.append(f'quest:{quest_id}')
+            if visible:
+                institution_ids.append(quest_institution_id)
+        if previous_owner_id != instance.case_owner_id:
+            institution_ids += owner_institutions(instance, {previous_owner_id})
+    invalidate_tags(*tags, *catalog_tags(*institution_ids))
+
+
+@receiver([post_save, post_delete], sender=Institution)
+def institution_changed(sender, instance, signal, **kwargs):
+    if signal is post_delete or instance.has_changed('name', 'active'):
+        invalidate_tags(f'institution:{instance.pk}')
+
+
+@receiver([post_save, post_delete], sender=Person)
+def person_changed(sender, instance, **kwargs):
+    # listed with the people of its institution, before and after the change
+    institutions = {instance.initial_value('institution_id'), instance.institution_id}
+    tags = [f'person:{instance.pk}', *(f'people:{id}' for id in institutions)]
+    if len(institutions) > 1:
+        # takes its cases to another institution catalog
+        tags += catalog_tags(*institutions)
+    invalidate_tags(*tags)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    # a new user's Person is covered above, and logins change nothing served
+    if created or not user_has_changed(instance, *PEOPLE_USER_FIELDS):
+        return
+    if User.person.is_cached(instance):
+        institution_id = instance.person.institution_id
+    else:
+        institution_id = Person.objects.filter(pk=instance.pk).values_list('institution_id', flat=True).first()
+    invalidate_tags(f'person:{instance.pk}', f'people:{institution_id}')
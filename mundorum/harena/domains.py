@@ -0,0 +1,163 @@
+import threading
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import bus
+from .models import Institution, InstitutionDomain
+
+
+ResolvedInstitution = namedtuple('ResolvedInstitution', ['id', 'name', 'active'])
+
+
+# Process-wide map of e-mail domains to institutions. Domains are stored in a
+# trie keyed by their labels in reverse order (br -> unicamp -> student), so a
+# lookup walks at most one node per label and the longest registered suffix
+# wins: student.unicamp.br resolves to unicamp.br unless it is registered itself.
+# The trie is loaded on first use and then kept in sync by model signals.
+class DomainResolver:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._root = {}
+        self._domains = {}       # domain pk -> (name, institution id)
+        self._institutions = {}  # institution id -> ResolvedInstitution
+
+    @staticmethod
+    def _labels(domain):
+        return reversed(domain.strip().rstrip('.').lower().split('.'))
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for id, name, active in Institution.objects.values_list('id', 'name', 'active'):
+                self._institutions[id] = ResolvedInstitution(id, name, active)
+            for pk, name, institution_id in InstitutionDomain.objects.values_list('pk', 'name', 'institution_id'):
+                self._add_domain(pk, name, institution_id)
+            self._loaded = True
+
+    def _add_domain(self, pk, name, institution_id):
+        node = self._root
+        for label in self._labels(name):
+            node = node.setdefault(label, {})
+        node[None] = institution_id
+        self._domains[pk] = (name, institution_id)
+
+    def _remove_domain(self, pk):
+        entry = self._domains.pop(pk, None)
+        if entry is None:
+            return
+        labels = list(self._labels(entry[0]))
+        nodes = [self._root]
+        for label in labels:
+            node = nodes[-1].get(label)
+            if node is None:
+                return
+            nodes.append(node)
+        nodes[-1].pop(None, None)
+        # prune the branch back to the last node still in use
+        for depth in range(len(labels), 0, -1):
+            if nodes[depth]:
+                break
+            del nodes[depth - 1][labels[depth - 1]]
+
+    def resolve(self, email):
+        """
+        Returns the ResolvedInstitution for an e-mail address (or bare domain),
+        matching the longest registered domain suffix, or None.
+        """
+        self._ensure_loaded()
+        domain = email.split('@')[-1]
+        with self._lock:
+            node = self._root
+            institution_id = None
+            for label in self._labels(domain):
+                node = node.get(label)
+                if node is None:
+                    break
+                institution_id = node.get(None, institution_id)
+            return self._institutions.get(institution_id)
+
+    def institution(self, institution_id):
+        self._ensure_loaded()
+        with self._lock:
+            return self._institutions.get(institution_id)
+
+    def domain_saved(self, pk, name, institution_id):
+        with self._lock:
+            if self._loaded:
+                self._remove_domain(pk)
+                self._add_domain(pk, name, institution_id)
+
+    def domain_deleted(self, pk):
+        with self._lock:
+            if self._loaded:
+                self._remove_domain(pk)
+
+    def institution_saved(self, pk, name, active):
+        with self._lock:
+            if self._loaded:
+                self._institutions[pk] = ResolvedInstitution(pk, name, active)
+
+    def institution_deleted(self, pk):
+        with self._lock:
+            if self._loaded:
+                self._institutions.pop(pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._loaded = False
+            self._root = {}
+            self._domains = {}
+            self._institutions = {}
+
+
+_resolver = DomainResolver()
+
+
+def get_domain_resolver():
+    return _resolver
+
+
+bus.register('domains.domain_saved', _resolver.domain_saved)
+bus.register('domains.domain_deleted', _resolver.domain_deleted)
+bus.register('domains.institution_saved', _resolver.institution_saved)
+bus.register('domains.institution_deleted', _resolver.institution_deleted)
+bus.reset_handler(_resolver.clear)
+
+
+# Changes are applied here once committed, so a rolled back write never leaks
+# in, and sent to the other workers with the transaction's other events
+@receiver(post_save, sender=InstitutionDomain)
+def domain_saved(sender, instance, **kwargs):
+    args = (instance.pk, instance.name, instance.institution_id)
+    transaction.on_commit(lambda: _resolver.domain_saved(*args))
+    bus.publish('domains.domain_saved', *args)
+
+
+@receiver(post_delete, sender=InstitutionDomain)
+def domain_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: _resolver.domain_deleted(pk))
+    bus.publish('domains.domain_deleted', pk)
+
+
+@receiver(post_save, sender=Institution)
+def institution_saved(sender, instance, **kwargs):
+    if not instance.has_changed('name', 'active'):
+        return
+    args = (instance.pk, instance.name, instance.active)
+    transaction.on_commit(lambda: _resolver.institution_saved(*args))
+    bus.publish('domains.institution_saved', *args)
+
+
+@receiver(post_delete, sender=Institution)
+def institution_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: _resolver.institution_deleted(pk))
+    bus.publish('domains.institution_deleted', pk)
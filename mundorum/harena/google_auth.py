@@ -0,0 +1,110 @@
+import hashlib
+import re
+import threading
+import time
+
+import requests
+from cachetools import TTLCache
+from django.conf import settings
+from google.auth import exceptions, jwt
+
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+# Verifies Google ID tokens without a round trip per login: the signing
+# certificates are fetched through a pooled session and kept for as long as
+# Google's Cache-Control allows, and tokens already verified are remembered
+# (by digest) for a short while, so retried logins are answered from memory.
+# A token signed with an unknown key refetches them, at most once every
+# min_refresh_interval seconds, so forged key ids cannot hammer Google.
+class GoogleTokenVerifier:
+    def __init__(self, client_id, certs_url, token_cache_ttl=60, token_cache_size=10000,
+                 default_certs_max_age=300, timeout=5, clock_skew=0, min_refresh_interval=60, session=None):
+        self.client_id = client_id
+        self.certs_url = certs_url
+        self.default_certs_max_age = default_certs_max_age
+        self.timeout = timeout
+        self.clock_skew = clock_skew
+        self.min_refresh_interval = min_refresh_interval
+        self.session = session or requests.Session()
+        self._certs = None
+        self._certs_expire_at = 0
+        self._certs_fetched_at = None
+        self._certs_lock = threading.Lock()
+        self._tokens = TTLCache(maxsize=token_cache_size, ttl=token_cache_ttl)
+        self._tokens_lock = threading.Lock()
+
+    def get_certs(self, refresh=False):
+        with self._certs_lock:
+            now = time.monotonic()
+            if refresh and self._certs_fetched_at is not None:
+                # also skips the refetch of a request that waited for another's
+                refresh = now - self._certs_fetched_at >= self.min_refresh_interval
+            if refresh or self._certs is None or now >= self._certs_expire_at:
+                self._certs, max_age = self._fetch_certs()
+                self._certs_fetched_at = now
+                self._certs_expire_at = now + max_age
+            return self._certs
+
+    def _fetch_certs(self):
+        try:
+            response = self.session.get(self.certs_url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise exceptions.TransportError(f"Could not fetch certificates: {e}") from e
+        if response.status_code != 200:
+            raise exceptions.TransportError(
+                f"Could not fetch certificates at {self.certs_url} ({response.status_code})")
+
+        max_age = self.default_certs_max_age
+        match = MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+        if match:
+            max_age = int(match.group(1))
+        return response.json(), max_age
+
+    def verify(self, token):
+        """
+        Returns the claims of a valid Google ID token for our client id.
+        Raises ValueError if the token is invalid or expired.
+        """
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        with self._tokens_lock:
+            idinfo = self._tokens.get(digest)
+        if idinfo is not None and idinfo['exp'] > time.time():
+            return idinfo
+
+        try:
+            idinfo = self._decode(token, self.get_certs())
+        except ValueError as e:
+            # a key id we do not know yet means Google rotated its keys
+            if 'Certificate for key id' not in str(e):
+                raise
+            idinfo = self._decode(token, self.get_certs(refresh=True))
+
+        if idinfo['iss'] not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer. 'iss' should be one of {GOOGLE_ISSUERS}")
+
+        with self._tokens_lock:
+            self._tokens[digest] = idinfo
+        return idinfo
+
+    def _decode(self, token, certs):
+        return jwt.decode(token, certs=certs, audience=self.client_id,
+                          clock_skew_in_seconds=self.clock_skew)
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_google_verifier():
+    global _verifier
+    with _verifier_lock:
+        if _verifier is None:
+            _verifier = GoogleTokenVerifier(
+                settings.GOOGLE_CLIENT_ID,
+                settings.GOOGLE_CERTS_URL,
+                token_cache_ttl=settings.GOOGLE_TOKEN_CACHE_TTL,
+            )
+        return _verifier
@@ -0,0 +1,172 @@
+import hashlib
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from PIL import Image, ImageOps
+
+from .models import Case
+
+
+logger = logging.getLogger(__name__)
+
+# Case images are uploaded at full resolution (radiology scans run to tens of
+# megabytes); lists and viewers get resized WebP and JPEG copies instead. Each
+# copy is named after the hash of its bytes, so its URL never changes meaning and
+# can be cached forever. Copies are built off the request, once the upload commits.
+#
+# They are served under their case's ID to those who can see the case (see
+# CaseImageDerivativeView). The URLs served with a case are also signed, so an
+# <img> tag loads them without the API token, and stop working after one to two
+# URL_LIFETIMEs; they stay the same within a URL_LIFETIME, so browsers keep
+# hitting their cached copies. URL_LIFETIME has to outlast the response cache
+# (harena.caching), which hands out the URLs of the responses it keeps.
+DERIVED_DIR = 'case_images/derived'
+URL_LIFETIME = getattr(settings, 'IMAGE_DERIVATIVE_URL_LIFETIME', 3600)
+# size name -> longest side in pixels; images are never enlarged
+SIZES = {'thumb': 320, 'medium': 1280}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+# colour profiles up to this size are kept; EXIF, XMP and comments never are
+MAX_ICC_PROFILE = 16 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def derivative_url(case_id, path):
+    name = path.rsplit('/', 1)[-1]
+    expires = (int(time.time()) // URL_LIFETIME + 2) * URL_LIFETIME
+    url = reverse('case-image-derivative', kwargs={'case_id': case_id, 'name': name})
+    return f"{url}?{urlencode({'expires': expires, 'signature': url_signature(case_id, name, expires)})}"
+
+
+def url_signature(case_id, name, expires):
+    return signing.Signer(salt='harena.images.derivative_url').signature(f'{case_id}/{name}/{expires}')
+
+
+def is_signed(case_id, name, query_params):
+    """
+    Whether the query string holds an unexpired signature of the URL.
+    """
+    expires, signature = query_params.get('expires', ''), query_params.get('signature', '')
+    if not expires.isascii() or not expires.isdigit() or int(expires) < time.time():
+        return False
+    return constant_time_compare(signature, url_signature(case_id, name, int(expires)))
+
+
+def to_displayable(image):
+    """
+    The image upright and in a mode both formats can encode, with 16-bit and
+    float scans scaled down to 8 bits.
+    """
+    image = ImageOps.exif_transpose(image)
+    if image.mode.startswith('I;16'):
+        # point() works on 32-bit integers, not on the packed 16-bit modes
+        image = image.convert('I')
+    if image.mode in ('I', 'F'):
+        low, high = image.getextrema()
+        scale = 255 / (high - low) if high > low else 0
+        image = image.point(lambda value: (value - low) * scale).convert('L')
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    return image
+
+
+def encode(image, format_name, icc_profile):
+    pil_format, options = FORMATS[format_name]
+    if pil_format == 'JPEG' and image.mode == 'RGBA':
+        image = image.convert('RGB')
+    if icc_profile is not None:
+        options = dict(options, icc_profile=icc_profile)
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def render_derivatives(file):
+    """
+    Encodes every size and format of the image in `file`, returning
+    {size: {format: storage path}} with the files saved under DERIVED_DIR.
+    """
+    with Image.open(file) as original:
+        icc_profile = original.info.get('icc_profile')
+        if icc_profile is not None and len(icc_profile) > MAX_ICC_PROFILE:
+            icc_profile = None
+        image = to_displayable(original)
+
+        derivatives = {}
+        for size_name, size in SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            derivatives[size_name] = {}
+            for format_name in FORMATS:
+                data = encode(resized, format_name, icc_profile)
+                path = f'{DERIVED_DIR}/{hashlib.sha256(data).hexdigest()[:20]}-{size_name}.{format_name}'
+                if not default_storage.exists(path):
+                    default_storage.save(path, ContentFile(data))
+                derivatives[size_name][format_name] = path
+    return derivatives
+
+
+def build_derivatives(case_id):
+    """
+    Builds (or drops) the derivatives of a case's current image and saves them
+    on the case, unless the image was replaced in the meantime.
+    """
+    case = Case.objects.only('image', 'image_derivatives').get(pk=case_id)
+    derivatives = {}
+    if case.image:
+        with case.image.open('rb') as file:
+            derivatives = render_derivatives(file)
+    if derivatives == case.image_derivatives:
+        return
+    current = Case.objects.filter(pk=case_id).values_list('image', flat=True).first()
+    if (current or '') != (case.image.name or ''):
+        return
+    case.image_derivatives = derivatives
+    case.save(update_fields=['image_derivatives'])
+
+
+def _run(case_id):
+    try:
+        build_derivatives(case_id)
+    except Case.DoesNotExist:
+        pass
+    except Exception:
+        logger.exception("Could not build the image derivatives of case %s", case_id)
+    finally:
+        # the worker thread's connection is not closed by any request cycle
+        connections.close_all()
+
+
+def schedule_derivatives(case_id):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2),
+                                           thread_name_prefix='image-derivatives')
+    _executor.submit(_run, case_id)
+
+
+@receiver(post_save, sender=Case)
+def case_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    if instance.has_changed('image') and (instance.image or instance.image_derivatives):
+        case_id = instance.pk
+        transaction.on_commit(lambda: schedule_derivatives(case_id))
@@ -0,0 +1,327 @@
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authtoken.models import Token
+
+from harena.models import Case, Institution, Person, Quest, QuestViewerInviteToken
+
+
+METRIC_RE = re.compile(r'^harena_db_queries_per_request_(sum|count)\{view="([^"]*)"\} (\S+)$')
+# words the seeded cases are made of, for searches that match
+SEARCH_TERMS = ['febre', 'dor torácica', 'radiografia', 'hipertensão diabetes', 'tomografia lesão', 'cefaleia']
+
+
+def percentile(sorted_values, share):
+    # nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+
+class Command(BaseCommand):
+    help = ("Drives the API of a running server (runserver, gunicorn, ...) with concurrent authenticated "
+            "clients, one endpoint at a time, and reports latency percentiles, throughput and SQL queries "
+            "per request against a stored baseline. Given several client counts, also how close throughput "
+            "comes to growing linearly with them. Needs data from seed_harena and the same database. "
+            "Every API route is driven except google-auth, whose tokens only Google can sign.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help="Base URL of the server.")
+        parser.add_argument('--clients', type=int, nargs='+', default=[8],
+                            help="Concurrent clients; each endpoint runs once per count given.")
+        parser.add_argument('--duration', type=float, default=10, help="Seconds spent on each endpoint.")
+        parser.add_argument('--users', type=int, default=50, help="Seeded people the clients act as.")
+        parser.add_argument('--endpoints', nargs='*', help="Endpoints to run (all by default).")
+        parser.add_argument('--prefix', default='seed', help="Prefix seed_harena was run with.")
+        parser.add_argument('--baseline', default=str(Path(settings.BASE_DIR) / 'bench-baseline.json'),
+                            help="Results to compare with.")
+        parser.add_argument('--save-baseline', action='store_true', help="Store these results as the baseline.")
+
+    def handle(self, *args, **options):
+        self.base_url = options['url'].rstrip('/')
+        self.random = random.Random(0)
+        self.prepare(options['prefix'], options['users'])
+
+        endpoints = self.endpoints()
+        names = options['endpoints'] or list(endpoints)
+        unknown = set(names) - set(endpoints)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}. Known: {', '.join(endpoints)}")
+
+        baseline = {}
+        baseline_path = Path(options['baseline'])
+        if baseline_path.exists():
+            baseline = json.loads(baseline_path.read_text())['endpoints']
+
+        self.stdout.write(f"{'endpoint':<22} {'clients':>7} {'requests':>8} {'errors':>6} {'req/s':>8} "
+                          f"{'scaling':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+        results = {}
+        for name in names:
+            # {client count: result}, keyed by strings as they are in JSON
+            runs = results[name] = {}
+            for clients in options['clients']:
+                result = runs[str(clients)] = self.run(name, endpoints[name], clients, options['duration'])
+                first = options['clients'][0]
+                # throughput over what the first count would reach if it grew linearly
+                result['scaling'] = result['throughput'] / (runs[str(first)]['throughput'] * clients / first)
+                self.stdout.write(self.format(name, clients, result, baseline.get(name, {}).get(str(clients))))
+
+        if options['save_baseline']:
+            baseline_path.write_text(json.dumps({
+                'recorded_at': timezone.now().isoformat(),
+                'duration': options['duration'],
+                'endpoints': results,
+            }, indent=2))
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {baseline_path}"))
+
+    def prepare(self, prefix, users):
+        """
+        Picks the people the clients act as, in the seeded institution with the
+        most quests, and gives each of them a token.
+        """
+        institution = (Institution.objects.filter(name__startswith=f'{prefix.title()} Institution')
+                       .annotate(quest_count=Count('quests')).order_by('-quest_count').first())
+        if institution is None:
+            raise CommandError(f"No seeded data with the prefix {prefix!r}; run seed_harena first")
+        people = Person.objects.filter(institution=institution, user__username__startswith=f'{prefix}-')
+        self.students = list(people.filter(role='student').order_by('pk')[:users])
+        self.professors = list(people.filter(role='professor').order_by('pk')[:max(1, users // 10)])
+        if not self.students:
+            raise CommandError(f"{institution.name} has no students")
+
+        self.tokens = {person.pk: Token.objects.get_or_create(user_id=person.pk)[0].key
+                       for person in self.students + self.professors}
+        staff, _ = User.objects.get_or_create(username=f'{prefix}-bench-staff', defaults={'is_staff': True})
+        self.staff_token = Token.objects.get_or_create(user=staff)[0].key
+
+        self.quest_ids = [str(id) for id in Quest.objects.filter(institution=institution, visible_to_institution=True)
+                          .values_list('id', flat=True)[:200]]
+        if not self.quest_ids:
+            raise CommandError(f"{institution.name} has no quests visible to its students")
+        professors = {person.pk: person for person in self.professors}
+        owned = Quest.objects.filter(owner__in=self.professors)
+        self.quest_owners = {str(id): professors[owner_id] for id, owner_id in owned.values_list('id', 'owner_id')[:50]}
+        self.case_ids = [str(id) for id in Case.objects.filter(case_owner__in=self.professors)
+                         .exclude(quest_cases__quest__in=owned).values_list('id', flat=True)[:200]]
+        self.own_cases = {}
+        for owner_id, id in Case.objects.filter(case_owner__in=self.professors).values_list('case_owner_id', 'id'):
+            self.own_cases.setdefault(owner_id, []).append(str(id))
+        # upload endpoints pin a professor to each client, as each may only have a few uploads going
+        self.uploaders = [person for person in self.professors if person.pk in self.own_cases]
+        image = io.BytesIO()
+        Image.new('RGB', (640, 480), (120, 30, 30)).save(image, 'PNG')
+        self.image = image.getvalue()
+        self.invite_quest = Quest.objects.filter(institution=institution).first()
+        self.invites = self.class_invites()
+        self.invites_lock = threading.Lock()
+
+    def class_invites(self):
+        """
+        (student, invite token) pairs, all first redemptions: the students take
+        turns redeeming a token shared by all of them, with exactly enough uses,
+        as a class joining a quest does, and then a new one.
+        """
+        while True:
+            invite = QuestViewerInviteToken.objects.create(quest=self.invite_quest, max_uses=len(self.students),
+                                                           expires_at=timezone.now() + timedelta(days=1))
+            for student in self.random.sample(self.students, len(self.students)):
+                yield student, str(invite.token)
+
+    def endpoints(self):
+        """
+        endpoint (its URL name, as the metrics label it) -> function of the
+        client returning (person, method, path, options) for its next request,
+        options being arguments of requests' request(). A function may send
+        untimed requests of its own first; options['then'] is called with the
+        response once it is timed, and client.cleanup is a request left to send
+        when the run ends. Those extra requests count in the elapsed time of the
+        upload endpoints, so their req/s is lower than what the server alone
+        could do.
+        """
+        def student(method, path, **options):
+            return lambda client: (self.random.choice(self.students), method, path(), options)
+
+        def professor(method, path, **options):
+            return lambda client: (self.random.choice(self.professors), method, path(), options)
+
+        endpoints = {
+            'user': student('GET', lambda: '/user/'),
+            'user-list': student('GET', lambda: '/users/'),
+            'quest-list': student('GET', lambda: '/api/quests/'),
+            'quest-cases': student('GET', lambda: f'/api/quests/{self.random.choice(self.quest_ids)}/cases/'),
+            'case-search': student('GET', lambda: f'/api/cases/search/?q={self.random.choice(SEARCH_TERMS)}'),
+            'harena-list': student('GET', lambda: '/person/?role=professor'),
+            'case-catalog': professor('GET', lambda: '/api/cases/catalog/'),
+            'case-export': professor('GET', lambda: '/api/cases/export/'),
+        }
+
+        def redeem(client):
+            with self.invites_lock:
+                person, token = next(self.invites)
+            return person, 'POST', '/api/use-quest-token/', {'json': {'token': token}}
+        endpoints['use-quest-token'] = redeem
+
+        def import_cases(client):
+            lines = [json.dumps({'name': f'Importado {n}', 'content': ' '.join(self.random.choices(SEARCH_TERMS, k=40)),
+                                 'answer': 'febre', 'specialty': 'Clínica'}) for n in range(20)]
+            return (self.random.choice(self.professors), 'POST', '/api/cases/import/',
+                    {'data': '\n'.join(lines).encode(), 'headers': {'Content-Type': 'application/x-ndjson'}})
+        endpoints['case-import'] = import_cases
+
+        if self.uploaders:
+            endpoints['case-image-uploads'] = self.start_upload
+            endpoints['image-upload'] = self.send_image
+
+        if self.quest_owners and self.case_ids:
+            def batch(client):
+                # adds a case to one of the professor's quests, or takes it out again
+                quest_id = self.random.choice(list(self.quest_owners))
+                body = {self.random.choice(['add', 'remove']): [self.random.choice(self.case_ids)]}
+                return self.quest_owners[quest_id], 'POST', f'/api/quests/{quest_id}/cases/batch/', {'json': body}
+            endpoints['quest-cases-batch'] = batch
+
+            def add_case(client):
+                quest_id = self.random.choice(list(self.quest_owners))
+                return (self.quest_owners[quest_id], 'POST', f'/api/quests/{quest_id}/cases/add/',
+                        {'json': {'case_id': self.random.choice(self.case_ids)}})
+            endpoints['add-case-to-quest'] = add_case
+
+            def remove_case(client):
+                quest_id = self.random.choice(list(self.quest_owners))
+                return (self.quest_owners[quest_id], 'POST',
+                        f'/api/quests/{quest_id}/cases/{self.random.choice(self.case_ids)}/remove/', {})
+            endpoints['remove-case-from-quest'] = remove_case
+        return endpoints
+
+    def uploader(self, client):
+        person = self.uploaders[client.index % len(self.uploaders)]
+        return person, self.random.choice(self.own_cases[person.pk])
+
+    def start_upload(self, client):
+        # drops the upload this client started last time, so it never has more than one going
+        if client.cleanup is not None:
+            self.send(client, *client.cleanup)
+            client.cleanup = None
+        person, case_id = self.uploader(client)
+
+        def then(response):
+            if response.ok:
+                client.cleanup = (person, 'DELETE', f"/api/uploads/{response.json()['id']}/")
+        body = {'filename': 'scan.png', 'size': len(self.image), 'sha256': hashlib.sha256(self.image).hexdigest()}
+        return person, 'POST', f'/api/cases/{case_id}/image/uploads/', {'json': body, 'then': then}
+
+    def send_image(self, client):
+        # the whole image in one chunk, which completes the upload and builds the derivatives
+        person, case_id = self.uploader(client)
+        response = self.send(client, person, 'POST', f'/api/cases/{case_id}/image/uploads/', json={
+            'filename': 'scan.png', 'size': len(self.image), 'sha256': hashlib.sha256(self.image).hexdigest()})
+        response.raise_for_status()
+        return person, 'PUT', f"/api/uploads/{response.json()['id']}/", {
+            'data': self.image, 'headers': {'Upload-Offset': '0', 'Content-Type': 'application/octet-stream'}}
+
+    def send(self, client, person, method, path, headers=None, **options):
+        return client.session.request(method, self.base_url + path, timeout=60, **options,
+                                      headers={**(headers or {}), 'Authorization': f'Token {self.tokens[person.pk]}'})
+
+    def scrape(self):
+        """
+        {view: (queries, requests)} from the server's /metrics.
+        """
+        response = requests.get(f'{self.base_url}/metrics', headers={'Authorization': f'Token {self.staff_token}'},
+                                timeout=30)
+        response.raise_for_status()
+        totals = {}
+        for line in response.text.splitlines():
+            match = METRIC_RE.match(line)
+            if match:
+                kind, view, value = match.groups()
+                queries, count = totals.get(view, (0, 0))
+                totals[view] = (float(value), count) if kind == 'sum' else (queries, float(value))
+        return totals
+
+    def run(self, name, next_request, clients, duration):
+        before = self.scrape().get(name, (0, 0))
+        latencies, errors = [], [0]
+        lock = threading.Lock()
+        deadline = time.monotonic() + duration
+
+        def client(index):
+            state = SimpleNamespace(index=index, session=requests.Session(), cleanup=None)
+            own, failed = [], 0
+            while time.monotonic() < deadline:
+                try:
+                    person, method, path, options = next_request(state)
+                except requests.RequestException:
+                    failed += 1
+                    continue
+                then = options.pop('then', None)
+                start = time.perf_counter()
+                try:
+                    response = self.send(state, person, method, path, **options)
+                    ok = response.status_code < 400
+                except requests.RequestException:
+                    response, ok = None, False
+                own.append(time.perf_counter() - start)
+                failed += not ok
+                if then is not None and response is not None:
+                    then(response)
+            if state.cleanup is not None:
+                try:
+                    self.send(state, *state.cleanup)
+                except requests.RequestException:
+                    pass
+            with lock:
+                latencies.extend(own)
+                errors[0] += failed
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        after = self.scrape().get(name, (0, 0))
+
+        latencies.sort()
+        served = after[1] - before[1]
+        return {
+            'requests': len(latencies),
+            'errors': errors[0],
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'queries': (after[0] - before[0]) / served if served else None,
+        }
+
+    def format(self, name, clients, result, baseline):
+        def ms(value):
+            return f'{value * 1000:8.1f}' if value is not None else f'{"-":>8}'
+
+        line = (f"{name:<22} {clients:>7} {result['requests']:>8} {result['errors']:>6} {result['throughput']:>8.1f} "
+                f"{result['scaling']:>7.2f} {ms(result['p50'])} {ms(result['p95'])} {ms(result['p99'])} "
+                + (f"{result['queries']:>8.1f}" if result['queries'] is not None else f'{"-":>8}'))
+        if baseline:
+            changes = []
+            for key, label in (('throughput', 'req/s'), ('p95', 'p95'), ('queries', 'queries')):
+                old, new = baseline.get(key), result[key]
+                if old and new is not None:
+                    changes.append(f"{label} {(new - old) / old:+.0%}")
+            line += f"   vs baseline: {', '.join(changes)}"
+        return line
@@ -0,0 +1,105 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from harena.models import Institution, Quest
+
+
+# Queries per committed save on sqlite, BEGIN and COMMIT included, before
+# TrackedFieldsMixin, when every save hook re-read the old row (and there was no
+# invalidation bus yet). The "before" column unless --baseline is given.
+BASELINE = {
+    'Institution.save (name)': 4,
+    'Institution.save (active)': 4,
+    'User.save (last_login)': 5,
+    'User.save (first_name)': 4,
+    'Quest.save (name)': 8,
+    'Quest.save (visibility)': 8,
+}
+
+
+class Command(BaseCommand):
+    help = ("Counts the SQL queries issued by the common model save paths, including the work "
+            "done when they commit, and compares them with a baseline. The rows are deleted afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-sql', action='store_true', help="Print every captured query.")
+        parser.add_argument('--baseline', metavar='FILE',
+                            help="Compare with the counts of an earlier run (see --save) instead of the "
+                                 "counts from before dirty-field tracking.")
+        parser.add_argument('--save', metavar='FILE', help="Write the counts of this run to FILE as JSON.")
+
+    def handle(self, *args, **options):
+        baseline = BASELINE
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+        counts = {}
+        institution = Institution.objects.create(name='bench institution')
+        user = User.objects.create_user('bench_user')
+        try:
+            self.run(institution, user, options['verbose_sql'], baseline, counts)
+        finally:
+            Quest.objects.filter(owner_id=user.pk).delete()
+            user.delete()
+            institution.delete()
+        if options['save']:
+            with open(options['save'], 'w') as file:
+                json.dump(counts, file, indent=2)
+
+    def run(self, institution, user, verbose_sql, baseline, counts):
+        quest = Quest.objects.create(name='bench quest', institution=institution, owner=user.person)
+
+        institution = Institution.objects.get(pk=institution.pk)
+        user = User.objects.get(pk=user.pk)
+        quest = Quest.objects.get(pk=quest.pk)
+
+        def rename_institution():
+            institution.name = 'bench institution renamed'
+            institution.save()
+
+        def deactivate_institution():
+            institution.active = False
+            institution.save()
+
+        def update_last_login():
+            user.last_login = timezone.now()
+            user.save(update_fields=['last_login'])
+
+        def rename_user():
+            user.first_name = 'Bench'
+            user.save()
+
+        def rename_quest():
+            quest.name = 'bench quest renamed'
+            quest.save()
+
+        def toggle_quest_visibility():
+            quest.visible_to_institution = not quest.visible_to_institution
+            quest.save()
+
+        cases = [
+            ('Institution.save (name)', rename_institution),
+            ('Institution.save (active)', deactivate_institution),
+            ('User.save (last_login)', update_last_login),
+            ('User.save (first_name)', rename_user),
+            ('Quest.save (name)', rename_quest),
+            ('Quest.save (visibility)', toggle_quest_visibility),
+        ]
+        self.stdout.write(f"{'':<30} {'before':>6} {'after':>6}")
+        for label, save in cases:
+            # each save commits, so what runs on commit is counted too
+            with CaptureQueriesContext(connection) as queries:
+                with transaction.atomic():
+                    save()
+            counts[label] = len(queries)
+            before = baseline.get(label)
+            change = '' if before is None else f" {len(queries) - before:+d}"
+            self.stdout.write(f"{label:<30} {'-' if before is None else before:>6} {len(queries):>6}{change}")
+            if verbose_sql:
+                for query in queries:
+                    self.stdout.write(f"    {query['sql']}")
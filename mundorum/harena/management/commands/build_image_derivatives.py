@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from harena.images import build_derivatives
+from harena.models import Case
+
+
+class Command(BaseCommand):
+    help = "Builds the resized copies of case images that do not have them yet (e.g. lost with a restart)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Rebuild the copies of every case image.")
+
+    def handle(self, *args, **options):
+        cases = Case.objects.exclude(Q(image='') | Q(image__isnull=True))
+        if not options['all']:
+            cases = cases.filter(image_derivatives={})
+        built = failed = 0
+        for case_id in cases.values_list('pk', flat=True).iterator():
+            try:
+                build_derivatives(case_id)
+                built += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"case {case_id}: {e}")
+        self.stdout.write(self.style.SUCCESS(f"{built} case images processed, {failed} failed"))
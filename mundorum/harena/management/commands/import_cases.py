@@ -0,0 +1,33 @@
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from harena.ndjson import IMPORT_BATCH_SIZE, import_cases
+
+
+class Command(BaseCommand):
+    help = "Imports cases from an NDJSON file (one JSON object per line), owned by the given user."
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="NDJSON file to import, or - for standard input.")
+        parser.add_argument('--owner', required=True, help="Username of the cases' owner.")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help="Cases created per transaction.")
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.select_related('person').get(username=options['owner']).person
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['owner']} does not exist")
+
+        def report(line, errors):
+            self.stderr.write(f"line {line}: {json.dumps(errors, ensure_ascii=False)}")
+
+        if options['file'] == '-':
+            created, failed = import_cases(sys.stdin, owner, options['batch_size'], report)
+        else:
+            with open(options['file'], encoding='utf-8') as lines:
+                created, failed = import_cases(lines, owner, options['batch_size'], report)
+        self.stdout.write(self.style.SUCCESS(f"{created} cases imported, {failed} lines rejected"))
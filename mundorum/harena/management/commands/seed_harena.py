@@ -0,0 +1,156 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from harena import bus, caching
+from harena.models import (Case, Institution, InstitutionDomain, Person, Quest, QuestCase, QuestMembership,
+                           next_version)
+
+
+SPECIALTIES = ['Cardiologia', 'Dermatologia', 'Endocrinologia', 'Gastroenterologia', 'Neurologia', 'Pediatria',
+               'Pneumologia', 'Radiologia', 'Reumatologia', 'Ortopedia', 'Infectologia', 'Nefrologia']
+WORDS = ('paciente sexo masculino feminino anos queixa dor torácica abdominal febre tosse dispneia cefaleia '
+         'exame físico ausculta pulmonar cardíaca pressão arterial frequência saturação hemograma leucocitose '
+         'radiografia tomografia ressonância lesão nódulo opacidade derrame edema história familiar tabagismo '
+         'hipertensão diabetes uso medicação contínua evolução quadro início súbito progressivo há dias semanas '
+         'internação tratamento antibiótico diagnóstico diferencial hipótese conduta achado laboratorial').split()
+
+
+class Command(BaseCommand):
+    help = ("Fills the database with synthetic institutions, people, quests and cases at production-like "
+            "volumes, for benchmarks (see bench_harena). Rows are created with bulk_create.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--institutions', type=int, default=2000)
+        parser.add_argument('--people', type=int, default=200000)
+        parser.add_argument('--professors', type=float, default=0.05, help="Share of people who are professors.")
+        parser.add_argument('--quests', type=int, default=20000)
+        parser.add_argument('--cases', type=int, default=100000)
+        parser.add_argument('--cases-per-quest', type=int, default=10)
+        parser.add_argument('--viewers-per-quest', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per INSERT.")
+        parser.add_argument('--prefix', default='seed', help="Prefix of the usernames, institution names and domains.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, so runs are reproducible.")
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}-').exists():
+            raise CommandError(f"There is already data seeded with the prefix {prefix!r}; pass another --prefix")
+        if options['people'] < 2 or options['institutions'] < 1:
+            raise CommandError("At least one institution and two people are needed")
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        institutions = self.step('institutions', lambda: self.create_institutions(prefix, options['institutions']))
+        self.step('domains', lambda: self.create_domains(prefix, institutions))
+        people = self.step('people', lambda: self.create_people(prefix, institutions, options['people'],
+                                                                options['professors']))
+        professors = [person for person in people if person.role == 'professor']
+        students = [person for person in people if person.role == 'student']
+        cases = self.step('cases', lambda: self.create_cases(professors, options['cases']))
+        quests = self.step('quests', lambda: self.create_quests(professors, options['quests']))
+        self.step('quest cases', lambda: self.link_cases(quests, cases, options['cases_per_quest']))
+        self.step('memberships', lambda: self.add_viewers(quests, students, options['viewers_per_quest']))
+
+        # bulk_create sends no signals: drop whatever the caches hold
+        caching.clear()
+        bus.publish(bus.RESET)
+
+    def step(self, label, create):
+        start = time.monotonic()
+        with transaction.atomic():
+            rows = create()
+        self.stdout.write(f"{label:<12} {len(rows):>8} rows in {time.monotonic() - start:6.1f}s")
+        return rows
+
+    def bulk_create(self, model, rows, **kwargs):
+        return model.objects.bulk_create(rows, batch_size=self.batch_size, **kwargs)
+
+    def create_institutions(self, prefix, count):
+        return self.bulk_create(Institution, [Institution(name=f'{prefix.title()} Institution {n}')
+                                              for n in range(count)])
+
+    def create_domains(self, prefix, institutions):
+        domains = []
+        for n, institution in enumerate(institutions):
+            domains.append(InstitutionDomain(name=f'inst{n}.{prefix}.edu.br', institution=institution))
+            if self.random.random() < 0.3:
+                # students and staff on subdomains of their own
+                domains.append(InstitutionDomain(name=f'aluno.inst{n}.{prefix}.edu.br', institution=institution))
+        return self.bulk_create(InstitutionDomain, domains)
+
+    def create_people(self, prefix, institutions, count, professors):
+        # a few large institutions and a long tail of small ones
+        weights = [1 / (rank + 1) for rank in range(len(institutions))]
+        chosen = self.random.choices(range(len(institutions)), weights, k=count)
+        users = self.bulk_create(User, [
+            # '!' marks an unusable password: seeded people only sign in with tokens
+            User(username=f'{prefix}-{n}', email=f'{prefix}-{n}@inst{i}.{prefix}.edu.br',
+                 first_name='Pessoa', last_name=str(n), password='!')
+            for n, i in enumerate(chosen)
+        ])
+        # the first person of an institution teaches, so every institution has a professor
+        seen = set()
+        people = []
+        for user, i in zip(users, chosen):
+            professor = i not in seen or self.random.random() < professors
+            seen.add(i)
+            people.append(Person(user=user, institution=institutions[i], role='professor' if professor else 'student'))
+        return self.bulk_create(Person, people)
+
+    def create_cases(self, professors, count):
+        cases = []
+        for n in range(count):
+            content = ' '.join(self.random.choices(WORDS, k=self.random.randint(80, 400)))
+            cases.append(Case(
+                name=f'Caso {n}: {" ".join(self.random.choices(WORDS, k=3))}',
+                description=' '.join(self.random.choices(WORDS, k=20)),
+                content=content.capitalize() + '.',
+                answer=self.random.choice(WORDS),
+                possible_answers=self.random.sample(WORDS, 4),
+                case_owner=self.random.choice(professors),
+                complexity=self.random.choice(Case.COMPLEXITY_CHOICES)[0],
+                specialty=self.random.choice(SPECIALTIES),
+            ))
+        return self.bulk_create(Case, cases)
+
+    def create_quests(self, professors, count):
+        version = next_version()
+        quests = []
+        for n in range(count):
+            owner = self.random.choice(professors)
+            quests.append(Quest(name=f'Quest {n}', institution_id=owner.institution_id, owner=owner,
+                                visible_to_institution=self.random.random() < 0.5, version=version + n))
+        quests = self.bulk_create(Quest, quests)
+        # Quest.save makes the owner an author
+        self.bulk_create(QuestMembership, [QuestMembership(quest=quest, person=quest.owner, role='author')
+                                           for quest in quests])
+        return quests
+
+    def link_cases(self, quests, cases, per_quest):
+        # mostly cases of the quest's own institution
+        by_institution = {}
+        for case in cases:
+            by_institution.setdefault(case.case_owner.institution_id, []).append(case)
+        links = []
+        for quest in quests:
+            pool = by_institution.get(quest.institution_id, [])
+            if len(pool) < per_quest:
+                pool = cases
+            for case in self.random.sample(pool, min(per_quest, len(pool))):
+                links.append(QuestCase(quest=quest, case=case))
+        return self.bulk_create(QuestCase, links, ignore_conflicts=True)
+
+    def add_viewers(self, quests, students, per_quest):
+        by_institution = {}
+        for student in students:
+            by_institution.setdefault(student.institution_id, []).append(student)
+        memberships = []
+        for quest in quests:
+            pool = by_institution.get(quest.institution_id, [])
+            for student in self.random.sample(pool, min(per_quest, len(pool))):
+                memberships.append(QuestMembership(quest=quest, person=student, role='viewer'))
+        return self.bulk_create(QuestMembership, memberships, ignore_conflicts=True)
@@ -0,0 +1,362 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.response import Response
+
+from . import budgets, bus, slowlog
+
+
+# Per-view request metrics in the Prometheus text format. Requests are labelled
+# with the name of the URL they resolved to (quest-cases, google-auth, ...), so
+# the number of series stays that of the routes. Every worker counts in its own
+# memory and writes it to a file of its own in METRICS_DIR every FLUSH_INTERVAL
+# seconds; a scrape adds up the files of every worker, including the ones that
+# have exited, so counters only go down when the directory is cleared (on deploy).
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5.0)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# requests that resolved to no URL name (404s, unnamed routes)
+UNNAMED = '<unnamed>'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def add(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dump(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, values, dumped):
+        for labels, value in dumped:
+            labels = tuple(labels)
+            values[labels] = values.get(labels, 0) + value
+
+    def render(self, values):
+        lines = []
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}')
+        return lines
+
+
+# Values are [count per bucket (not cumulative)..., count above the last, sum].
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        slots = self.values.get(labels)
+        if slots is None:
+            slots = self.values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                slots[i] += 1
+                break
+        else:
+            slots[-2] += 1
+        slots[-1] += value
+
+    def merge(self, values, dumped):
+        for labels, slots in dumped:
+            labels = tuple(labels)
+            if labels in values:
+                values[labels] = [a + b for a, b in zip(values[labels], slots)]
+            else:
+                values[labels] = list(slots)
+
+    def render(self, values):
+        lines = []
+        for labels, slots in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), slots[:-1]):
+                cumulative += count
+                bucket_labels = format_labels((*self.labels, 'le'), (*labels, format_value(bound)))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {format_value(slots[-1])}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+REQUESTS = Counter('harena_requests_total', 'Requests served, by view and status.',
+                   ('view', 'method', 'status'))
+LATENCY = Histogram('harena_request_duration_seconds', 'Time to build the response.',
+                    ('view', 'method'), LATENCY_BUCKETS)
+QUERIES = Histogram('harena_db_queries_per_request', 'SQL queries run by each request.',
+                    ('view',), QUERY_BUCKETS)
+QUERY_TIME = Counter('harena_db_query_seconds_total', 'Time spent running SQL queries.', ('view',))
+SERIALIZER_TIME = Counter('harena_serializer_seconds_total', 'Time spent serializing responses.', ('view',))
+BUS_EVENTS = Counter('harena_invalidation_events_total', 'Invalidation bus events, by outcome.', ('outcome',))
+BUS_RECONNECTS = Counter('harena_invalidation_reconnects_total', 'Invalidation bus reconnections.', ())
+BUS_LAG = Histogram('harena_invalidation_lag_seconds', 'Time from publishing an invalidation event to applying it.',
+                    (), bus.BusMetrics.LAG_BUCKETS)
+REQUEST_METRICS = (REQUESTS, LATENCY, QUERIES, QUERY_TIME, SERIALIZER_TIME)
+ALL_METRICS = (*REQUEST_METRICS, BUS_EVENTS, BUS_RECONNECTS, BUS_LAG)
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def bus_values():
+    """
+    This worker's invalidation bus counters, in the form the other metrics dump.
+    """
+    snapshot = bus.metrics.snapshot()
+    buckets = list(snapshot['lag_buckets'].values())
+    # the bus counts cumulatively
+    slots = [count - previous for count, previous in zip(buckets, [0] + buckets[:-1])]
+    slots += [snapshot['received'] - (buckets[-1] if buckets else 0), snapshot['lag_sum']]
+    return {
+        BUS_EVENTS.name: [[[outcome], snapshot[outcome]] for outcome in ('published', 'received', 'failed')],
+        BUS_RECONNECTS.name: [[[], snapshot['reconnects']]],
+        BUS_LAG.name: [[[], slots]],
+    }
+
+
+def dump():
+    with _lock:
+        data = {metric.name: metric.dump() for metric in REQUEST_METRICS}
+    data.update(bus_values())
+    return data
+
+
+def clear():
+    with _lock:
+        for metric in REQUEST_METRICS:
+            metric.values.clear()
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None)
+
+
+def process_file():
+    return Path(metrics_dir()) / f'{os.getpid()}.json'
+
+
+def flush():
+    """
+    Writes this worker's metrics to its file, replacing it whole so a scrape
+    never reads half of one.
+    """
+    if metrics_dir() is None:
+        return
+    path = process_file()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix('.tmp')
+    temporary.write_text(json.dumps(dump()))
+    os.replace(temporary, path)
+
+
+def collect():
+    """
+    The metrics of every worker that wrote a file (this one up to date), or of
+    this worker alone without METRICS_DIR, as {metric name: {labels: value}}.
+    """
+    if metrics_dir() is None:
+        dumps = [dump()]
+    else:
+        flush()
+        dumps = []
+        for path in Path(metrics_dir()).glob('*.json'):
+            try:
+                dumps.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                # a worker's file removed or being cleared under us
+                continue
+    merged = {metric.name: {} for metric in ALL_METRICS}
+    for data in dumps:
+        for metric in ALL_METRICS:
+            metric.merge(merged[metric.name], data.get(metric.name, []))
+    return merged
+
+
+def render():
+    merged = collect()
+    lines = []
+    for metric in ALL_METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render(merged[metric.name]))
+    return '\n'.join(lines) + '\n'
+
+
+class Flusher(threading.Thread):
+    def __init__(self):
+        super().__init__(name='metrics-flusher', daemon=True)
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                flush()
+            except OSError:
+                pass
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def start_flusher():
+    # once per process, like the bus listener
+    global _flusher
+    if metrics_dir() is None or (_flusher is not None and _flusher.pid == os.getpid()):
+        return
+    with _flusher_lock:
+        if _flusher is None or _flusher.pid != os.getpid():
+            if _flusher is not None:
+                # counts copied from the parent are the parent's to report
+                clear()
+            _flusher = Flusher()
+            _flusher.start()
+            atexit.register(flush)
+
+
+# What the current request spent on SQL and serialization, added to by the
+# execute wrapper and the views' serializing() blocks while the middleware has it set, with
+# its slowest statements for the slow-query log and all of them for the query
+# budgets (each None when that is off).
+class RequestStats:
+    __slots__ = ('queries', 'query_time', 'serializer_time', 'slowest', 'statements')
+
+    def __init__(self, keep_slowest, keep_statements):
+        self.queries = 0
+        self.query_time = 0.0
+        self.serializer_time = 0.0
+        self.slowest = [] if keep_slowest else None
+        self.statements = [] if keep_statements else None
+
+
+def count_query(execute, sql, params, many, context):
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        stats.query_time += duration
+        stats.queries += 1
+        if stats.slowest is not None:
+            slowlog.keep(stats.slowest, duration, stats.queries, sql, params, many)
+        if stats.statements is not None:
+            stats.statements.append(sql)
+
+
+@contextmanager
+def serializing():
+    """
+    Counts the time spent in the block as the current request's serializer time.
+    """
+    stats = getattr(_local, 'stats', None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.serializer_time += time.perf_counter() - start
+
+
+class SerializerTimingMixin:
+    """
+    For views: serialize() builds a serializer's data, timed for the request
+    metrics.
+    """
+    def serialize(self, serializer):
+        with serializing():
+            return serializer.data
+
+
+class TimedViewSetMixin(SerializerTimingMixin):
+    """
+    For model viewsets: their list and retrieve, as DRF's, with the
+    serialization timed.
+    """
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize(self.get_serializer(page, many=True)))
+        return Response(self.serialize(self.get_serializer(queryset, many=True)))
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.serialize(self.get_serializer(self.get_object())))
+
+
+class MetricsMiddleware:
+    """
+    Times each request and counts its SQL queries, handing the slowest ones of
+    slow requests to the slow-query log and checking the view's query budget
+    when budgets are enforced. Goes first in MIDDLEWARE, so the time includes
+    the other middleware; a streamed response is timed (and its queries
+    counted) until it starts streaming.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start_flusher()
+        slow_threshold = slowlog.threshold()
+        stats = _local.stats = RequestStats(slow_threshold is not None, budgets.enforced())
+        start = time.perf_counter()
+        wrapped = []
+        try:
+            for connection in connections.all():
+                connection.execute_wrappers.append(count_query)
+                wrapped.append(connection)
+            response = self.get_response(request)
+        finally:
+            for connection in wrapped:
+                connection.execute_wrappers.remove(count_query)
+            _local.stats = None
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name if match is not None else None) or UNNAMED
+        with _lock:
+            REQUESTS.add((view, request.method, str(response.status_code)))
+            LATENCY.observe((view, request.method), elapsed)
+            QUERIES.observe((view,), stats.queries)
+            QUERY_TIME.add((view,), stats.query_time)
+            SERIALIZER_TIME.add((view,), stats.serializer_time)
+        if slow_threshold is not None and elapsed >= slow_threshold:
+            user = getattr(request, 'user', None)
+            slowlog.schedule(view, request.method, user.pk if user is not None else None, elapsed, stats.slowest)
+        if stats.statements is not None:
+            budgets.check(match, request.method, stats.statements)
+        return response
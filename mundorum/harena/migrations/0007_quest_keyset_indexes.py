@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0006_institution_active_institution_active_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='quest',
+            index=models.Index(fields=['created_at', 'id'], name='quest_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quest',
+            index=models.Index(fields=['owner', 'created_at', 'id'], name='quest_owner_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quest',
+            index=models.Index(fields=['institution', 'visible_to_institution', 'created_at', 'id'], name='quest_inst_visible_keyset_idx'),
+        ),
+    ]
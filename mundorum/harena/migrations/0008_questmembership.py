@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0007_quest_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('viewer', 'Viewer'), ('author', 'Author')], default='viewer', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quest_memberships', to='harena.person')),
+                ('quest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='harena.quest')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['quest', 'role'], name='quest_membership_role_idx')],
+                'constraints': [models.UniqueConstraint(fields=('person', 'quest'), name='unique_quest_membership')],
+            },
+        ),
+    ]
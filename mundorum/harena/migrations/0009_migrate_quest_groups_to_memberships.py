@@ -0,0 +1,85 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:30
+
+import uuid
+
+from django.db import migrations
+
+
+ROLE_BY_PREFIX = {'viewers': 'viewer', 'authors': 'author'}
+
+
+def quest_groups(Group):
+    # (group, prefix, quest id) for every viewers_<id>/authors_<id> group
+    for group in Group.objects.filter(name__regex=r'^(viewers|authors)_'):
+        prefix, _, quest_id = group.name.partition('_')
+        try:
+            yield group, prefix, uuid.UUID(quest_id)
+        except ValueError:
+            continue
+
+
+def groups_to_memberships(apps, schema_editor):
+    Group = apps.get_model('auth', 'Group')
+    Quest = apps.get_model('harena', 'Quest')
+    Person = apps.get_model('harena', 'Person')
+    QuestMembership = apps.get_model('harena', 'QuestMembership')
+
+    quest_ids = set(Quest.objects.values_list('id', flat=True))
+    person_ids = set(Person.objects.values_list('pk', flat=True))
+
+    roles = {}
+    converted = []
+    for group, prefix, quest_id in quest_groups(Group):
+        converted.append(group.pk)
+        if quest_id not in quest_ids:
+            continue
+        for user_id in group.user_set.values_list('id', flat=True):
+            if user_id not in person_ids:
+                continue
+            # author wins over viewer when a user was in both groups
+            if roles.get((quest_id, user_id)) != 'author':
+                roles[(quest_id, user_id)] = ROLE_BY_PREFIX[prefix]
+
+    QuestMembership.objects.bulk_create(
+        [QuestMembership(quest_id=quest_id, person_id=user_id, role=role)
+         for (quest_id, user_id), role in roles.items()],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    Group.objects.filter(pk__in=converted).delete()
+
+
+def memberships_to_groups(apps, schema_editor):
+    # back to a viewers_<id> group per quest with members, and authors_<id>
+    # for its authors, who were in both
+    Group = apps.get_model('auth', 'Group')
+    User = apps.get_model('auth', 'User')
+    QuestMembership = apps.get_model('harena', 'QuestMembership')
+
+    members = {}
+    for quest_id, person_id, role in QuestMembership.objects.values_list('quest_id', 'person_id', 'role'):
+        members.setdefault(f'viewers_{quest_id}', set()).add(person_id)
+        if role == 'author':
+            members.setdefault(f'authors_{quest_id}', set()).add(person_id)
+
+    Group.objects.bulk_create([Group(name=name) for name in members], batch_size=1000, ignore_conflicts=True)
+    group_ids = dict(Group.objects.filter(name__regex=r'^(viewers|authors)_').values_list('name', 'pk'))
+    UserGroup = User.groups.through
+    UserGroup.objects.bulk_create(
+        [UserGroup(user_id=user_id, group_id=group_ids[name]) for name, user_ids in members.items()
+         for user_id in user_ids],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('harena', '0008_questmembership'),
+    ]
+
+    operations = [
+        migrations.RunPython(groups_to_memberships, memberships_to_groups),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0009_migrate_quest_groups_to_memberships'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='institution',
+            name='active_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
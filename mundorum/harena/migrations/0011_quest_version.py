@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0010_institution_active_updated_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quest',
+            name='version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0011_quest_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvalidationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender', models.CharField(max_length=100)),
+                ('sent_at', models.FloatField()),
+                ('name', models.CharField(max_length=100)),
+                ('args', models.JSONField(default=list)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0012_invalidationevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='questcase',
+            index=models.Index(fields=['quest', 'added_at', 'id'], name='quest_case_order_idx'),
+        ),
+    ]
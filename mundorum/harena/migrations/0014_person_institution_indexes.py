@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0013_quest_case_order_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['institution', 'user'], name='person_inst_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['institution', 'role', 'user'], name='person_inst_role_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:50
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# Full-text search only exists on PostgreSQL; elsewhere the column stays empty
+# and Case.objects.search() falls back to a substring match.
+class AddIndexOnPostgres(migrations.AddIndex):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            # sqlite rebuilds a table from its model state when a later
+            # migration alters it, which creates the index after all
+            schema_editor.execute(f'DROP INDEX IF EXISTS {schema_editor.quote_name(self.index.name)}')
+
+
+class RunSQLOnPostgres(migrations.RunSQL):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+# must match CASE_SEARCH_CONFIG in harena/models.py
+SEARCH_VECTOR = """
+    setweight(to_tsvector('portuguese', coalesce({row}name, '')), 'A') ||
+    setweight(to_tsvector('portuguese', coalesce({row}specialty, '')), 'B') ||
+    setweight(to_tsvector('portuguese', coalesce({row}description, '')), 'B') ||
+    setweight(to_tsvector('portuguese', coalesce({row}content, '')), 'C')
+"""
+
+CREATE_TRIGGER = f"""
+CREATE FUNCTION harena_case_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {SEARCH_VECTOR.format(row='NEW.')};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER harena_case_search_vector
+    BEFORE INSERT OR UPDATE OF name, specialty, description, content ON harena_case
+    FOR EACH ROW EXECUTE FUNCTION harena_case_search_vector();
+
+UPDATE harena_case SET search_vector = {SEARCH_VECTOR.format(row='')};
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS harena_case_search_vector ON harena_case;
+DROP FUNCTION IF EXISTS harena_case_search_vector();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0014_person_institution_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='case',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        RunSQLOnPostgres(CREATE_TRIGGER, DROP_TRIGGER),
+        AddIndexOnPostgres(
+            model_name='case',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='case_search_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.7 on 2026-10-17 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0015_case_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['created_at', 'id'], name='case_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['case_owner', 'complexity', 'specialty'], name='case_owner_facets_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harena', '0019_slowquery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questviewerinvitetoken',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, help_text='Empty for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='questviewerinvitetoken',
+            name='uses',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='QuestInviteRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('redeemed_at', models.DateTimeField(auto_now_add=True)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quest_invite_redemptions', to='harena.person')),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='harena.questviewerinvitetoken')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'person'), name='unique_quest_invite_redemption')],
+            },
+        ),
+    ]
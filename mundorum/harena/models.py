@@ -1,28 +1,120 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
-from django.contrib.auth.models import Group
+import time
 import uuid
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authentication import TokenAuthentication
 from django.contrib.postgres.fields import JSONField
 from django.db.models import JSONField
+from django.db.models import Q
+from django.db.models.fields.files import FieldFile
+from django.db.models.functions import Greatest
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVectorField
+from django.db import connection
+
+
+# Remembers the values of `tracked_fields` as loaded from (or last saved to) the
+# database, so save hooks can tell what actually changed without querying.
+class TrackedFieldsMixin:
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_tracked_fields()
+        return instance
+
+    def _tracked_value(self, field):
+        value = getattr(self, field)
+        # a FieldFile is changed in place (FieldFile.save), so its name is kept
+        return value.name if isinstance(value, FieldFile) else value
+
+    def _snapshot_tracked_fields(self, fields=None):
+        # only `fields` (names or attnames) when given, as the others may have
+        # unsaved changes; deferred fields are not in __dict__ and are left out
+        if fields is None:
+            self._loaded_values = {}
+            tracked = self.tracked_fields
+        else:
+            attnames = {self._meta.get_field(name).attname for name in fields}
+            tracked = [field for field in self.tracked_fields if field in attnames]
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        for field in tracked:
+            if field in self.__dict__:
+                loaded[field] = self._tracked_value(field)
+
+    def initial_value(self, field):
+        loaded = getattr(self, '_loaded_values', {})
+        return loaded[field] if field in loaded else self._tracked_value(field)
+
+    def has_changed(self, *fields):
+        """
+        True if the row is new or any of the given tracked fields differs from
+        the database value. A field still deferred has not been set, so it has
+        not changed, and is not loaded to tell.
+        """
+        if self._state.adding:
+            return True
+        loaded = getattr(self, '_loaded_values', {})
+        return any(field in self.__dict__ and (field not in loaded or loaded[field] != self._tracked_value(field))
+                   for field in fields)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._snapshot_tracked_fields(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        self._snapshot_tracked_fields(fields)
+
+
+# User is not ours to give TrackedFieldsMixin, so these of its fields are
+# snapshotted by signals instead: when a User is built, and by every save,
+# which first records what it changes for the post_save receivers to ask
+# with user_has_changed(). last_login and password are not served anywhere.
+USER_TRACKED_FIELDS = ('username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser')
+
+
+@receiver(post_init, sender=User)
+def snapshot_user(sender, instance, **kwargs):
+    instance._loaded_values = {field: instance.__dict__[field] for field in USER_TRACKED_FIELDS
+                               if field in instance.__dict__}
+
+
+@receiver(pre_save, sender=User)
+def record_user_changes(sender, instance, update_fields=None, **kwargs):
+    fields = [field for field in USER_TRACKED_FIELDS if update_fields is None or field in update_fields]
+    loaded = instance._loaded_values
+    instance._saved_changes = {field for field in fields if instance._state.adding or field not in loaded
+                               or loaded[field] != getattr(instance, field)}
+    loaded.update((field, getattr(instance, field)) for field in fields)
+
 
+def user_has_changed(user, *fields):
+    """
+    In a User post_save receiver: True if the save wrote a new value to any of
+    the given USER_TRACKED_FIELDS.
+    """
+    return not getattr(user, '_saved_changes', set(fields)).isdisjoint(fields)
 
-class Institution(models.Model):
+
+class Institution(TrackedFieldsMixin, models.Model):
     name = models.CharField(max_length=100, unique=True)
     active = models.BooleanField(default=True)  # flag to indicate if the institution is active or not
-    active_updated_at = models.DateTimeField(auto_now=True)
+    active_updated_at = models.DateTimeField(default=timezone.now)
+
+    tracked_fields = ('name', 'active')
 
     def save(self, *args, **kwargs):
-        if self.pk:  
-            old = Institution.objects.get(pk=self.pk)
-            if old.active != self.active:
-                self.active_updated_at = timezone.now()
-        else:
+        if not self._state.adding and self.has_changed('active'):
             self.active_updated_at = timezone.now()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'active_updated_at'}
         super().save(*args, **kwargs)
 
 
@@ -37,8 +129,25 @@ class InstitutionDomain(models.Model):
     def __str__(self):
         return self.name    
 
+def institution_of(user):
+    """
+    The user's institution id as a subquery, so scoping by it costs no extra query.
+    """
+    return models.Subquery(Person.objects.filter(pk=user.pk).values('institution_id')[:1])
+
+
+class PersonQuerySet(models.QuerySet):
+
+    def in_institution_of(self, user):
+        """
+        People of the user's institution, with their User joined. A user without
+        an institution sees nobody.
+        """
+        return self.filter(institution_id=institution_of(user)).select_related('user')
+
+
 # A Person is a User with additional fields like Google ID, profile picture, birth date, institution, role.
-class Person(models.Model):
+class Person(TrackedFieldsMixin, models.Model):
 
     ROLE_CHOICES = [
         ('student', 'Student'),
@@ -57,6 +166,16 @@ class Person(models.Model):
     institution = models.ForeignKey(Institution, on_delete=models.PROTECT, related_name='people', null=True)
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='student')
 
+    objects = PersonQuerySet.as_manager()
+
+    tracked_fields = ('institution_id',)
+
+    class Meta:
+        indexes = [
+            # an institution's people in keyset order, all of them or by role
+            models.Index(fields=['institution', 'user'], name='person_inst_keyset_idx'),
+            models.Index(fields=['institution', 'role', 'user'], name='person_inst_role_idx'),
+        ]
 
     def __str__(self):
         if self.role == 'professor':
@@ -64,13 +183,11 @@ class Person(models.Model):
         return self.user.username
 
 
-# Automatically create or update Person when User is created/updated
+# Automatically create Person when User is created
 @receiver(post_save, sender=User)
 def create_or_update_person(sender, instance, created, **kwargs):
     if created:
         Person.objects.create(user=instance)
-    else:
-        instance.person.save()
 
 
 # Professor registration through expirable token 
@@ -89,8 +206,53 @@ class ProfessorInviteToken(models.Model):
     def __str__(self):
         return f"Token for {self.institution.name} - Expires at {self.expires_at.strftime('%d/%m/%Y %H:%M')}"
 
+def next_version():
+    # microsecond clock, so versions also grow across quests and list ETags can use their max
+    return time.time_ns() // 1000
+
+
+class QuestQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Quests the user can view, resolved in the database: owned quests, quests
+        visible to the user's institution and quests shared through a membership.
+        """
+        return self.filter(
+            Q(owner_id=user.pk) |
+            Q(visible_to_institution=True, institution_id=institution_of(user)) |
+            Q(id__in=QuestMembership.objects.filter(person_id=user.pk).values('quest_id'))
+        )
+
+    def with_cases(self, case_columns=None):
+        """
+        Quests ready for QuestSerializer: institution and owner joined, and the
+        quest cases with their case fetched in a single extra query. With
+        `case_columns`, only those columns of each case are read.
+        """
+        quest_cases = QuestCase.objects.select_related('case').defer('case__search_vector').order_by('added_at', 'id')
+        if case_columns is not None:
+            quest_cases = quest_cases.only('quest', 'added_at', 'case__id',
+                                           *[f'case__{column}' for column in case_columns])
+        return self.select_related('institution', 'owner__user').prefetch_related(
+            models.Prefetch('quest_cases', queryset=quest_cases)
+        )
+
+    def bump_version(self):
+        return self.update(version=Greatest(models.F('version') + 1, next_version()))
+
+    def editable_by(self, user):
+        """
+        Quests the user can edit: owned quests and quests where the user is an author.
+        """
+        return self.filter(
+            Q(owner_id=user.pk) |
+            Q(id__in=QuestMembership.objects.filter(person_id=user.pk, role='author').values('quest_id'))
+        )
+
+
 # A Quest is a group of cases or challenge that can be assigned to users, associated with an institution.    
-class Quest(models.Model):
+class Quest(TrackedFieldsMixin, models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
     institution = models.ForeignKey('Institution', on_delete=models.CASCADE, related_name='quests')
@@ -98,34 +260,180 @@ class Quest(models.Model):
     visible_to_institution = models.BooleanField(default=False)  # if True, all users in the institution can see this quest
 
     created_at = models.DateTimeField(auto_now_add=True)
+    # increases whenever the quest or what is served with it changes (see harena.versions)
+    version = models.BigIntegerField(default=0, editable=False)
+
+    objects = QuestQuerySet.as_manager()
+
+    tracked_fields = ('owner_id', 'institution_id', 'visible_to_institution')
+
+    class Meta:
+        # keyset pagination scans (created_at, id) inside each visibility branch
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='quest_keyset_idx'),
+            models.Index(fields=['owner', 'created_at', 'id'], name='quest_owner_keyset_idx'),
+            models.Index(fields=['institution', 'visible_to_institution', 'created_at', 'id'],
+                         name='quest_inst_visible_keyset_idx'),
+        ]
 
     def save(self, *args, **kwargs):
+        owner_changed = self.has_changed('owner_id')
+        self.version = max(self.version + 1, next_version())
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version'}
         super().save(*args, **kwargs)
         
-        # Automatically add the owner to the quest's group
-        viewers_group, _ = Group.objects.get_or_create(name=f"viewers_{self.id}")
-        authors_group, _ = Group.objects.get_or_create(name=f"authors_{self.id}")
-        self.owner.user.groups.add(viewers_group, authors_group)
+        # Automatically make a new owner an author of the quest
+        if owner_changed:
+            QuestMembership.objects.update_or_create(
+                quest=self, person_id=self.owner_id, defaults={'role': 'author'})
 
     def __str__(self):
         return f"{self.name} ({self.institution.name})" 
 
-# Token for inviting users to view a Quest, with an expiration date
-class QuestViewerInviteToken(models.Model):
+# Who can see or edit a Quest besides its owner. Authors can also view.
+class QuestMembership(models.Model):
+
+    ROLE_CHOICES = [
+        ('viewer', 'Viewer'),
+        ('author', 'Author'),
+    ]
+
+    quest = models.ForeignKey('Quest', on_delete=models.CASCADE, related_name='memberships')
+    person = models.ForeignKey('Person', on_delete=models.CASCADE, related_name='quest_memberships')
+    role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='viewer')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # also the index behind every (person, quest) permission lookup
+            models.UniqueConstraint(fields=['person', 'quest'], name='unique_quest_membership'),
+        ]
+        indexes = [
+            models.Index(fields=['quest', 'role'], name='quest_membership_role_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.person} ({self.role}) in {self.quest.name}"
+
+# Token for inviting users to view a Quest, with an expiration date and,
+# optionally, a limit on how many people may redeem it
+class QuestViewerInviteToken(TrackedFieldsMixin, models.Model):
     token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     quest = models.ForeignKey('Quest', on_delete=models.CASCADE, related_name='viewer_tokens')
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
+    max_uses = models.PositiveIntegerField(null=True, blank=True, help_text="Empty for no limit.")
+    # counted only while there is a limit, by a conditional UPDATE (see
+    # QuestViewerInviteToken.use); the redemptions are the full record
+    uses = models.PositiveIntegerField(default=0, editable=False)
+
+    tracked_fields = ('max_uses',)
+
+    def save(self, *args, **kwargs):
+        # a limit set on a token that was already redeemed counts from its redemptions
+        if self.max_uses is not None and not self._state.adding and self.initial_value('max_uses') is None:
+            self.uses = self.redemptions.count()
+        super().save(*args, **kwargs)
 
     def is_valid(self):
         return timezone.now() < self.expires_at
 
+    def use(self):
+        """
+        Takes one of the token's uses in a single UPDATE that only matches while
+        some are left, so concurrent redemptions can't go over max_uses.
+        Returns False when none are left.
+        """
+        if self.max_uses is None:
+            return True
+        return QuestViewerInviteToken.objects.filter(pk=self.pk, uses__lt=models.F('max_uses')).update(
+            uses=models.F('uses') + 1) == 1
+
     def __str__(self):
         return f"Token for {self.quest.name} - Expires at {self.expires_at.strftime('%d/%m/%Y %H:%M')}"
+
+
+# Who redeemed a quest viewer invite token, and when; a person redeems a token
+# once, so redeeming it again changes nothing
+class QuestInviteRedemption(models.Model):
+    token = models.ForeignKey(QuestViewerInviteToken, on_delete=models.CASCADE, related_name='redemptions')
+    person = models.ForeignKey('Person', on_delete=models.CASCADE, related_name='quest_invite_redemptions')
+    redeemed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['token', 'person'], name='unique_quest_invite_redemption'),
+        ]
+
+    def __str__(self):
+        return f"{self.person} redeemed {self.token.token}"
     
   
 
-class Case(models.Model):
+# Text search configuration of Case.search_vector; the trigger that fills it
+# (migration 0015) uses the same one.
+CASE_SEARCH_CONFIG = 'portuguese'
+
+
+class CaseQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Cases the user owns or can reach through a quest they can view.
+        """
+        return self.filter(
+            Q(case_owner_id=user.pk) |
+            models.Exists(QuestCase.objects.filter(case=models.OuterRef('pk'),
+                                                   quest__in=Quest.objects.visible_to(user)))
+        )
+
+    def in_catalog_of(self, institution_id):
+        """
+        The institution's case library: cases owned by its people and cases in
+        quests shared with the whole institution.
+        """
+        return self.filter(
+            Q(case_owner__institution_id=institution_id) |
+            models.Exists(QuestCase.objects.filter(case=models.OuterRef('pk'), quest__institution_id=institution_id,
+                                                   quest__visible_to_institution=True))
+        )
+
+    def search(self, text):
+        """
+        Cases matching a web-style query (words, "phrases", -excluded, or),
+        annotated with their `rank`. Runs on the GIN-indexed search_vector; other
+        databases fall back to an unranked substring match.
+        """
+        if connection.vendor != 'postgresql':
+            return self.filter(
+                Q(name__icontains=text) | Q(description__icontains=text) | Q(content__icontains=text)
+            ).annotate(rank=models.Value(0.0, output_field=models.FloatField()))
+        query = SearchQuery(text, config=CASE_SEARCH_CONFIG, search_type='websearch')
+        return self.filter(search_vector=query).annotate(rank=SearchRank(models.F('search_vector'), query))
+
+    def headlines(self, text):
+        """
+        Case id -> fragments of its content around the matched words, wrapped in
+        <mark>. Meant for one page of results, ts_headline is expensive.
+        """
+        if connection.vendor != 'postgresql':
+            return {}
+        query = SearchQuery(text, config=CASE_SEARCH_CONFIG, search_type='websearch')
+        headline = SearchHeadline('content', query, config=CASE_SEARCH_CONFIG, start_sel='<mark>',
+                                  stop_sel='</mark>', max_fragments=2, max_words=30, min_words=10)
+        return dict(self.annotate(snippet=headline).values_list('pk', 'snippet'))
+
+
+# The search vector is only read by searches, never loaded with the case
+class CaseManager(models.Manager.from_queryset(CaseQuerySet)):
+
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
+
+
+class Case(TrackedFieldsMixin, models.Model):
 
     COMPLEXITY_CHOICES = [
         ('undergraduate', 'Undergraduate'), #still in college
@@ -145,6 +453,22 @@ class Case(models.Model):
     complexity = models.CharField(max_length=30, choices=COMPLEXITY_CHOICES, default='undergraduate')
     specialty = models.CharField(max_length=255, blank=True, null=True)
     image = models.ImageField(upload_to='case_images/', blank=True, null=True)  # optional image for the case
+    # resized copies of the image, {size: {format: storage path}}, built by harena/images.py
+    image_derivatives = JSONField(default=dict, blank=True, editable=False)
+    # name, specialty, description and content (not the answer), kept by a database trigger
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = CaseManager()
+
+    tracked_fields = ('image', 'case_owner_id')
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='case_search_idx'),
+            models.Index(fields=['created_at', 'id'], name='case_keyset_idx'),
+            # catalog facets are counted per owner range without reading the table
+            models.Index(fields=['case_owner', 'complexity', 'specialty'], name='case_owner_facets_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -162,6 +486,67 @@ class QuestCase(models.Model):
             name='unique_quest_case'
         )
         ]
+        indexes = [
+            # a quest's cases in the order they were added (see QuestCasePagination)
+            models.Index(fields=['quest', 'added_at', 'id'], name='quest_case_order_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.case.name} in {self.quest.name}"
+
+# A resumable upload of a case image (see harena/uploads.py): the bytes received
+# so far are in a file on disk, and `offset` is how many of them were written.
+class ImageUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    case = models.ForeignKey('Case', on_delete=models.CASCADE, related_name='image_uploads')
+    owner = models.ForeignKey('Person', on_delete=models.CASCADE, related_name='image_uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # the uploads still in progress of each person, for the concurrency limit
+            models.Index(fields=['owner', 'completed_at', 'updated_at'], name='image_upload_active_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size} bytes) for {self.case.name}"
+
+
+# Cache invalidation events for databases without LISTEN/NOTIFY (see harena/bus.py).
+# Workers poll for rows newer than the last one they applied; old rows are pruned.
+class InvalidationEvent(models.Model):
+    sender = models.CharField(max_length=100)
+    sent_at = models.FloatField()
+    name = models.CharField(max_length=100)
+    args = JSONField(default=list)
+
+    def __str__(self):
+        return f"{self.name}{tuple(self.args)} from {self.sender}"
+
+
+# The slowest statements of requests that took longer than SLOW_REQUEST_THRESHOLD,
+# with a plan for a sample of them (see harena/slowlog.py). Only the latest
+# SLOW_QUERY_LOG_SIZE rows are kept.
+class SlowQuery(models.Model):
+    recorded_at = models.DateTimeField(auto_now_add=True)
+    view = models.CharField(max_length=200)
+    method = models.CharField(max_length=10)
+    # not a foreign key: the log outlives users and is written off the request
+    user_id = models.IntegerField(blank=True, null=True)
+    request_duration = models.FloatField()
+    duration = models.FloatField()
+    sql = models.TextField()
+    params = JSONField(default=list)
+    plan = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = 'slow queries'
 
     def __str__(self):
-        return f"{self.case.name} in {self.quest.name}"
\ No newline at end of file
+        return f"{self.duration * 1000:.0f} ms in {self.view}"
@@ -0,0 +1,70 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .caching import catalog_tags, invalidate_tags
+from .models import Case
+from .serializers import CaseImportSerializer
+
+
+# Bulk case transfer as NDJSON, one case per line. Both directions stream: an
+# import holds one batch of cases at a time and an export one database chunk,
+# so memory stays flat whatever the size of the library.
+IMPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FIELDS = ['id', 'name', 'description', 'content', 'answer', 'possible_answers',
+                 'complexity', 'specialty', 'created_at', 'case_owner']
+
+
+def import_cases(lines, owner, batch_size=IMPORT_BATCH_SIZE, on_error=None):
+    """
+    Validates and creates a case per line of `lines` (str or bytes), owned by
+    `owner`, committing every `batch_size` cases in a transaction of its own.
+    Invalid lines are skipped and passed to `on_error(line_number, errors)`.
+    Returns the number of cases created and of lines rejected.
+    """
+    created = failed = 0
+    batch = []
+
+    def flush():
+        with transaction.atomic():
+            Case.objects.bulk_create(batch)
+            # bulk_create sends no post_save
+            invalidate_tags(*catalog_tags(owner.institution_id))
+        batch.clear()
+
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            errors = {'line': [f'Invalid JSON: {e}']}
+        else:
+            serializer = CaseImportSerializer(data=data) if isinstance(data, dict) else None
+            if serializer is not None and serializer.is_valid():
+                batch.append(Case(case_owner=owner, **serializer.validated_data))
+                if len(batch) >= batch_size:
+                    created += len(batch)
+                    flush()
+                continue
+            errors = serializer.errors if serializer is not None else {'line': ['Expected a JSON object']}
+        failed += 1
+        if on_error is not None:
+            on_error(number, errors)
+
+    if batch:
+        created += len(batch)
+        flush()
+    return created, failed
+
+
+def export_cases(cases, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields one NDJSON line per case, read `chunk_size` rows at a time.
+    """
+    for row in cases.order_by().values(*EXPORT_FIELDS).iterator(chunk_size=chunk_size):
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
@@ -0,0 +1,153 @@
+import base64
+import json
+from datetime import datetime
+from uuid import UUID
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+# Keyset (seek) pagination: a page is addressed by the sort key of the last row
+# already seen, so every page is a single range scan over an index on the
+# ordering fields, no matter how deep the client goes. No COUNT(*) is issued.
+class KeysetPagination(BasePagination):
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.seek_filter(self.to_python(queryset, position)))
+
+        # one extra row tells whether there is a next page
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.next_position = self.get_position(rows[-1]) if self.has_next else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def seek_filter(self, position):
+        """
+        Rows strictly after `position` in the current ordering, expanded as
+        (a > x) OR (a = x AND b > y) OR ... so the planner can use the index.
+        """
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def get_position(self, obj):
+        position = []
+        for field in self.ordering:
+            value = obj
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value, attr)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif isinstance(value, UUID):
+                value = str(value)
+            position.append(value)
+        return position
+
+    def encode_cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def to_python(self, queryset, position):
+        """
+        The cursor's values as their ordering fields hold them, so a forged
+        cursor is answered like any other invalid one.
+        """
+        values = []
+        for field, value in zip(self.ordering, position):
+            if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+                raise NotFound(self.invalid_cursor_message)
+            model_field = self.ordering_field(queryset, field.lstrip('-'))
+            try:
+                value = model_field.to_python(value)
+                model_field.run_validators(value)
+            except (ValidationError, ValueError, TypeError, OverflowError):
+                raise NotFound(self.invalid_cursor_message)
+            values.append(value)
+        return values
+
+    @staticmethod
+    def ordering_field(queryset, name):
+        # an annotation (the rank of a search) or a field, maybe across relations
+        annotation = queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        model = queryset.model
+        *path, name = name.split('__')
+        for part in path:
+            model = model._meta.get_field(part).related_model
+        field = model._meta.get_field(name)
+        # a foreign key holds (and range checks) its target's values
+        return field.target_field if field.is_relation else field
+
+
+class PersonPagination(KeysetPagination):
+    ordering = ('user_id',)
+
+
+class UserPagination(KeysetPagination):
+    ordering = ('id',)
+
+
+# The order cases were added to a quest: the link's added_at and id, annotated on
+# the cases (see QuestCasesView) and backed by quest_case_order_idx.
+class QuestCasePagination(KeysetPagination):
+    ordering = ('added_at', 'quest_case_id')
+
+
+# Best matches first; the rank is annotated by Case.objects.search()
+class CaseSearchPagination(KeysetPagination):
+    ordering = ('-rank', 'id')
+    page_size = 20
+    max_page_size = 100
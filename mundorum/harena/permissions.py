@@ -0,0 +1,187 @@
+import hashlib
+import threading
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import bus
+from .models import Person, Quest, QuestMembership
+
+
+# Effective quest permissions, resolved once per request and kept in a TTL cache
+# shared by every request served by this process. Person entries hold what the
+# person owns or was granted; institution entries hold the quests visible to the
+# whole institution, so they are loaded once for all of its members.
+PERMISSION_CACHE_TTL = getattr(settings, 'QUEST_PERMISSION_CACHE_TTL', 300)
+PERMISSION_CACHE_SIZE = getattr(settings, 'QUEST_PERMISSION_CACHE_SIZE', 10000)
+
+_person_cache = TTLCache(maxsize=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL)
+_institution_cache = TTLCache(maxsize=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL)
+_lock = threading.Lock()
+# bumped by every invalidation, so a load that raced with a write is not cached
+_generation = 0
+
+
+class QuestPermissions:
+    def __init__(self, institution_id, owned, viewer, author, institution_visible, fingerprint):
+        self.institution_id = institution_id
+        self.viewable = owned | viewer | author | institution_visible
+        self.editable = owned | author
+        # equal for users with the same institution and quest access
+        self.fingerprint = fingerprint
+
+    def can_view(self, quest_id):
+        return quest_id in self.viewable
+
+    def can_edit(self, quest_id):
+        return quest_id in self.editable
+
+
+def _load_person(person_id):
+    institution_id = Person.objects.filter(pk=person_id).values_list('institution_id', flat=True).first()
+    owned = frozenset(Quest.objects.filter(owner_id=person_id).values_list('id', flat=True))
+    viewer, author = set(), set()
+    for quest_id, role in QuestMembership.objects.filter(person_id=person_id).values_list('quest_id', 'role'):
+        (author if role == 'author' else viewer).add(quest_id)
+    digest = _digest(institution_id, owned | viewer, owned | author)
+    return institution_id, owned, frozenset(viewer), frozenset(author), digest
+
+
+def _load_institution(institution_id):
+    visible = frozenset(
+        Quest.objects.filter(institution_id=institution_id, visible_to_institution=True)
+        .values_list('id', flat=True)
+    )
+    return visible, _digest(visible)
+
+
+def _digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (set, frozenset)):
+            part = sorted(str(id) for id in part)
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def _cached(cache, key, load):
+    with _lock:
+        value = cache.get(key)
+        generation = _generation
+    if value is None:
+        value = load(key)
+        with _lock:
+            if generation == _generation:
+                cache[key] = value
+    return value
+
+
+def get_quest_permissions(user):
+    """
+    Returns the user's QuestPermissions, memoized on the user object for the
+    rest of the request.
+    """
+    permissions = getattr(user, '_quest_permissions', None)
+    if permissions is None:
+        institution_id, owned, viewer, author, person_digest = _cached(_person_cache, user.pk, _load_person)
+        institution_visible, institution_digest = frozenset(), None
+        if institution_id is not None:
+            institution_visible, institution_digest = _cached(_institution_cache, institution_id, _load_institution)
+        permissions = QuestPermissions(institution_id, owned, viewer, author, institution_visible,
+                                       _digest(person_digest, institution_digest))
+        user._quest_permissions = permissions
+    return permissions
+
+
+# Helper function to check if a user can view a quest
+def user_can_view_quest(user, quest):
+    return get_quest_permissions(user).can_view(quest.id)
+
+# Helper function to check if a user can edit a quest
+def user_can_edit_quest(user, quest):
+    return get_quest_permissions(user).can_edit(quest.id)
+
+
+@bus.handler('permissions.person')
+def invalidate_person(person_id):
+    global _generation
+    with _lock:
+        _generation += 1
+        _person_cache.pop(person_id, None)
+
+
+@bus.handler('permissions.institution')
+def invalidate_institution(institution_id):
+    global _generation
+    with _lock:
+        _generation += 1
+        _institution_cache.pop(institution_id, None)
+
+
+@bus.reset_handler
+def clear():
+    global _generation
+    with _lock:
+        _generation += 1
+        _person_cache.clear()
+        _institution_cache.clear()
+
+
+def person_changed(person_id):
+    """
+    Drops the person's permissions here and in the other workers. The writing
+    request sees its change at once; they are dropped here again when the
+    transaction commits, as a request that loaded them in between read the
+    rows from before the commit. The other workers get the event on commit.
+    """
+    bus.broadcast('permissions.person', person_id)
+    transaction.on_commit(lambda: invalidate_person(person_id))
+
+
+def institution_changed(institution_id):
+    bus.broadcast('permissions.institution', institution_id)
+    transaction.on_commit(lambda: invalidate_institution(institution_id))
+
+
+@receiver([post_save, post_delete], sender=QuestMembership)
+def membership_changed(sender, instance, **kwargs):
+    person_changed(instance.person_id)
+
+
+@receiver(post_save, sender=Quest)
+def quest_saved(sender, instance, **kwargs):
+    if not instance.has_changed('owner_id', 'institution_id', 'visible_to_institution'):
+        return
+    # both who had access before the update and who has it now, once each
+    owner_ids = {instance.initial_value('owner_id'), instance.owner_id}
+    institution_ids = {
+        institution_id for institution_id, visible in [
+            (instance.initial_value('institution_id'), instance.initial_value('visible_to_institution')),
+            (instance.institution_id, instance.visible_to_institution),
+        ] if visible
+    }
+    for owner_id in owner_ids:
+        person_changed(owner_id)
+    for institution_id in institution_ids:
+        institution_changed(institution_id)
+
+
+@receiver(post_delete, sender=Quest)
+def quest_deleted(sender, instance, **kwargs):
+    person_changed(instance.owner_id)
+    if instance.visible_to_institution:
+        institution_changed(instance.institution_id)
+
+
+@receiver(post_save, sender=Person)
+def person_saved(sender, instance, **kwargs):
+    if instance.has_changed('institution_id'):
+        person_changed(instance.pk)
+
+
+@receiver(post_delete, sender=Person)
+def person_deleted(sender, instance, **kwargs):
+    person_changed(instance.pk)
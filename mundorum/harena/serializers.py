@@ -1,20 +1,117 @@
 from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+from .images import derivative_url
 from .models import Quest, QuestCase, Case
 
 
-class CaseSerializer(serializers.ModelSerializer):
+# Lets a serializer be restricted to some of its fields, chosen by the client
+# with ?fields=a,b or ?view=summary, and tells which model columns those fields
+# read, so views can fetch just them with .only() and never load the large ones.
+class SparseFieldsMixin:
+    summary_fields = None
+    # serializer field -> model columns it reads (defaults to the field name)
+    field_columns = {}
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, request):
+        """
+        Field names asked for in the query string, or None for all of them.
+        Unknown names are a ParseError (400).
+        """
+        fields = request.query_params.get('fields')
+        if fields:
+            names = fields.split(',')
+            unknown = [name for name in names if name not in cls.Meta.fields]
+            if unknown:
+                raise ParseError(f"Unknown fields: {', '.join(unknown)}")
+            return [name for name in cls.Meta.fields if name in names]
+        if is_summary(request):
+            return list(cls.summary_fields)
+        return None
+
+    @classmethod
+    def columns(cls, fields):
+        columns = []
+        for name in fields:
+            columns.extend(cls.field_columns.get(name, [name]))
+        return columns
+
+    @classmethod
+    def restrict(cls, queryset, fields, *required):
+        """
+        Loads only the columns behind `fields` (plus `required`), joining the
+        relations they go through.
+        """
+        columns = cls.columns(fields) + list(required)
+        relations = {column.rsplit('__', 1)[0] for column in columns if '__' in column}
+        return queryset.select_related(*relations).only(*columns)
+
+
+def is_summary(request):
+    return request.query_params.get('view') == 'summary'
+
+
+class CaseSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    images = serializers.SerializerMethodField()
+
+    summary_fields = ['id', 'name', 'complexity', 'specialty', 'created_at', 'case_owner', 'images']
+    field_columns = {
+        'images': ['image_derivatives'],
+    }
+
     class Meta:
         model = Case
         fields = [
-            'id', 'name', 'description', 'content', 'answer', 'answer_options',
-            'created_at', 'case_owner'
+            'id', 'name', 'description', 'content', 'answer', 'possible_answers',
+            'created_at', 'case_owner', 'complexity', 'specialty', 'images'
         ]
 
-class QuestSerializer(serializers.ModelSerializer):
+    # {size: {format: signed url}} of the resized copies; the original is not listed
+    def get_images(self, obj):
+        return {
+            size: {format_name: derivative_url(obj.pk, path) for format_name, path in formats.items()}
+            for size, formats in obj.image_derivatives.items()
+        }
+
+class CaseSearchSerializer(CaseSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.SerializerMethodField()
+
+    field_columns = {'images': ['image_derivatives'], 'rank': [], 'snippet': []}
+
+    class Meta(CaseSerializer.Meta):
+        fields = CaseSerializer.summary_fields + ['description', 'rank', 'snippet']
+
+    # the `snippets` context entry comes from Case.objects.headlines()
+    def get_snippet(self, obj):
+        return self.context.get('snippets', {}).get(obj.pk)
+
+# One NDJSON line of a case import (see harena/ndjson.py); the owner is the importer
+class CaseImportSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Case
+        fields = ['name', 'description', 'content', 'answer', 'possible_answers', 'complexity', 'specialty']
+
+class QuestSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     institution_name = serializers.CharField(source='institution.name', read_only=True)
     owner_name = serializers.CharField(source='owner.user.get_full_name', read_only=True)
     cases = serializers.SerializerMethodField()
 
+    summary_fields = ['id', 'name', 'institution', 'institution_name', 'owner', 'owner_name',
+                      'visible_to_institution', 'created_at', 'cases']
+    field_columns = {
+        'institution_name': ['institution__name'],
+        'owner_name': ['owner__user__first_name', 'owner__user__last_name'],
+        'cases': [],
+    }
+
     class Meta:
         model = Quest
         fields = [
@@ -29,8 +126,11 @@ class QuestSerializer(serializers.ModelSerializer):
             'cases' 
         ]
 
+    # expects quests from Quest.objects.with_cases(), so no query is issued here;
+    # the `case_fields` context entry restricts the nested cases
     def get_cases(self, obj):
         return CaseSerializer(
             [qc.case for qc in obj.quest_cases.all()],
-            many=True
+            many=True,
+            fields=self.context.get('case_fields'),
         ).data
@@ -0,0 +1,168 @@
+import functools
+import hashlib
+import heapq
+import json
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from rest_framework.authtoken.models import Token
+
+from .models import ProfessorInviteToken, QuestViewerInviteToken, SlowQuery
+
+
+logger = logging.getLogger(__name__)
+
+# Slow-query log. While a request runs, the metrics middleware keeps its
+# STATEMENTS slowest statements; if the whole request took longer than
+# SLOW_REQUEST_THRESHOLD seconds they are saved as SlowQuery rows, tagged with
+# the view and the user, and for SLOW_QUERY_EXPLAIN_RATE of those requests with
+# their plan (EXPLAIN (ANALYZE, BUFFERS) on PostgreSQL). Plans and inserts are
+# made by a thread of their own, after the response has gone. Parameters are
+# stored too, hashed in statements on the tables that hold credentials.
+EXPLAIN_RATE = getattr(settings, 'SLOW_QUERY_EXPLAIN_RATE', 0.1)
+LOG_SIZE = getattr(settings, 'SLOW_QUERY_LOG_SIZE', 1000)
+# statements kept per request
+STATEMENTS = getattr(settings, 'SLOW_QUERY_STATEMENTS', 5)
+# longest an EXPLAIN ANALYZE may run (seconds)
+EXPLAIN_TIMEOUT = getattr(settings, 'SLOW_QUERY_EXPLAIN_TIMEOUT', 10)
+# slow requests waiting to be logged; more are dropped rather than queued
+MAX_PENDING = 20
+# longest parameter value stored (characters)
+MAX_PARAM = 200
+# in statements on tables holding credentials, values longer than this are
+# stored as a hash: still comparable between entries, but no longer usable
+SECRET_PARAM = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def threshold():
+    # None turns the log off
+    return getattr(settings, 'SLOW_REQUEST_THRESHOLD', None)
+
+
+def keep(slowest, duration, seq, sql, params, many):
+    """
+    Adds a statement to the `slowest` heap of a request, which holds at most
+    STATEMENTS of them.
+    """
+    entry = (duration, seq, sql, params, many)
+    if len(slowest) < STATEMENTS:
+        heapq.heappush(slowest, entry)
+    elif duration > slowest[0][0]:
+        heapq.heapreplace(slowest, entry)
+
+
+@functools.cache
+def secret_tables():
+    # token keys, password hashes, session data and invite tokens
+    return tuple(f'"{model._meta.db_table}"'
+                 for model in (Token, User, Session, ProfessorInviteToken, QuestViewerInviteToken))
+
+
+def is_secret(sql):
+    return any(table in sql for table in secret_tables())
+
+
+def redact(value):
+    if isinstance(value, str) and len(value) > SECRET_PARAM:
+        return 'sha256:' + hashlib.sha256(value.encode()).hexdigest()[:16]
+    return value
+
+
+def storable(params, many, secret=False):
+    if many:
+        # executemany: the first rows are enough to tell what it was
+        return [storable(row, False, secret) for row in list(params)[:3]]
+    if params is None:
+        return []
+    if isinstance(params, dict):
+        params = list(params.values())
+    values = []
+    for value in json.loads(json.dumps(list(params), default=str)):
+        if secret:
+            value = redact(value)
+        elif isinstance(value, str) and len(value) > MAX_PARAM:
+            value = value[:MAX_PARAM] + '...'
+        values.append(value)
+    return values
+
+
+def explain(sql, params):
+    """
+    The plan of a read statement, run on this thread's connection. ANALYZE
+    executes the statement, so it runs in a transaction that is rolled back.
+    """
+    if sql.lstrip()[:6].upper() not in ('SELECT', 'WITH'):
+        return ''
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.vendor == 'postgresql':
+        statements = [f'SET LOCAL statement_timeout = {int(EXPLAIN_TIMEOUT * 1000)}',
+                      f'EXPLAIN (ANALYZE, BUFFERS) {sql}']
+    elif connection.vendor == 'sqlite':
+        statements = [f'EXPLAIN QUERY PLAN {sql}']
+    else:
+        return ''
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        try:
+            with connection.cursor() as cursor:
+                for statement in statements[:-1]:
+                    cursor.execute(statement)
+                cursor.execute(statements[-1], params)
+                rows = cursor.fetchall()
+        finally:
+            transaction.set_rollback(True, using=DEFAULT_DB_ALIAS)
+    # PostgreSQL gives a line per row, sqlite the detail column of each step
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+def record(view, method, user_id, request_duration, slowest, with_plans):
+    entries = []
+    for duration, _, sql, params, many in sorted(slowest, reverse=True):
+        plan = ''
+        if with_plans and not many:
+            try:
+                plan = explain(sql, params)
+            except Exception as e:
+                plan = f'EXPLAIN failed: {e}'
+        entries.append(SlowQuery(view=view, method=method, user_id=user_id, request_duration=request_duration,
+                                 duration=duration, sql=sql, params=storable(params, many, is_secret(sql)),
+                                 plan=plan))
+    SlowQuery.objects.bulk_create(entries)
+    trim()
+
+
+def trim():
+    # the ring buffer: ids only grow, so everything below the LOG_SIZE-th newest goes
+    oldest_kept = SlowQuery.objects.order_by('-pk').values_list('pk', flat=True)[LOG_SIZE - 1:LOG_SIZE]
+    if oldest_kept:
+        SlowQuery.objects.filter(pk__lt=oldest_kept[0]).delete()
+
+
+def _run(*args):
+    try:
+        record(*args)
+    except Exception:
+        logger.exception("Could not log the slow queries of %s", args[0])
+    finally:
+        _pending.release()
+        # the logging thread's connection is not closed by any request cycle
+        connections.close_all()
+
+
+def schedule(view, method, user_id, request_duration, slowest):
+    global _executor
+    if not slowest or not _pending.acquire(blocking=False):
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-queries')
+    _executor.submit(_run, view, method, user_id, request_duration, slowest, random.random() < EXPLAIN_RATE)
@@ -1,3 +1,1393 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F
+import base64
+import hashlib
+import io
+import os
+import json
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.contrib import admin
+from django.urls import resolve, reverse
+import rsa
+from google.auth import crypt, jwt
+from PIL import Image
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APIClient
+
+from mundorum.api import router
+
+from . import authentication, budgets, bus, caching, images, metrics, permissions, slowlog, uploads, urls
+from .domains import get_domain_resolver
+from .google_auth import GoogleTokenVerifier
+from .models import (Case, InvalidationEvent, Institution, InstitutionDomain, Person, ProfessorInviteToken, Quest, QuestCase,
+                     QuestMembership, QuestViewerInviteToken, SlowQuery)
+
+
+@override_settings(INVALIDATION_BUS=False, SLOW_REQUEST_THRESHOLD=None, ENFORCE_QUERY_BUDGETS=True)
+class HarenaTestCase(TestCase):
+
+    def setUp(self):
+        # the shared tier in files of its own, not a development server's
+        shared = tempfile.TemporaryDirectory()
+        self.addCleanup(shared.cleanup)
+        self.enterContext(override_settings(CACHES={**settings.CACHES, 'shared': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': shared.name}}))
+        # the process-wide caches outlive the rolled back test transactions
+        authentication.clear()
+        caching.clear()
+        permissions.clear()
+        self.institution = Institution.objects.create(name='Unicamp')
+        self.user = self.create_user('student')
+        self.professor = self.create_user('professor')
+
+    def create_user(self, username):
+        user = User.objects.create_user(username, email=f'{username}@unicamp.br')
+        user.person.institution = self.institution
+        user.person.save()
+        return user
+
+    def create_quest(self, owner, n_cases=0, **kwargs):
+        quest = Quest.objects.create(name='Quest', institution=self.institution, owner=owner.person, **kwargs)
+        for n in range(n_cases):
+            case = Case.objects.create(name=f'Case {n}', content='...', answer='a', case_owner=owner.person)
+            QuestCase.objects.create(quest=quest, case=case)
+        return quest
+
+    def get(self, user, url, status=200):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=user.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, status, response.content)
+        return response, len(queries)
+
+
+class QuestReadQueryCountTests(HarenaTestCase):
+
+    def test_quest_list_query_count_is_constant(self):
+        self.create_quest(self.professor, n_cases=1, visible_to_institution=True)
+        response, few = self.get(self.user, '/api/quests/')
+        self.assertEqual(len(response.data['results']), 1)
+
+        for _ in range(5):
+            self.create_quest(self.professor, n_cases=4, visible_to_institution=True)
+        shared = self.create_quest(self.professor, n_cases=3)
+        QuestMembership.objects.create(quest=shared, person=self.user.person)
+        permissions.clear()
+
+        response, many = self.get(self.user, '/api/quests/')
+        self.assertEqual(len(response.data['results']), 7)
+        self.assertEqual(sum(len(quest['cases']) for quest in response.data['results']), 24)
+        self.assertEqual(few, many)
+
+    def test_quest_cases_query_count_is_constant(self):
+        small = self.create_quest(self.professor, n_cases=1, visible_to_institution=True)
+        large = self.create_quest(self.professor, n_cases=20, visible_to_institution=True)
+
+        response, few = self.get(self.user, f'/api/quests/{small.id}/cases/')
+        self.assertEqual(len(response.data['results']), 1)
+        permissions.clear()
+        response, many = self.get(self.user, f'/api/quests/{large.id}/cases/')
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(response.data['results'][0]['name'], 'Case 0')
+        self.assertEqual(few, many)
+
+
+class QuestListETagTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the ETags are computed on every request, not replayed from cached responses
+        patcher = mock.patch.object(caching, 'get_response', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def etag(self, user):
+        response, _ = self.get(user, '/api/quests/')
+        return response['ETag']
+
+    def rename_case(self, quest):
+        case = quest.quest_cases.first().case
+        case.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            case.save()
+
+    def test_changes_to_visible_quests_move_the_etag(self):
+        shared = self.create_quest(self.professor, n_cases=1)
+        QuestMembership.objects.create(quest=shared, person=self.user.person)
+        public = self.create_quest(self.professor, n_cases=1, visible_to_institution=True)
+        before = self.etag(self.user)
+        self.assertEqual(before, self.etag(self.user))
+        for quest in (shared, public):
+            self.rename_case(quest)
+            after = self.etag(self.user)
+            self.assertNotEqual(before, after)
+            before = after
+
+    def test_swapping_one_visible_quest_for_another_moves_the_etag(self):
+        # same count, same max version: an aggregate over the quests could not tell
+        first = self.create_quest(self.professor)
+        second = self.create_quest(self.professor)
+        membership = QuestMembership.objects.create(quest=first, person=self.user.person)
+        before = self.etag(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            # no signals, so no list version moves: only the fingerprint tells
+            QuestMembership.objects.filter(pk=membership.pk).update(quest=second)
+            permissions.person_changed(self.user.pk)
+        self.assertNotEqual(before, self.etag(self.user))
+
+    def test_unrelated_quests_leave_the_etag_alone(self):
+        self.create_quest(self.professor, n_cases=1, visible_to_institution=True)
+        other = self.create_quest(self.professor, n_cases=1)
+        before = self.etag(self.user)
+        self.rename_case(other)
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=self.user.pk))
+        response = client.get('/api/quests/', HTTP_IF_NONE_MATCH=before)
+        self.assertEqual(response.status_code, 304)
+
+
+class QuestVisibilityQueryTests(HarenaTestCase):
+
+    def list_quests(self):
+        # cold caches: the caller's permissions, then the page and its cases
+        caching.clear()
+        permissions.clear()
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=self.user.pk))
+        with self.assertNumQueries(6), CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/quests/')
+        pages = [query['sql'] for query in queries
+                 if query['sql'].startswith('SELECT "harena_quest"."id", "harena_quest"."name"')]
+        self.assertEqual(len(pages), 1)
+        # owned, shared with the institution or through a membership, in the one query
+        self.assertIn('"harena_quest"."owner_id" =', pages[0])
+        self.assertIn('"harena_quest"."visible_to_institution"', pages[0])
+        self.assertIn('"harena_questmembership"', pages[0])
+        return response.data['results']
+
+    def add_quests(self, n):
+        other = Institution.objects.create(name=f'Other {Institution.objects.count()}')
+        stranger = self.create_user(f'stranger{other.pk}')
+        stranger.person.institution = other
+        stranger.person.save()
+        for _ in range(n):
+            self.create_quest(self.user, n_cases=1)
+            self.create_quest(self.professor, n_cases=2, visible_to_institution=True)
+            shared = Quest.objects.create(name='Shared', institution=other, owner=stranger.person)
+            QuestMembership.objects.create(quest=shared, person=self.user.person)
+            Quest.objects.create(name='Hidden', institution=other, owner=stranger.person, visible_to_institution=True)
+
+    def test_the_visibility_filter_is_one_query_at_any_size(self):
+        self.add_quests(1)
+        self.assertEqual(len(self.list_quests()), 3)
+        for _ in range(3):
+            self.add_quests(5)
+        self.assertEqual(len(self.list_quests()), 48)
+
+
+class SaveQueryCountTests(HarenaTestCase):
+    # what a save costs once committed, its receivers and on_commit work included
+
+    def setUp(self):
+        super().setUp()
+        self.create_quest(self.user)
+        self.institution = Institution.objects.get(pk=self.institution.pk)
+        self.user = User.objects.get(pk=self.user.pk)
+        self.quest = Quest.objects.get(owner=self.user.person)
+
+    def assertSaveQueries(self, count, save):
+        with self.assertNumQueries(count), self.captureOnCommitCallbacks(execute=True):
+            save()
+
+    def check_save_paths(self, events):
+        # rows that change nothing served cost their UPDATE alone
+        self.user.last_login = timezone.now()
+        self.assertSaveQueries(1, lambda: self.user.save(update_fields=['last_login']))
+        self.assertSaveQueries(1, self.user.save)
+        self.assertSaveQueries(1, self.institution.save)
+        # quests show their owner's name: the bump and its audience (the person
+        # loaded with the quest tells the institution's people list)
+        self.user.first_name = 'Ana'
+        self.assertSaveQueries(3 + events, self.user.save)
+        self.institution.active = False
+        self.assertSaveQueries(1 + events, self.institution.save)
+        # ... and their institution's name: the bump and its audience
+        self.institution.name = 'Unesp'
+        self.assertSaveQueries(3 + events, self.institution.save)
+        self.quest.name = 'Renamed'
+        self.assertSaveQueries(2 + events, self.quest.save)
+
+    def test_save_paths(self):
+        self.check_save_paths(events=0)
+
+    @override_settings(INVALIDATION_BUS=True)
+    def test_save_paths_send_their_events_in_one_insert(self):
+        self.check_save_paths(events=1)
+
+
+class TrackedFieldsTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quest = Quest.objects.get(pk=self.create_quest(self.professor).pk)
+
+    def test_plain_fields(self):
+        institution = Institution.objects.get(pk=self.institution.pk)
+        self.assertFalse(institution.has_changed('name', 'active'))
+        institution.name = 'Unesp'
+        self.assertTrue(institution.has_changed('name'))
+        self.assertFalse(institution.has_changed('active'))
+        self.assertEqual(institution.initial_value('name'), 'Unicamp')
+        institution.save()
+        self.assertFalse(institution.has_changed('name'))
+        self.assertEqual(institution.initial_value('name'), 'Unesp')
+
+    def test_foreign_key_ids(self):
+        for change in (lambda quest: setattr(quest, 'owner', self.user.person),
+                       lambda quest: setattr(quest, 'owner_id', self.user.pk)):
+            quest = Quest.objects.get(pk=self.quest.pk)
+            change(quest)
+            self.assertTrue(quest.has_changed('owner_id'))
+            self.assertEqual(quest.initial_value('owner_id'), self.professor.pk)
+        quest.owner_id = self.professor.pk
+        self.assertFalse(quest.has_changed('owner_id'))
+
+    def test_refresh_from_db(self):
+        institution = Institution.objects.get(pk=self.institution.pk)
+        Institution.objects.filter(pk=institution.pk).update(name='Unesp')
+        institution.active = False
+        institution.refresh_from_db(fields=['name'])
+        self.assertFalse(institution.has_changed('name'))
+        self.assertEqual(institution.initial_value('name'), 'Unesp')
+        # still unsaved
+        self.assertTrue(institution.has_changed('active'))
+        institution.refresh_from_db()
+        self.assertFalse(institution.has_changed('name', 'active'))
+
+    def test_save_with_update_fields_keeps_the_other_changes(self):
+        self.quest.visible_to_institution = True
+        self.quest.owner = self.user.person
+        self.quest.save(update_fields=['visible_to_institution'])
+        self.assertFalse(self.quest.has_changed('visible_to_institution'))
+        self.assertTrue(self.quest.has_changed('owner_id'))
+        self.assertEqual(self.quest.initial_value('owner_id'), self.professor.pk)
+        # named by field or by attname
+        self.quest.save(update_fields=['owner'])
+        self.assertFalse(self.quest.has_changed('owner_id'))
+
+    def test_deferred_fields_are_unchanged_without_a_query(self):
+        quest = Quest.objects.only('id', 'name').get(pk=self.quest.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(quest.has_changed('owner_id', 'institution_id', 'visible_to_institution'))
+            quest.visible_to_institution = True
+            self.assertTrue(quest.has_changed('visible_to_institution'))
+        # loading one deferred field takes it as the database's
+        with self.assertNumQueries(1):
+            self.assertEqual(quest.initial_value('owner_id'), self.professor.pk)
+        self.assertFalse(quest.has_changed('owner_id'))
+        self.assertTrue(quest.has_changed('visible_to_institution'))
+
+
+class SparseFieldsTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quest = self.create_quest(self.user, n_cases=2)
+        # the SQL of every request, not responses replayed from the cache
+        self.enterContext(mock.patch.object(caching, 'get_response', return_value=None))
+
+    def case_sql(self, url):
+        """
+        The response to `url` and the SQL of the queries that read harena_case.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response, _ = self.get(self.user, url)
+        return response, [query['sql'] for query in queries if '"harena_case"' in query['sql']]
+
+    def assertNotSelected(self, sql, *columns):
+        self.assertTrue(sql)
+        for statement in sql:
+            select = statement.split(' FROM ')[0]
+            for column in columns:
+                self.assertNotIn(f'"harena_case"."{column}"', select)
+
+    def test_summaries_do_not_read_case_texts(self):
+        for url in ('/api/quests/?view=summary', f'/api/quests/{self.quest.id}/cases/?view=summary'):
+            with self.subTest(url):
+                response, sql = self.case_sql(url)
+                self.assertNotSelected(sql, 'content', 'answer', 'description')
+                self.assertNotIn('answer', str(response.data))
+
+    def test_requested_fields_are_the_columns_read(self):
+        response, sql = self.case_sql(f'/api/quests/{self.quest.id}/cases/?fields=id,name')
+        self.assertNotSelected(sql, 'content', 'answer', 'specialty')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name'})
+        # the full cases do read them
+        _, sql = self.case_sql(f'/api/quests/{self.quest.id}/cases/')
+        self.assertIn('"harena_case"."answer"', sql[0].split(' FROM ')[0])
+
+    def test_unknown_fields_are_rejected(self):
+        for url in ('/api/quests/?fields=bogus', f'/api/quests/{self.quest.id}/cases/?fields=id,bogus'):
+            with self.subTest(url):
+                response, _ = self.get(self.user, url, status=400)
+                self.assertIn('bogus', str(response.data))
+
+
+class PaginationTests(HarenaTestCase):
+
+    def collect(self, user, url):
+        names = []
+        while url:
+            response, _ = self.get(user, url)
+            names += [row.get('name') or row.get('username') for row in response.data['results']]
+            url = response.data['next']
+        return names
+
+    def test_quest_cases_are_paged_in_the_order_they_were_added(self):
+        quest = self.create_quest(self.professor, n_cases=7, visible_to_institution=True)
+        names = self.collect(self.user, f'/api/quests/{quest.id}/cases/?page_size=3')
+        self.assertEqual(names, [f'Case {n}' for n in range(7)])
+
+    def test_people_and_users_are_paged_by_id(self):
+        for n in range(4):
+            self.create_user(f'student{n}')
+        expected = list(User.objects.order_by('id').values_list('username', flat=True))
+        self.assertEqual(self.collect(self.user, '/person/?page_size=2'), expected)
+        self.assertEqual(self.collect(self.user, '/users/?page_size=2'), expected)
+
+
+    def test_forged_cursors_are_not_found(self):
+        quest = self.create_quest(self.professor, n_cases=3, visible_to_institution=True)
+        self.professor.person.role = 'professor'
+        self.professor.person.save()
+        # url -> (user, values in a cursor)
+        routes = {
+            '/api/quests/': (self.user, 2),
+            f'/api/quests/{quest.id}/cases/': (self.user, 2),
+            '/api/cases/search/?q=case': (self.professor, 2),
+            '/api/cases/catalog/': (self.professor, 2),
+            '/person/': (self.user, 1),
+            '/users/': (self.user, 1),
+        }
+        for url, (user, size) in routes.items():
+            for value in ('x', None, {'a': 1}, [1], True, 2 ** 200):
+                cursor = base64.urlsafe_b64encode(json.dumps([value] * size).encode()).decode()
+                with self.subTest(url=url, value=value):
+                    separator = '&' if '?' in url else '?'
+                    response, _ = self.get(user, f'{url}{separator}cursor={cursor}', status=404)
+                    self.assertEqual(response.data['detail'], 'Invalid cursor')
+
+
+class InstitutionScopeTests(HarenaTestCase):
+
+    def test_people_and_users_are_limited_to_the_callers_institution(self):
+        other = Institution.objects.create(name='USP')
+        outsider = User.objects.create_user('outsider')
+        outsider.person.institution = other
+        outsider.person.save()
+
+        for url in ['/person/', '/users/']:
+            response, _ = self.get(self.user, url)
+            usernames = {row['username'] for row in response.data['results']}
+            self.assertEqual(usernames, {'student', 'professor'})
+        self.get(self.user, f'/person/{outsider.pk}/', status=404)
+
+        response, _ = self.get(self.user, '/person/?role=professor')
+        self.assertEqual(response.data['results'], [])
+
+        loner = User.objects.create_user('loner')
+        response, _ = self.get(loner, '/person/')
+        self.assertEqual(response.data['results'], [])
+
+
+class PermissionCacheTests(HarenaTestCase):
+
+    def test_a_load_racing_with_a_write_is_dropped_on_commit(self):
+        quest = self.create_quest(self.professor)
+        permissions.get_quest_permissions(self.user)
+        stale = permissions._person_cache[self.user.pk]
+        with self.captureOnCommitCallbacks(execute=True):
+            QuestMembership.objects.create(quest=quest, person=self.user.person)
+            self.assertNotIn(self.user.pk, permissions._person_cache)
+            # another request loads before the commit, still without the membership
+            permissions._person_cache[self.user.pk] = stale
+        self.assertTrue(permissions.user_can_view_quest(User.objects.get(pk=self.user.pk), quest))
+
+    def test_a_quest_update_tells_each_owner_and_institution_once(self):
+        quest = self.create_quest(self.professor)
+        quest.visible_to_institution = True
+        with mock.patch.object(permissions, 'person_changed') as person_changed, \
+                mock.patch.object(permissions, 'institution_changed') as institution_changed:
+            quest.save()
+        person_changed.assert_called_once_with(self.professor.pk)
+        institution_changed.assert_called_once_with(self.institution.pk)
+
+        other = Institution.objects.create(name='USP')
+        quest.institution = other
+        with mock.patch.object(permissions, 'person_changed') as person_changed, \
+                mock.patch.object(permissions, 'institution_changed') as institution_changed:
+            quest.save()
+        person_changed.assert_called_once_with(self.professor.pk)
+        self.assertCountEqual([args for args, _ in institution_changed.call_args_list],
+                              [(self.institution.pk,), (other.pk,)])
+
+
+class TokenCacheTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.key = Token.objects.create(user=self.user).key
+        self.auth = authentication.CachedTokenAuthentication()
+
+    def test_a_cached_token_costs_no_query(self):
+        with self.assertNumQueries(1):
+            user, _ = self.auth.authenticate_credentials(self.key)
+        with self.assertNumQueries(0):
+            again, _ = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(again.person.institution, self.institution)
+        # copies, so what a request sets on its user stays in that request
+        self.assertIsNot(user, again)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.auth.authenticate_credentials('unknown')
+
+    def test_a_deactivated_user_is_refused_at_once(self):
+        self.auth.authenticate_credentials(self.key)
+        stale = authentication._tokens[self.key]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+            self.assertNotIn(self.key, authentication._tokens)
+            # another request loads before the commit, still active
+            authentication._tokens[self.key] = stale
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.auth.authenticate_credentials(self.key)
+
+    def test_a_load_racing_with_a_write_is_not_cached(self):
+        select_related = Token.objects.select_related
+
+        def racing(*fields):
+            # the user changes while the token is being loaded
+            authentication.invalidate_user(self.user.pk)
+            return select_related(*fields)
+        with mock.patch.object(Token.objects, 'select_related', racing):
+            self.auth.authenticate_credentials(self.key)
+        self.assertNotIn(self.key, authentication._tokens)
+
+    def test_institution_changes_reach_cached_tokens(self):
+        self.auth.authenticate_credentials(self.key)
+        self.institution.name = 'Universidade Estadual de Campinas'
+        self.institution.save()
+        user, _ = self.auth.authenticate_credentials(self.key)
+        self.assertEqual(user.person.institution.name, 'Universidade Estadual de Campinas')
+
+    @override_settings(TOKEN_LIFETIME=60)
+    def test_expired_tokens_are_rejected_and_deleted(self):
+        self.auth.authenticate_credentials(self.key)
+        Token.objects.filter(key=self.key).update(created=timezone.now() - timedelta(minutes=2))
+        authentication.clear()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.auth.authenticate_credentials(self.key)
+        self.assertFalse(Token.objects.filter(key=self.key).exists())
+
+
+class DomainResolverTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resolver = get_domain_resolver()
+        self.resolver.clear()
+        self.addCleanup(self.resolver.clear)
+        self.computing = Institution.objects.create(name='IC Unicamp')
+        self.domain = InstitutionDomain.objects.create(name='unicamp.br', institution=self.institution)
+        InstitutionDomain.objects.create(name='ic.unicamp.br', institution=self.computing)
+
+    def resolved(self, email):
+        institution = self.resolver.resolve(email)
+        return institution and institution.name
+
+    def test_the_longest_registered_suffix_wins(self):
+        self.assertEqual(self.resolved('student@unicamp.br'), 'Unicamp')
+        self.assertEqual(self.resolved('student@dac.unicamp.br'), 'Unicamp')
+        self.assertEqual(self.resolved('student@ic.unicamp.br'), 'IC Unicamp')
+        self.assertEqual(self.resolved('student@lab.ic.unicamp.br'), 'IC Unicamp')
+        self.assertEqual(self.resolved('Student@IC.Unicamp.BR.'), 'IC Unicamp')
+        self.assertIsNone(self.resolved('student@unicamp.br.example.com'))
+        self.assertIsNone(self.resolved('student@br'))
+        self.assertIsNone(self.resolved('student@usp.br'))
+
+    def test_writes_reach_a_loaded_trie(self):
+        self.resolved('student@unicamp.br')
+        with self.captureOnCommitCallbacks(execute=True):
+            InstitutionDomain.objects.filter(name='ic.unicamp.br').delete()
+        self.assertEqual(self.resolved('student@lab.ic.unicamp.br'), 'Unicamp')
+        # the emptied branch is pruned
+        self.assertNotIn('ic', self.resolver._root['br']['unicamp'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.domain.name = 'unicamp.edu.br'
+            self.domain.save()
+        self.assertIsNone(self.resolved('student@unicamp.br'))
+        self.assertEqual(self.resolved('student@unicamp.edu.br'), 'Unicamp')
+
+    def test_inactive_institutions_resolve_but_cannot_sign_in(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.institution.active = False
+            self.institution.save()
+        self.assertFalse(self.resolver.resolve('student@unicamp.br').active)
+
+        verifier = mock.Mock()
+        verifier.verify.return_value = {'sub': '1234567890', 'email': 'new@unicamp.br'}
+        with mock.patch('harena.views.get_google_verifier', return_value=verifier):
+            response = APIClient().post('/auth/google/', {'token': 'google'}, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['error'], 'This institution is currently inactive.')
+
+
+class GoogleTokenVerifierTests(TestCase):
+    """
+    Tokens signed with local keys, whose certificates a stub session serves in
+    place of Google's.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.keys = {kid: rsa.newkeys(1024) for kid in ('old', 'new', 'forged')}
+
+    def setUp(self):
+        self.served = ['old']
+        self.session = mock.Mock()
+        self.session.get.side_effect = lambda url, timeout: mock.Mock(
+            status_code=200, headers={'Cache-Control': 'public, max-age=3600'},
+            json=lambda: {kid: self.keys[kid][0].save_pkcs1().decode() for kid in self.served})
+        self.verifier = GoogleTokenVerifier('client', 'https://certs.test/', session=self.session)
+
+    def sign(self, kid='old', **claims):
+        now = int(time.time())
+        payload = {'iss': 'https://accounts.google.com', 'aud': 'client', 'sub': '42',
+                   'email': 'student@unicamp.br', 'iat': now, 'exp': now + 3600, **claims}
+        signer = crypt.RSASigner.from_string(self.keys[kid][1].save_pkcs1(), key_id=kid)
+        return jwt.encode(signer, payload).decode()
+
+    def test_valid_tokens_are_verified_once(self):
+        token = self.sign()
+        self.assertEqual(self.verifier.verify(token)['sub'], '42')
+        self.assertEqual(self.verifier.verify(token)['sub'], '42')
+        self.verifier.verify(self.sign(sub='43'))
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_expired_tokens_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'expired'):
+            self.verifier.verify(self.sign(iat=int(time.time()) - 7200, exp=int(time.time()) - 3600))
+
+    def test_tokens_for_another_audience_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'audience'):
+            self.verifier.verify(self.sign(aud='someone-else'))
+
+    def test_tokens_from_other_issuers_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'issuer'):
+            self.verifier.verify(self.sign(iss='https://evil.test'))
+
+    def test_unknown_key_ids_refetch_the_certificates_at_most_once_a_while(self):
+        self.verifier.verify(self.sign())
+        # Google rotated its keys a moment ago, too soon to ask again
+        self.served = ['old', 'new']
+        token = self.sign('new')
+        with self.assertRaisesRegex(ValueError, 'key id'):
+            self.verifier.verify(token)
+        self.assertEqual(self.session.get.call_count, 1)
+
+        later = time.monotonic() + self.verifier.min_refresh_interval
+        with mock.patch('time.monotonic', return_value=later):
+            self.assertEqual(self.verifier.verify(token)['sub'], '42')
+            self.assertEqual(self.session.get.call_count, 2)
+            # a forged key id right after is not worth another fetch
+            with self.assertRaisesRegex(ValueError, 'key id'):
+                self.verifier.verify(self.sign('forged'))
+            self.assertEqual(self.session.get.call_count, 2)
+
+
+class ResponseCacheTests(HarenaTestCase):
+
+    def test_case_writes_reach_cached_quest_pages(self):
+        quest = self.create_quest(self.professor, n_cases=2, visible_to_institution=True)
+        case = quest.quest_cases.first().case
+        for url in ('/api/quests/', f'/api/quests/{quest.id}/cases/'):
+            self.get(self.user, url)
+            _, cached = self.get(self.user, url)
+            self.assertEqual(cached, 0)
+        case.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            case.save()
+        response, _ = self.get(self.user, '/api/quests/')
+        self.assertIn('Renamed', str(response.data))
+        response, _ = self.get(self.user, f'/api/quests/{quest.id}/cases/')
+        self.assertIn('Renamed', str(response.data))
+
+    def test_tag_times_expire(self):
+        caching.tag_times(['quest:1'], 0)
+        self.assertIsNotNone(caching.shared_cache().get('tag:quest:1'))
+        with mock.patch('time.time', return_value=time.time() + caching.TAG_LIFETIME + 1):
+            self.assertIsNone(caching.shared_cache().get('tag:quest:1'))
+        self.assertGreater(caching.TAG_LIFETIME, caching.SHARED_TIMEOUT)
+
+    def test_workers_share_entries_and_tag_times(self):
+        # two processes: each its own local tier and its own handle on the shared files
+        location = settings.CACHES['shared']['LOCATION']
+        workers = [(LocMemCache(f'worker-{n}', {}), FileBasedCache(location, {})) for n in range(2)]
+
+        def as_worker(n):
+            local, shared = workers[n]
+            return mock.patch.multiple(caching, local_cache=lambda: local, shared_cache=lambda: shared)
+
+        with as_worker(0):
+            caching.set_response('page', 'payload', ['quest:1'], time.time())
+        with as_worker(1):
+            self.assertEqual(caching.get_response('page'), 'payload')
+            with self.captureOnCommitCallbacks(execute=True):
+                caching.invalidate_tags('quest:1')
+            self.assertIsNone(caching.get_response('page'))
+        with as_worker(0):
+            # once its local copy of the tag time expires
+            with mock.patch('time.time', return_value=time.time() + caching.TAG_TIMEOUT + 1):
+                self.assertIsNone(caching.get_response('page'))
+
+
+class CaseSearchTests(HarenaTestCase):
+
+    def test_search_only_returns_cases_the_user_can_see(self):
+        visible = self.create_quest(self.professor, visible_to_institution=True)
+        hidden = self.create_quest(self.professor)
+        for quest, name in [(visible, 'Pneumonia'), (hidden, 'Pneumonia grave'), (visible, 'Fratura')]:
+            case = Case.objects.create(name=name, content='...', answer='a', case_owner=self.professor.person)
+            QuestCase.objects.create(quest=quest, case=case)
+        Case.objects.create(name='Minha pneumonia', content='...', answer='a', case_owner=self.user.person)
+
+        response, _ = self.get(self.user, '/api/cases/search/?q=pneumonia')
+        names = {case['name'] for case in response.data['results']}
+        self.assertEqual(names, {'Pneumonia', 'Minha pneumonia'})
+        self.assertNotIn('answer', response.data['results'][0])
+
+        self.get(self.user, '/api/cases/search/', status=400)
+
+    def test_admin_search_finds_answers(self):
+        case = Case.objects.create(name='Asma', content='...', answer='broncoespasmo', case_owner=self.user.person)
+        Case.objects.create(name='Gota', content='...', answer='a', case_owner=self.user.person)
+        model_admin = admin.site._registry[Case]
+        for term in ('asma', 'broncoespasmo'):
+            with self.subTest(term):
+                results, _ = model_admin.get_search_results(None, Case.objects.all(), term)
+                self.assertEqual(list(results), [case])
+
+    @skipUnless(connection.vendor == 'postgresql', 'full-text search runs on PostgreSQL only')
+    def test_full_text_search_stems_ranks_and_follows_writes(self):
+        by_name = Case.objects.create(name='Fratura de fêmur', content='Queda da própria altura.', answer='a',
+                                      case_owner=self.user.person)
+        by_content = Case.objects.create(name='Trauma', content='Paciente com fraturas múltiplas.', answer='a',
+                                         case_owner=self.user.person)
+        Case.objects.create(name='Asma', content='Chiado e dispneia.', answer='a', case_owner=self.user.person)
+
+        # "fraturas" and "fratura" share their stem; the name weighs more than the content
+        response, _ = self.get(self.user, '/api/cases/search/?q=fraturas')
+        results = response.data['results']
+        self.assertEqual([case['id'] for case in results], [str(by_name.id), str(by_content.id)])
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+        self.assertIn('<mark>', results[1]['snippet'])
+
+        # the trigger refills the vector on save
+        by_content.content = 'Paciente com luxação.'
+        by_content.save()
+        self.assertEqual(list(Case.objects.search('fratura')), [by_name])
+        self.assertEqual(list(Case.objects.search('luxação')), [by_content])
+
+
+class ProfessorTestCase(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.professor.person.role = 'professor'
+        self.professor.person.save()
+
+
+class CaseCatalogTests(ProfessorTestCase):
+
+    def create_case(self, owner, complexity, specialty):
+        return Case.objects.create(name=specialty, content='...', answer='a', case_owner=owner.person,
+                                   complexity=complexity, specialty=specialty)
+
+    def test_facets_count_the_other_filters(self):
+        self.create_case(self.professor, 'graduate', 'Cardiologia')
+        self.create_case(self.professor, 'graduate', 'Neurologia')
+        self.create_case(self.user, 'undergraduate', 'Cardiologia')
+        outsider = User.objects.create_user('outsider')
+        self.create_case(outsider, 'graduate', 'Cardiologia')
+
+        response, _ = self.get(self.professor, '/api/cases/catalog/?complexity=graduate')
+        self.assertEqual(len(response.data['results']), 2)
+        facets = response.data['facets']
+        self.assertEqual(facets['complexity'], [{'value': 'graduate', 'count': 2},
+                                                {'value': 'undergraduate', 'count': 1}])
+        self.assertEqual(facets['specialty'], [{'value': 'Cardiologia', 'count': 1},
+                                               {'value': 'Neurologia', 'count': 1}])
+        self.assertEqual(facets['institution'], [{'value': self.institution.pk, 'count': 2, 'name': 'Unicamp'}])
+
+    def test_id_filters_must_be_ids(self):
+        self.create_case(self.professor, 'graduate', 'Cardiologia')
+        response, _ = self.get(self.professor, f'/api/cases/catalog/?owner={self.professor.pk}')
+        self.assertEqual(len(response.data['results']), 1)
+        for value in ('abc', '²', '١', '-1', '0', '9' * 30, '1' * 5000):
+            for name in ('institution', 'owner'):
+                with self.subTest(name=name, value=value):
+                    self.get(self.professor, f'/api/cases/catalog/?{name}={value}', status=400)
+
+    def test_facets_are_cached_until_a_case_is_written(self):
+        self.create_case(self.professor, 'graduate', 'Cardiologia')
+        url = '/api/cases/catalog/'
+        _, uncached = self.get(self.professor, url)
+        response, cached = self.get(self.professor, url)
+        self.assertLess(cached, uncached)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_case(self.professor, 'graduate', 'Cardiologia')
+        response, _ = self.get(self.professor, url)
+        self.assertEqual(response.data['facets']['specialty'], [{'value': 'Cardiologia', 'count': 2}])
+
+    def test_facets_are_dropped_only_for_the_catalogs_a_write_reaches(self):
+        other = Institution.objects.create(name='USP')
+        outsider = self.create_user('outsider')
+        outsider.person.institution = other
+        outsider.person.role = 'professor'
+        outsider.person.save()
+        case = self.create_case(self.professor, 'graduate', 'Cardiologia')
+        self.create_case(outsider, 'graduate', 'Neurologia')
+        url = '/api/cases/catalog/'
+        self.get(self.professor, url)
+        _, cached = self.get(self.professor, url)
+        self.get(outsider, url)
+
+        # a case written at USP leaves Unicamp's facets cached
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_case(outsider, 'graduate', 'Neurologia')
+        self.assertEqual(self.get(self.professor, url)[1], cached)
+        response, _ = self.get(outsider, url)
+        self.assertEqual(response.data['facets']['specialty'], [{'value': 'Neurologia', 'count': 2}])
+
+        # a quest shared with USP takes a Unicamp case to USP's catalog
+        quest = Quest.objects.create(name='Quest', institution=other, owner=outsider.person,
+                                     visible_to_institution=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            QuestCase.objects.create(quest=quest, case=case)
+        response, _ = self.get(outsider, url)
+        self.assertEqual(response.data['facets']['specialty'], [{'value': 'Neurologia', 'count': 2},
+                                                                {'value': 'Cardiologia', 'count': 1}])
+        # and editing it there reaches both catalogs
+        case.specialty = 'Pediatria'
+        with self.captureOnCommitCallbacks(execute=True):
+            case.save()
+        for user in (self.professor, outsider):
+            response, _ = self.get(user, url)
+            self.assertIn({'value': 'Pediatria', 'count': 1}, response.data['facets']['specialty'])
+
+    def test_students_cannot_browse_the_catalog(self):
+        self.get(self.user, '/api/cases/catalog/', status=403)
+
+
+class QuestCasesBatchTests(ProfessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quest = self.create_quest(self.professor, n_cases=3)
+        self.cases = [quest_case.case for quest_case in self.quest.quest_cases.order_by('added_at', 'id')]
+        self.others = [Case.objects.create(name=f'Other {n}', content='...', answer='a',
+                                           case_owner=self.professor.person) for n in range(2)]
+        self.url = f'/api/quests/{self.quest.id}/cases/batch/'
+
+    def post(self, user, data):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=user.pk))
+        return client.post(self.url, data, format='json')
+
+    def in_quest(self):
+        return set(self.quest.quest_cases.values_list('case_id', flat=True))
+
+    def test_adds_and_removes_in_one_request(self):
+        missing = uuid.uuid4()
+        version = self.quest.version
+        response = self.post(self.professor, {
+            'add': [str(case.id) for case in self.others] + [str(self.cases[0].id), str(missing), 'nope'],
+            'remove': [str(self.cases[1].id), str(self.others[0].id) + 'x'],
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['add'], {
+            str(self.others[0].id): 'added', str(self.others[1].id): 'added',
+            str(self.cases[0].id): 'already_in_quest', str(missing): 'not_found', 'nope': 'invalid',
+        })
+        self.assertEqual(response.data['remove'], {str(self.cases[1].id): 'removed',
+                                                   str(self.others[0].id) + 'x': 'invalid'})
+        self.assertEqual(self.in_quest(), {self.cases[0].id, self.cases[2].id, *(case.id for case in self.others)})
+        self.quest.refresh_from_db()
+        self.assertGreater(self.quest.version, version)
+
+        response = self.post(self.professor, {'remove': [str(self.cases[1].id)]})
+        self.assertEqual(response.data['remove'], {str(self.cases[1].id): 'not_in_quest'})
+
+    def test_only_editors_may_change_the_cases(self):
+        self.quest.visible_to_institution = True
+        self.quest.save()
+        response = self.post(self.user, {'remove': [str(self.cases[0].id)]})
+        self.assertEqual(response.status_code, 403)
+        QuestMembership.objects.create(quest=self.quest, person=self.user.person, role='author')
+        self.assertEqual(self.post(self.user, {'remove': [str(self.cases[0].id)]}).status_code, 200)
+        self.assertNotIn(self.cases[0].id, self.in_quest())
+
+    def test_rejects_malformed_and_oversized_batches(self):
+        before = self.in_quest()
+        for data in ({}, [str(self.others[0].id)], 'add', None, {'add': str(self.others[0].id)},
+                     {'add': [str(self.cases[0].id)], 'remove': [str(self.cases[0].id)]}):
+            with self.subTest(data):
+                self.assertEqual(self.post(self.professor, data).status_code, 400)
+        with mock.patch('harena.views.QuestCasesBatchView.max_batch_size', 2):
+            response = self.post(self.professor, {'add': [str(case.id) for case in self.others],
+                                                  'remove': [str(self.cases[0].id)]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'At most 2 case IDs per request')
+        self.assertEqual(self.in_quest(), before)
+
+
+class CaseTransferTests(ProfessorTestCase):
+
+    def test_import_reports_invalid_lines_and_export_streams_the_library(self):
+        lines = [
+            {'name': 'Asma', 'content': '...', 'answer': 'a', 'complexity': 'graduate'},
+            {'name': 'Sem resposta', 'content': '...'},
+            {'name': 'Gota', 'content': '...', 'answer': 'b', 'specialty': 'Reumatologia'},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines) + '\n{not json\n'
+        client = APIClient()
+        client.force_authenticate(self.professor)
+        response = client.post('/api/cases/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 2))
+        self.assertEqual([error['line'] for error in response.data['errors']], [2, 4])
+        self.assertIn('answer', response.data['errors'][0]['errors'])
+
+        response = client.get('/api/cases/export/')
+        exported = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual({case['name'] for case in exported}, {'Asma', 'Gota'})
+        self.assertEqual(exported[0]['case_owner'], self.professor.pk)
+
+
+class CaseImageTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name,
+                                            IMAGE_UPLOAD_DIR=os.path.join(media_root.name, 'uploads')))
+
+    def test_derivatives_are_resized_stripped_and_cached_forever(self):
+        exif = Image.Exif()
+        exif[0x010E] = 'x' * 60000  # ImageDescription
+        upload = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(upload, 'JPEG', exif=exif)
+        case = Case.objects.create(name='Raio-X', content='...', answer='a', case_owner=self.professor.person,
+                                   image=SimpleUploadedFile('scan.jpg', upload.getvalue()))
+
+        images.build_derivatives(case.pk)
+        case.refresh_from_db()
+        self.assertEqual(set(case.image_derivatives), {'thumb', 'medium'})
+        with default_storage.open(case.image_derivatives['thumb']['jpeg']) as file:
+            thumb = Image.open(file)
+            self.assertEqual(thumb.size, (320, 160))
+            self.assertFalse(thumb.getexif())
+
+        response, _ = self.get(self.professor, '/api/cases/search/?q=raio')
+        url = response.data['results'][0]['images']['thumb']['webp']
+        # signed, so an <img> tag loads it without the token
+        response = APIClient().get(url)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+
+    def test_derivatives_are_served_to_who_can_see_the_case(self):
+        case = Case.objects.create(name='Raio-X', content='...', answer='a', case_owner=self.professor.person)
+        derivative = default_storage.save(f'{images.DERIVED_DIR}/0123456789-thumb.webp', io.BytesIO(b'webp'))
+        Case.objects.filter(pk=case.pk).update(image_derivatives={'thumb': {'webp': derivative}})
+        signed = images.derivative_url(case.pk, derivative)
+        unsigned = signed.split('?')[0]
+
+        self.assertEqual(APIClient().get(unsigned).status_code, 401)
+        # the student sees no quest with the case: neither its files nor others' under its ID
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get(unsigned).status_code, 404)
+        other = Case.objects.create(name='Outro', content='...', answer='a', case_owner=self.user.person)
+        self.assertEqual(client.get(unsigned.replace(str(case.pk), str(other.pk))).status_code, 404)
+        self.assertEqual(APIClient().get(signed.replace(str(case.pk), str(other.pk))).status_code, 401)
+        # ... until a quest they can view has it
+        QuestCase.objects.create(quest=self.create_quest(self.professor, visible_to_institution=True), case=case)
+        self.assertEqual(client.get(unsigned).status_code, 200)
+
+        with mock.patch('time.time', return_value=time.time() + 2 * images.URL_LIFETIME + 1):
+            self.assertEqual(APIClient().get(signed).status_code, 401)
+
+    def test_16_bit_scans_are_scaled_to_8_bits(self):
+        for mode in ('I;16', 'I;16B'):
+            with self.subTest(mode):
+                scan = Image.new(mode, (4, 1))
+                scan.putdata([1000, 2000, 3000, 4000])
+                image = images.to_displayable(scan)
+                self.assertEqual(image.mode, 'L')
+                self.assertEqual(list(image.getdata()), [0, 85, 170, 255])
+
+    def test_a_file_replaced_in_place_counts_as_changed(self):
+        case = Case.objects.create(name='Raio-X', content='...', answer='a', case_owner=self.professor.person,
+                                   image=SimpleUploadedFile('scan.png', b'png'))
+        # once saved, the instance holds the FieldFile that FieldFile.save renames
+        for case in (case, Case.objects.get(pk=case.pk)):
+            first = case.image.name
+            self.assertFalse(case.has_changed('image'))
+            case.image.save('rescan.png', SimpleUploadedFile('rescan.png', b'png'), save=False)
+            self.assertTrue(case.has_changed('image'))
+            self.assertEqual(case.initial_value('image'), first)
+            case.save(update_fields=['image'])
+            self.assertFalse(case.has_changed('image'))
+
+    def test_chunked_upload_resumes_and_attaches_the_image(self):
+        upload = io.BytesIO()
+        Image.new('RGB', (64, 64), 'blue').save(upload, 'PNG')
+        data = upload.getvalue()
+        case = Case.objects.create(name='Raio-X', content='...', answer='a', case_owner=self.professor.person)
+        client = APIClient()
+        client.force_authenticate(self.professor)
+
+        response = client.post(f'/api/cases/{case.id}/image/uploads/', {
+            'filename': 'scan.png', 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(),
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        url = f'/api/uploads/{response.data["id"]}/'
+
+        half = len(data) // 2
+        response = client.put(url, data[:half], content_type='application/octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(response.data['offset'], half)
+        # a retried chunk is refused with the offset to resume from
+        response = client.put(url, data[:half], content_type='application/octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual((response.status_code, response.data['offset']), (409, half))
+        response = client.put(url, data[half:], content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(half))
+        self.assertTrue(response.data['completed'], response.data)
+
+        case.refresh_from_db()
+        with case.image.open('rb') as file:
+            self.assertEqual(file.read(), data)
+
+    def test_upload_with_a_wrong_checksum_starts_over(self):
+        case = Case.objects.create(name='Raio-X', content='...', answer='a', case_owner=self.professor.person)
+        upload = uploads.start_upload(case, self.professor.person, 'scan.png', 4, '0' * 64)
+        client = APIClient()
+        client.force_authenticate(self.professor)
+        response = client.put(f'/api/uploads/{upload.id}/', b'abcd', content_type='application/octet-stream',
+                              HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual((response.status_code, response.data['offset']), (422, 0))
+        self.assertFalse(Case.objects.get(pk=case.pk).image)
+
+
+class MetricsTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(METRICS_DIR=directory.name))
+        self.directory = directory.name
+
+    def test_metrics_add_up_every_worker(self):
+        quest = self.create_quest(self.professor, n_cases=3, visible_to_institution=True)
+        response, nqueries = self.get(self.user, f'/api/quests/{quest.id}/cases/')
+        self.get(self.user, '/person/')
+        # another worker's file, as it flushed it
+        other = {metrics.REQUESTS.name: [[['quest-cases', 'GET', '200'], 2]],
+                 metrics.QUERIES.name: [[['quest-cases'], [0] * 5 + [2] + [0] * 5 + [16]]]}
+        with open(os.path.join(self.directory, '1.json'), 'w') as file:
+            json.dump(other, file)
+
+        self.get(self.user, '/metrics', status=403)
+        self.user.is_staff = True
+        self.user.save()
+        response, _ = self.get(self.user, '/metrics')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode().splitlines()
+        self.assertIn('harena_requests_total{view="quest-cases",method="GET",status="200"} 3', lines)
+        self.assertIn('harena_requests_total{view="metrics",method="GET",status="403"} 1', lines)
+        self.assertIn(f'harena_db_queries_per_request_sum{{view="quest-cases"}} {16 + nqueries}', lines)
+        self.assertIn('harena_db_queries_per_request_count{view="quest-cases"} 3', lines)
+        self.assertIn('harena_request_duration_seconds_count{view="quest-cases",method="GET"} 1', lines)
+        for view in ('quest-cases', 'harena-list'):
+            serializer_time = next(line for line in lines
+                                   if line.startswith(f'harena_serializer_seconds_total{{view="{view}"}}'))
+            self.assertGreater(float(serializer_time.split()[-1]), 0)
+        # timed by the views, DRF's serializers are left as they are
+        self.assertEqual(BaseSerializer.data.fget.__module__, 'rest_framework.serializers')
+
+
+@override_settings(SLOW_REQUEST_THRESHOLD=0)
+class SlowQueryLogTests(HarenaTestCase):
+
+    def test_slow_requests_log_their_slowest_queries_with_plans(self):
+        quest = self.create_quest(self.professor, n_cases=3, visible_to_institution=True)
+        # logged right away, and always with plans
+        log = lambda *args: slowlog.record(*args, True)
+        with mock.patch.object(slowlog, 'schedule', log), mock.patch.object(slowlog, 'LOG_SIZE', 7):
+            self.get(self.user, f'/api/quests/{quest.id}/cases/')
+            self.get(self.user, '/api/quests/')
+
+        entries = list(SlowQuery.objects.order_by('pk'))
+        # the oldest entries made room for the newest ones
+        self.assertEqual(len(entries), 7)
+        self.assertEqual((entries[0].view, entries[-1].view), ('quest-cases', 'quest-list'))
+        self.assertEqual({entry.user_id for entry in entries}, {self.user.pk})
+        select = next(entry for entry in entries if entry.sql.startswith('SELECT'))
+        self.assertTrue(select.plan)
+        self.assertFalse(select.plan.startswith('EXPLAIN failed'), select.plan)
+        self.assertEqual(len(select.params), select.sql.count('%s'))
+
+    def test_credentials_are_not_stored(self):
+        quest = self.create_quest(self.professor, n_cases=1, visible_to_institution=True)
+        key = Token.objects.create(user=self.user).key
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        log = lambda *args: slowlog.record(*args, False)
+        with mock.patch.object(slowlog, 'schedule', log):
+            self.assertEqual(client.get(f'/api/quests/{quest.id}/cases/').status_code, 200)
+
+        lookup = SlowQuery.objects.get(sql__contains='"authtoken_token"')
+        self.assertNotIn(key, json.dumps(lookup.params))
+        self.assertEqual(lookup.params, [slowlog.redact(key)])
+        # other statements keep their values
+        stored = json.dumps([entry.params for entry in SlowQuery.objects.exclude(pk=lookup.pk)])
+        self.assertTrue(quest.id.hex in stored or str(quest.id) in stored)
+
+
+class QueryBudgetTests(ProfessorTestCase):
+    """
+    Runs every route of harena/urls.py and every harena changelist against
+    quests full of cases, with the query budgets enforced, so a view whose
+    queries grow with the data fails here.
+    """
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name,
+                                            IMAGE_UPLOAD_DIR=os.path.join(media_root.name, 'uploads')))
+        self.quests = [self.create_quest(self.professor, n_cases=10, visible_to_institution=True) for _ in range(3)]
+        self.cases = list(Case.objects.filter(quest_cases__quest=self.quests[0]))
+        for n in range(5):
+            student = self.create_user(f'student{n}')
+            QuestMembership.objects.create(quest=self.quests[0], person=student.person)
+            token = ProfessorInviteToken.objects.create(institution=self.institution,
+                                                        expires_at=timezone.now() + timedelta(days=1))
+            token.used_by.add(student.person)
+        # with max_uses, the longest way through use-quest-token
+        self.viewer_token = QuestViewerInviteToken.objects.create(quest=self.quests[1], max_uses=10,
+                                                                  expires_at=timezone.now() + timedelta(days=1))
+        self.upload = uploads.start_upload(self.cases[0], self.professor.person, 'scan.png', 4, '0' * 64)
+        self.staff = self.create_user('staff')
+        self.staff.is_staff = True
+        self.staff.save()
+        # a new professor signing in with an invite, the longest way through google-auth
+        self.invite = ProfessorInviteToken.objects.create(institution=self.institution,
+                                                          expires_at=timezone.now() + timedelta(days=1))
+        verifier = mock.Mock()
+        verifier.verify.return_value = {'sub': '1234567890', 'email': 'new@unicamp.br', 'given_name': 'New'}
+        self.enterContext(mock.patch('harena.views.get_google_verifier', return_value=verifier))
+
+    def route_requests(self):
+        """
+        route name -> (user, method, URL kwargs, body) of a request to run.
+        """
+        quest, case = self.quests[0], self.cases[0]
+        other, another = [Case.objects.create(name=name, content='...', answer='a', case_owner=self.professor.person)
+                          for name in ('Other', 'Another')]
+        derivative = default_storage.save(f'{images.DERIVED_DIR}/0123456789-thumb.webp', io.BytesIO(b'webp'))
+        Case.objects.filter(pk=case.pk).update(image_derivatives={'thumb': {'webp': derivative}})
+        return {
+            'google-auth': (None, 'post', {}, {'token': 'google', 'invite_token': str(self.invite.token)}),
+            'user': (self.user, 'get', {}, None),
+            'quest-list': (self.user, 'get', {}, None),
+            'use-quest-token': (self.user, 'post', {}, {'token': str(self.viewer_token.token)}),
+            'quest-cases': (self.user, 'get', {'quest_id': quest.id}, None),
+            'quest-cases-batch': (self.professor, 'post', {'quest_id': quest.id},
+                                  {'add': [str(other.id)], 'remove': [str(c.id) for c in self.cases[1:4]]}),
+            'case-search': (self.professor, 'get', {}, {'q': 'case'}),
+            'case-catalog': (self.professor, 'get', {}, None),
+            'case-import': (self.professor, 'post', {}, None),
+            'case-export': (self.professor, 'get', {}, None),
+            'case-image-uploads': (self.professor, 'post', {'case_id': case.id},
+                                   {'filename': 'scan.png', 'size': 4, 'sha256': '0' * 64}),
+            'image-upload': (self.professor, 'get', {'upload_id': self.upload.id}, None),
+            'case-image-derivative': (self.user, 'get', {'case_id': case.id, 'name': derivative.rsplit('/', 1)[-1]},
+                                      None),
+            'metrics': (self.staff, 'get', {}, None),
+            'add-case-to-quest': (self.professor, 'post', {'quest_id': quest.id}, {'case_id': str(another.id)}),
+            'remove-case-from-quest': (self.professor, 'post', {'quest_id': quest.id, 'case_id': case.id}, None),
+            'user-list': (self.user, 'get', {}, None),
+            'user-detail': (self.user, 'get', {'pk': self.professor.pk}, None),
+            'harena-list': (self.user, 'get', {}, None),
+            'harena-detail': (self.user, 'get', {'pk': self.professor.pk}, None),
+        }
+
+    def route_names(self):
+        # harena/urls.py and the API router, whose root only lists links and
+        # whose format suffix routes repeat the names
+        names = [pattern.name for pattern in urls.urlpatterns]
+        for pattern in router.urls:
+            if pattern.name not in names and pattern.name != 'api-root':
+                names.append(pattern.name)
+        return names
+
+    def test_every_route_keeps_its_budget(self):
+        requests = self.route_requests()
+        for name in self.route_names():
+            with self.subTest(name):
+                self.assertIn(name, requests, 'a new route needs a request here')
+                user, method, kwargs, data = requests[name]
+                url = reverse(name, kwargs=kwargs)
+                self.assertIsNotNone(budgets.budget_for(resolve(url), method), 'a new route needs a query_budget')
+                # cold caches, the most a request can cost
+                bus.reset()
+                caching.clear()
+                client = APIClient()
+                if user is not None:
+                    # a real token, so its lookup counts against the budget
+                    client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.get_or_create(user=user)[0].key}')
+                if name == 'case-import':
+                    body = '\n'.join(json.dumps({'name': f'Imported {n}', 'content': '...', 'answer': 'a'})
+                                     for n in range(20))
+                    response = client.post(url, body, content_type='application/x-ndjson')
+                else:
+                    response = getattr(client, method)(url, data, format='json' if method != 'get' else None)
+                self.assertLess(response.status_code, 400, getattr(response, 'data', None))
+
+    def test_every_changelist_keeps_its_budget(self):
+        superuser = User.objects.create_superuser('admin', 'admin@unicamp.br', 'x')
+        self.client.force_login(superuser)
+        for model, model_admin in admin.site._registry.items():
+            if model._meta.app_label != 'harena':
+                continue
+            with self.subTest(model.__name__):
+                self.assertIsNotNone(getattr(model_admin, 'changelist_query_budget', None),
+                                     'a new admin needs a changelist_query_budget')
+                url = reverse(f'admin:harena_{model._meta.model_name}_changelist')
+                bus.reset()
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class QuestGroupMigrationTests(TransactionTestCase):
+    before = [('harena', '0008_questmembership')]
+    after = [('harena', '0009_migrate_quest_groups_to_memberships')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def setUp(self):
+        # back to the latest schema for the tests that follow
+        self.addCleanup(lambda: self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes()))
+        apps = self.migrate(self.before)
+        User, Group = apps.get_model('auth', 'User'), apps.get_model('auth', 'Group')
+        Person, Quest = apps.get_model('harena', 'Person'), apps.get_model('harena', 'Quest')
+        institution = apps.get_model('harena', 'Institution').objects.create(name='Unicamp')
+        self.viewer, self.author, self.owner = [
+            Person.objects.create(user=User.objects.create(username=name), institution=institution)
+            for name in ('viewer', 'author', 'owner')
+        ]
+        self.quest = Quest.objects.create(name='Quest', institution=institution, owner=self.owner)
+        groups = {name: Group.objects.create(name=name) for name in (
+            f'viewers_{self.quest.id}', f'authors_{self.quest.id}', f'viewers_{uuid.uuid4()}', 'viewers_team')}
+        groups[f'viewers_{self.quest.id}'].user_set.add(self.viewer.pk, self.author.pk)
+        groups[f'authors_{self.quest.id}'].user_set.add(self.author.pk)
+        groups['viewers_team'].user_set.add(self.viewer.pk)
+
+    def memberships(self, apps):
+        return set(apps.get_model('harena', 'QuestMembership').objects.values_list('quest_id', 'person_id', 'role'))
+
+    def groups(self, apps):
+        return {group.name: set(group.user_set.values_list('id', flat=True))
+                for group in apps.get_model('auth', 'Group').objects.all()}
+
+    def test_quest_groups_become_memberships_and_back(self):
+        apps = self.migrate(self.after)
+        self.assertEqual(self.memberships(apps), {(self.quest.id, self.viewer.pk, 'viewer'),
+                                                  (self.quest.id, self.author.pk, 'author')})
+        # the groups of quests are gone, those of missing quests too; others stay
+        self.assertEqual(self.groups(apps), {'viewers_team': {self.viewer.pk}})
+
+        apps = self.migrate(self.before)
+        self.assertEqual(self.groups(apps), {
+            f'viewers_{self.quest.id}': {self.viewer.pk, self.author.pk},
+            f'authors_{self.quest.id}': {self.author.pk},
+            'viewers_team': {self.viewer.pk},
+        })
+
+
+@override_settings(INVALIDATION_BUS=False)
+class SeedTests(TestCase):
+
+    def test_seed_builds_a_consistent_dataset(self):
+        call_command('seed_harena', institutions=5, people=200, quests=30, cases=100, stdout=io.StringIO())
+        self.assertEqual(Person.objects.filter(user__username__startswith='seed-').count(), 200)
+        self.assertEqual(Quest.objects.count(), 30)
+        for institution in Institution.objects.filter(name__startswith='Seed Institution'):
+            self.assertTrue(institution.people.filter(role='professor').exists())
+        # every quest has its owner as an author and belongs to the owner's institution
+        self.assertEqual(QuestMembership.objects.filter(role='author').count(), 30)
+        self.assertFalse(Quest.objects.exclude(institution=F('owner__institution')).exists())
+        self.assertTrue(QuestCase.objects.exists())
+        with self.assertRaises(CommandError):
+            call_command('seed_harena', institutions=1, people=2, stdout=io.StringIO())
+
+
+
+class QuestInviteRedemptionTests(HarenaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quest = self.create_quest(self.professor)
+        self.invite = QuestViewerInviteToken.objects.create(quest=self.quest, max_uses=2,
+                                                            expires_at=timezone.now() + timedelta(days=1))
+
+    def redeem(self, user, token=None):
+        client = APIClient()
+        key = Token.objects.get_or_create(user=user)[0].key
+        client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        return client.post(reverse('use-quest-token'), {'token': self.invite.token if token is None else token},
+                           format='json')
+
+    def test_redeeming_twice_is_one_use(self):
+        self.assertFalse(permissions.user_can_view_quest(self.user, self.quest))
+        self.assertEqual(self.redeem(self.user).status_code, 200)
+        self.assertEqual(self.redeem(self.user).status_code, 200)
+        self.invite.refresh_from_db()
+        self.assertEqual(self.invite.uses, 1)
+        self.assertEqual(self.invite.redemptions.get().person_id, self.user.pk)
+        self.assertEqual(QuestMembership.objects.get(quest=self.quest, person=self.user.person).role, 'viewer')
+        # the cached permissions learnt about the membership
+        self.assertTrue(permissions.user_can_view_quest(User.objects.get(pk=self.user.pk), self.quest))
+
+    def test_no_redemption_past_max_uses(self):
+        self.assertEqual(self.redeem(self.user).status_code, 200)
+        self.assertEqual(self.redeem(self.create_user('second')).status_code, 200)
+        third = self.create_user('third')
+        response = self.redeem(third)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Token esgotado')
+        self.assertFalse(QuestMembership.objects.filter(person=third.person).exists())
+        self.assertEqual(self.invite.redemptions.count(), 2)
+        # the author who redeems their own token stays an author
+        self.invite.max_uses = None
+        self.invite.save()
+        self.assertEqual(self.redeem(self.professor).status_code, 200)
+        self.assertEqual(QuestMembership.objects.get(quest=self.quest, person=self.professor.person).role, 'author')
+
+    def test_redeeming_again_restores_a_removed_membership(self):
+        self.assertEqual(self.redeem(self.user).status_code, 200)
+        QuestMembership.objects.filter(quest=self.quest, person=self.user.person).delete()
+        self.assertEqual(self.redeem(self.user).status_code, 200)
+        self.assertEqual(QuestMembership.objects.get(quest=self.quest, person=self.user.person).role, 'viewer')
+        self.invite.refresh_from_db()
+        self.assertEqual(self.invite.uses, 1)
+
+    def test_a_limit_set_later_counts_earlier_redemptions(self):
+        self.invite.max_uses = None
+        self.invite.save()
+        self.redeem(self.user)
+        self.redeem(self.create_user('second'))
+        self.invite.refresh_from_db()
+        self.assertEqual(self.invite.uses, 0)
+        self.invite.max_uses = 3
+        self.invite.save()
+        self.invite.refresh_from_db()
+        self.assertEqual(self.invite.uses, 2)
+        self.assertEqual(self.redeem(self.create_user('third')).status_code, 200)
+        self.assertEqual(self.redeem(self.create_user('fourth')).status_code, 400)
+
+    def test_expired_and_unknown_tokens(self):
+        self.invite.expires_at = timezone.now() - timedelta(minutes=1)
+        self.invite.save()
+        self.assertEqual(self.redeem(self.user).status_code, 400)
+        self.assertEqual(self.redeem(self.user, token=uuid.uuid4()).status_code, 404)
+        for token in ('not-a-uuid', 12, -1, ['a']):
+            with self.subTest(token=token):
+                self.assertEqual(self.redeem(self.user, token=token).status_code, 404)
+        self.assertFalse(self.invite.redemptions.exists())
+
+# Enabled per test rather than for the class: setUp's events would wait for a
+# commit the test case never makes, and take in the events of the test.
+class InvalidationBusTests(HarenaTestCase):
+
+    @override_settings(INVALIDATION_BUS=True)
+    def test_events_from_other_workers_are_applied(self):
+        listener = bus.PollingListener()
+        permissions.get_quest_permissions(self.user)
+        self.assertIn(self.user.pk, permissions._person_cache)
+
+        InvalidationEvent.objects.create(sender='other-worker', sent_at=time.time(),
+                                         name='permissions.person', args=[self.user.pk])
+        listener.poll()
+        self.assertNotIn(self.user.pk, permissions._person_cache)
+
+    @override_settings(INVALIDATION_BUS=True)
+    def test_own_events_are_published_but_not_applied_twice(self):
+        listener = bus.PollingListener()
+        with self.captureOnCommitCallbacks(execute=True):
+            quest = self.create_quest(self.professor)
+            QuestMembership.objects.create(quest=quest, person=self.user.person)
+        event = InvalidationEvent.objects.filter(name='permissions.person').latest('pk')
+        self.assertEqual(event.args, [self.user.pk])
+        self.assertEqual(event.sender, bus.sender_id())
+
+        received = bus.metrics.snapshot()['received']
+        listener.poll()
+        self.assertEqual(bus.metrics.snapshot()['received'], received)
+        self.assertEqual(listener.last_id, InvalidationEvent.objects.latest('pk').pk)
+
+    @override_settings(INVALIDATION_BUS=True)
+    def test_events_are_sent_together_on_commit(self):
+        sent = InvalidationEvent.objects.count()
+        # the savepoint, its release and a single INSERT
+        with self.assertNumQueries(3), self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                bus.publish('permissions.person', self.user.pk)
+                bus.publish('permissions.person', self.user.pk)
+                bus.publish('permissions.institution', self.institution.pk)
+        self.assertEqual(InvalidationEvent.objects.count(), sent + 2)
+
+    @override_settings(INVALIDATION_BUS=True)
+    def test_rolled_back_events_are_not_sent(self):
+        sent = InvalidationEvent.objects.count()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                bus.publish('permissions.person', self.user.pk)
+                transaction.set_rollback(True)
+        self.assertEqual(InvalidationEvent.objects.count(), sent)
@@ -0,0 +1,166 @@
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.http import UnreadablePostError
+from django.utils import timezone
+from PIL import Image
+
+from .models import Case, ImageUpload
+
+
+# Resumable case image uploads. A client declares the file (name, size,
+# SHA-256), then sends it in PUTs that each say at which offset their bytes
+# start; the bytes go straight from the request stream to a file on disk, and a
+# dropped connection only costs the chunk in flight: the client asks for the
+# offset and goes on from there. The last byte verifies the checksum and moves
+# the file into Case.image.
+MAX_SIZE = getattr(settings, 'IMAGE_UPLOAD_MAX_SIZE', 512 * 1024 * 1024)
+# bytes per PUT, so a slow client holds a worker for one chunk at a time
+MAX_CHUNK = getattr(settings, 'IMAGE_UPLOAD_MAX_CHUNK', 16 * 1024 * 1024)
+# uploads in progress per person
+MAX_ACTIVE = getattr(settings, 'IMAGE_UPLOAD_MAX_ACTIVE', 3)
+# chunks being received at once by this process
+MAX_WRITERS = getattr(settings, 'IMAGE_UPLOAD_MAX_WRITERS', 4)
+# seconds an upload may sit idle before it is dropped
+EXPIRY = getattr(settings, 'IMAGE_UPLOAD_EXPIRY', 24 * 60 * 60)
+READ_SIZE = 64 * 1024
+EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff', '.bmp', '.gif'}
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+_writers = threading.BoundedSemaphore(MAX_WRITERS)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+def part_path(upload_id):
+    return Path(settings.IMAGE_UPLOAD_DIR) / f'{upload_id}.part'
+
+
+# Hands the finished file to FileSystemStorage as a temporary file, so it is
+# moved into place instead of copied.
+class PartFile(File):
+    def temporary_file_path(self):
+        return self.name
+
+
+def start_upload(case, owner, filename, size, sha256):
+    filename = os.path.basename(str(filename or ''))
+    if os.path.splitext(filename)[1].lower() not in EXTENSIONS:
+        raise UploadError('The file must be an image', 400)
+    if not isinstance(size, int) or not 0 < size <= MAX_SIZE:
+        raise UploadError(f'The size must be between 1 and {MAX_SIZE} bytes', 400)
+    sha256 = str(sha256 or '').lower()
+    if not SHA256_RE.match(sha256):
+        raise UploadError('The sha256 must be a hex SHA-256 digest', 400)
+
+    active = ImageUpload.objects.filter(owner=owner, completed_at__isnull=True)
+    for stale in active.filter(updated_at__lt=timezone.now() - timedelta(seconds=EXPIRY)):
+        stale.delete()
+    if active.count() >= MAX_ACTIVE:
+        raise UploadError(f'You already have {MAX_ACTIVE} uploads in progress', 429)
+
+    upload = ImageUpload.objects.create(case=case, owner=owner, filename=filename, size=size, sha256=sha256)
+    path = part_path(upload.id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Appends `length` bytes of `stream` at `offset`, which must be where the
+    upload stands. Whatever arrives before the client goes away is kept.
+    Completes the upload with its last byte.
+    """
+    if upload.completed_at is not None:
+        raise UploadError('This upload is already complete', 409, offset=upload.offset)
+    if offset != upload.offset:
+        raise UploadError('The upload is at another offset', 409, offset=upload.offset)
+    if length > MAX_CHUNK:
+        raise UploadError(f'Chunks are at most {MAX_CHUNK} bytes', 413)
+    if offset + length > upload.size:
+        raise UploadError('The chunk goes past the declared size', 400, offset=upload.offset)
+
+    if not _writers.acquire(blocking=False):
+        raise UploadError('Too many uploads at once, retry shortly', 503, retry_after=5)
+    try:
+        with open(part_path(upload.id), 'r+b') as file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Another chunk of this upload is being written', 409, offset=upload.offset)
+            # a chunk that finished before we got the lock moved the offset
+            upload.refresh_from_db(fields=['offset', 'completed_at'])
+            if offset != upload.offset or upload.completed_at is not None:
+                raise UploadError('The upload is at another offset', 409, offset=upload.offset)
+
+            file.seek(offset)
+            file.truncate()
+            received = 0
+            try:
+                while received < length:
+                    data = stream.read(min(READ_SIZE, length - received))
+                    if not data:
+                        break
+                    file.write(data)
+                    received += len(data)
+            except (OSError, UnreadablePostError):
+                pass
+            finally:
+                file.flush()
+                os.fsync(file.fileno())
+                upload.offset = offset + received
+                upload.save(update_fields=['offset', 'updated_at'])
+
+            if upload.offset == upload.size:
+                finish_upload(upload)
+    finally:
+        _writers.release()
+    return upload
+
+
+def finish_upload(upload):
+    path = part_path(upload.id)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for data in iter(lambda: file.read(READ_SIZE), b''):
+            digest.update(data)
+    if digest.hexdigest() != upload.sha256:
+        # start over: there is no telling which chunk was corrupted
+        path.write_bytes(b'')
+        upload.offset = 0
+        upload.save(update_fields=['offset', 'updated_at'])
+        raise UploadError('The file does not match its SHA-256, upload it again', 422, offset=0)
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except Exception:
+        upload.delete()
+        raise UploadError('The file is not an image', 422)
+
+    case = Case.objects.get(pk=upload.case_id)
+    with open(path, 'rb') as file:
+        case.image.save(upload.filename, PartFile(file, name=str(path)), save=False)
+    case.save(update_fields=['image'])
+    upload.completed_at = timezone.now()
+    upload.save(update_fields=['completed_at', 'updated_at'])
+
+
+@receiver(post_delete, sender=ImageUpload)
+def upload_deleted(sender, instance, **kwargs):
+    part_path(instance.id).unlink(missing_ok=True)
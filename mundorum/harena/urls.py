@@ -1,11 +1,21 @@
 from django.urls import path
-from .views import GoogleAuthView, UserView, UseQuestViewerTokenView, QuestCasesView, AddCaseToQuestView, RemoveCaseFromQuestView
+from .views import GoogleAuthView, UserView, QuestListView, UseQuestViewerTokenView, QuestCasesView, QuestCasesBatchView, CaseSearchView, CaseCatalogView, CaseImportView, CaseExportView, CaseImageUploadsView, CaseImageDerivativeView, ImageUploadView, MetricsView, AddCaseToQuestView, RemoveCaseFromQuestView
 
 urlpatterns = [
     path('auth/google/', GoogleAuthView.as_view(), name='google-auth'),
     path('user/', UserView.as_view(), name='user'),
+    path('api/quests/', QuestListView.as_view(), name='quest-list'),
     path('api/use-quest-token/', UseQuestViewerTokenView.as_view(), name='use-quest-token'),
     path('api/quests/<uuid:quest_id>/cases/', QuestCasesView.as_view(), name='quest-cases'),
+    path('api/quests/<uuid:quest_id>/cases/batch/', QuestCasesBatchView.as_view(), name='quest-cases-batch'),
+    path('api/cases/search/', CaseSearchView.as_view(), name='case-search'),
+    path('api/cases/catalog/', CaseCatalogView.as_view(), name='case-catalog'),
+    path('api/cases/import/', CaseImportView.as_view(), name='case-import'),
+    path('api/cases/export/', CaseExportView.as_view(), name='case-export'),
+    path('api/cases/<uuid:case_id>/image/uploads/', CaseImageUploadsView.as_view(), name='case-image-uploads'),
+    path('api/uploads/<uuid:upload_id>/', ImageUploadView.as_view(), name='image-upload'),
+    path('media/case_images/derived/<uuid:case_id>/<str:name>', CaseImageDerivativeView.as_view(), name='case-image-derivative'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('api/quests/<uuid:quest_id>/cases/add/', AddCaseToQuestView.as_view(), name='add-case-to-quest'),
     path('api/quests/<uuid:quest_id>/cases/<uuid:case_id>/remove/', RemoveCaseFromQuestView.as_view(), name='remove-case-from-quest'),
 ]
@@ -0,0 +1,131 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import caching
+from .models import Case, Institution, Quest, QuestCase, QuestMembership, user_has_changed
+from .permissions import get_quest_permissions
+
+
+# Keeps Quest.version moving whenever something a quest read endpoint serves
+# changes, so ETags can be computed from the quest rows alone. Quest.save bumps
+# its own version; the receivers below cover the related rows.
+#
+# Quest lists have a version per person and per institution instead, kept as
+# response cache tag times (see harena.caching): a change to a quest moves the
+# versions of its owner, its members and, if it is visible to its institution,
+# the institution's. Which quests a list holds is told by the caller's
+# permission fingerprint.
+_deferred = threading.local()
+
+
+def quest_list_version(user):
+    """
+    What a quest list ETag is made of: changes whenever a quest the user can
+    view changes or the set of those quests does.
+    """
+    permissions = get_quest_permissions(user)
+    tags = [f'quest-list:person:{user.pk}']
+    if permissions.institution_id is not None:
+        tags.append(f'quest-list:institution:{permissions.institution_id}')
+    times = caching.tag_times(tags, time.time())
+    return permissions.fingerprint, [times[tag] for tag in tags]
+
+
+def bump_quest_lists(quests):
+    # one query for everyone whose quest list shows `quests`
+    tags = set()
+    for institution_id, visible, owner_id, member_id in quests.values_list(
+            'institution_id', 'visible_to_institution', 'owner_id', 'memberships__person_id'):
+        if visible:
+            tags.add(f'quest-list:institution:{institution_id}')
+        tags.add(f'quest-list:person:{owner_id}')
+        if member_id is not None:
+            tags.add(f'quest-list:person:{member_id}')
+    if tags:
+        caching.invalidate_tags(*tags)
+
+
+def bump(quests):
+    # no quest, nobody to tell
+    if quests.bump_version():
+        bump_quest_lists(quests)
+
+
+@contextmanager
+def deferred_version_bumps():
+    """
+    Collects the bumps made inside the block and applies them in one UPDATE at
+    the end, for bulk writes that would otherwise bump once per row.
+    """
+    if getattr(_deferred, 'quest_ids', None) is not None:
+        yield
+        return
+    _deferred.quest_ids = set()
+    try:
+        yield
+        quest_ids = _deferred.quest_ids
+    finally:
+        _deferred.quest_ids = None
+    if quest_ids:
+        bump(Quest.objects.filter(pk__in=quest_ids))
+
+
+def bump_quests(*quest_ids):
+    deferred = getattr(_deferred, 'quest_ids', None)
+    if deferred is not None:
+        deferred.update(quest_ids)
+    else:
+        bump(Quest.objects.filter(pk__in=quest_ids))
+
+
+def deleting_quest(origin):
+    # rows cascading from a deleted quest need no bump
+    model = getattr(origin, 'model', type(origin))
+    return model is Quest
+
+
+@receiver(post_save, sender=Quest)
+def quest_saved(sender, instance, created, **kwargs):
+    # Quest.save bumped its own version; a new quest, or one moved or hidden,
+    # changes permission fingerprints instead
+    if not created:
+        bump_quest_lists(Quest.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=QuestCase)
+@receiver(post_save, sender=QuestMembership)
+def quest_row_saved(sender, instance, **kwargs):
+    bump_quests(instance.quest_id)
+
+
+@receiver(post_delete, sender=QuestCase)
+@receiver(post_delete, sender=QuestMembership)
+def quest_row_deleted(sender, instance, origin=None, **kwargs):
+    if not deleting_quest(origin):
+        bump_quests(instance.quest_id)
+
+
+@receiver(post_save, sender=Case)
+def case_saved(sender, instance, created, **kwargs):
+    if not created:
+        bump(Quest.objects.filter(quest_cases__case=instance))
+
+
+@receiver(post_save, sender=Institution)
+def institution_saved(sender, instance, created, **kwargs):
+    # quests are served with their institution's name
+    if not created and instance.has_changed('name'):
+        bump(Quest.objects.filter(institution=instance))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    # ... and their owner's name
+    if created or not user_has_changed(instance, 'first_name', 'last_name'):
+        return
+    bump(Quest.objects.filter(owner_id=instance.pk))
@@ -1,34 +1,46 @@
-from django.conf import settings
 from rest_framework import status
+from rest_framework.exceptions import NotAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import AllowAny
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser
 from django.contrib.auth.models import User
-from google.oauth2 import id_token
-from google.auth.transport import requests
-from .models import Person, InstitutionDomain, ProfessorInviteToken, Quest, QuestViewerInviteToken, Case, QuestCase
-from django.db.models import Q
-from django.contrib.auth.models import Group
-from .serializers import QuestSerializer,CaseSerializer
+from .models import (Institution, Person, ProfessorInviteToken, Quest, QuestViewerInviteToken, QuestInviteRedemption,
+                     QuestMembership, Case, QuestCase, ImageUpload)
+import hashlib
+import uuid
+from django.db import IntegrityError, connection, transaction
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.db.models import Count, Exists, F, OuterRef, Q
+from .serializers import QuestSerializer,CaseSerializer, CaseSearchSerializer, is_summary
+from . import images, metrics, uploads
+from .authentication import CachedTokenAuthentication
+from .budgets import UNLIMITED
+from .caching import cached_response, catalog_tags, get_or_build, invalidate_tags
+from .domains import get_domain_resolver
+from .etags import make_etag, not_modified
+from .google_auth import get_google_verifier
+from .ndjson import export_cases, import_cases
+from .pagination import CaseSearchPagination, KeysetPagination, QuestCasePagination
+from .permissions import get_quest_permissions, person_changed, user_can_view_quest, user_can_edit_quest
+from .versions import bump_quests, deferred_version_bumps, quest_list_version
 
 
 class GoogleAuthView(APIView):
     permission_classes = [AllowAny]
+    query_budget = 15
 
     @staticmethod
     def get_institution_from_email(email):
         """
-        Extracts the institution from the email domain.
+        Extracts the institution from the email domain (or a parent domain),
+        served from the in-memory domain resolver.
         """
-        domain = email.split('@')[-1]
-        try:
-            institution_domain = InstitutionDomain.objects.get(name=domain)
-            return institution_domain.institution
-        except InstitutionDomain.DoesNotExist:
-            return None
+        return get_domain_resolver().resolve(email)
 
     @staticmethod
     def check_institution_valid(institution):
@@ -50,11 +62,7 @@ class GoogleAuthView(APIView):
 
         try:
             # Verify Google token
-            idinfo = id_token.verify_oauth2_token(
-                google_token,
-                requests.Request(),
-                settings.GOOGLE_CLIENT_ID
-            )
+            idinfo = get_google_verifier().verify(google_token)
 
             google_id = idinfo['sub']
             email = idinfo['email']
@@ -90,9 +98,10 @@ class GoogleAuthView(APIView):
                     if not token.is_valid():
                         return Response({'error': 'Expired Token'}, status=400)
 
-                    self.check_institution_valid(token.institution)
+                    institution = get_domain_resolver().institution(token.institution_id)
+                    self.check_institution_valid(institution)
 
-                    person.institution = token.institution
+                    person.institution_id = institution.id
                     person.role = 'professor'
                     person.save()
 
@@ -112,7 +121,7 @@ class GoogleAuthView(APIView):
                 except Exception as e:
                     return Response({'error': str(e)}, status=403)
 
-                person.institution = institution
+                person.institution_id = institution.id
                 person.role = 'student'
                 person.save()
 
@@ -126,7 +135,7 @@ class GoogleAuthView(APIView):
                     'email': user.email,
                     'name': f"{user.first_name} {user.last_name}".strip(),
                     'picture': person.profile_picture,
-                    'institution': user.person.institution.name if user.person.institution else None
+                    'institution': institution.name
                 }
             })
 
@@ -137,8 +146,9 @@ class GoogleAuthView(APIView):
 
 
 class UserView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = 1
 
     queryset = Person.objects.all()
 
@@ -155,46 +165,59 @@ class UserView(APIView):
             'picture': user.person.profile_picture if hasattr(user, 'person') else None
         })
 
-# Helper function to check if a user can view a quest
-def user_can_view_quest(user, quest):
-    person = user.person
-    group_names = user.groups.values_list('name', flat=True)
-    return (
-        quest.owner == person or
-        (quest.visible_to_institution and quest.institution == person.institution) or
-        f"viewers_{quest.id}" in group_names or
-        f"authors_{quest.id}" in group_names
-    )
-
-# Helper function to check if a user can edit a quest
-def user_can_edit_quest(user, quest):
-    person = user.person
-    group_names = user.groups.values_list('name', flat=True)
-    return (
-        quest.owner == person or
-        f"authors_{quest.id}" in group_names
-    )
-
-#Lists all quests that the user can view, either by being the owner, part of the institution, or via group membership.
-class QuestListView(APIView):
-    authentication_classes = [TokenAuthentication]
+def quest_cache_tags(quests):
+    # only what was loaded can have been served
+    tags = set()
+    for quest in quests:
+        tags.add(f'quest:{quest.pk}')
+        if 'institution_id' in vars(quest):
+            tags.add(f'institution:{quest.institution_id}')
+        if 'owner_id' in vars(quest):
+            tags.add(f'person:{quest.owner_id}')
+    # its cases are covered by the quest tags (see caching.case_changed)
+    return tags
+
+#Lists all quests that the user can view, either by being the owner, part of the institution, or via quest membership.
+class QuestListView(metrics.SerializerTimingMixin, APIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = 8
 
-    def get(self, request):
-        user = request.user
-        quests = Quest.objects.all()
+    pagination_class = KeysetPagination
 
-        # Filter quests based on user permissions
-        visible_quests = [quest for quest in quests if user_can_view_quest(user, quest)]
-
-        serializer = QuestSerializer(visible_quests, many=True)
-        return Response(serializer.data)
+    @cached_response
+    def get(self, request):
+        fields = QuestSerializer.requested_fields(request)
+        case_fields = CaseSerializer.summary_fields if is_summary(request) else None
+
+        # Visibility is resolved by the database; only the requested page is loaded
+        quests = Quest.objects.visible_to(request.user)
+
+        etag = make_etag('quest-list', quest_list_version(request.user),
+                         request.get_full_path(), request.accepted_media_type)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        if fields is None or 'cases' in fields:
+            quests = quests.with_cases(CaseSerializer.columns(case_fields) if case_fields else None)
+        if fields is not None:
+            quests = QuestSerializer.restrict(quests, fields, 'created_at')
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(quests, request, view=self)
+        serializer = QuestSerializer(page, many=True, fields=fields, context={'case_fields': case_fields})
+        response = paginator.get_paginated_response(self.serialize(serializer))
+        response['ETag'] = etag
+        response.cache_tags = quest_cache_tags(page)
+        return response
    
     
 # Allows a user to use a token to gain access to view a quest.
 class UseQuestViewerTokenView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = 8
 
     def post(self, request):
         token_value = request.data.get('token')
@@ -203,28 +226,56 @@ class UseQuestViewerTokenView(APIView):
             return Response({'error': 'Token não enviado'}, status=400)
 
         try:
-            token_obj = QuestViewerInviteToken.objects.get(token=token_value)
-
-            if not token_obj.is_valid():
-                return Response({'error': 'Token expirado'}, status=400)
-
-            person = request.user.person
-            quest = token_obj.quest
-
-            group = Group.objects.get(name=f"viewers_{quest.id}")
-            group.user_set.add(person.user)
-
+            token_obj = QuestViewerInviteToken.objects.select_related('quest').get(token=token_value)
+        except (QuestViewerInviteToken.DoesNotExist, ValidationError):
+            # ValidationError: not a UUID
+            return Response({'error': 'Token inválido'}, status=404)
+
+        if not token_obj.is_valid():
+            return Response({'error': 'Token expirado'}, status=400)
+
+        person = request.user.person
+        quest = token_obj.quest
+
+        # A whole class redeems the same token at once, so redeeming takes no
+        # lock before its writes and none is read back: the redemption's unique
+        # constraint makes it idempotent and the use is taken last, so the token
+        # row stays locked (when it has max_uses) only until the commit.
+        used = True
+        viewer = QuestMembership(quest=quest, person=person, role='viewer')
+        try:
+            with transaction.atomic():
+                QuestInviteRedemption.objects.create(token=token_obj, person=person)
+                # existing authors keep their role
+                QuestMembership.objects.bulk_create([viewer], ignore_conflicts=True)
+                used = token_obj.use()
+                if not used:
+                    transaction.set_rollback(True)
+        except IntegrityError:
+            # redeemed before, maybe by a request running alongside this one:
+            # no use is taken again, but a membership removed since comes back
+            QuestMembership.objects.bulk_create([viewer], ignore_conflicts=True)
+
+        if not used:
+            return Response({'error': 'Token esgotado'}, status=400)
+        # bulk_create sends no signals. A new viewer only changes their own
+        # quest list, whose ETag holds their permission fingerprint, so unlike
+        # a saved membership this doesn't bump the quest's version (an UPDATE
+        # of the quest row by every student of the class).
+        person_changed(person.pk)
+
+        return Response({'success': f"{person} agora pode visualizar a quest '{quest.name}'."})
 
-            return Response({'success': f"{person} agora pode visualizar a quest '{quest.name}'."})
 
-        except QuestViewerInviteToken.DoesNotExist:
-            return Response({'error': 'Token inválido'}, status=404)  
-        
 #Lists all the cases associated with a quest
-class QuestCasesView(APIView):
-    authentication_classes = [TokenAuthentication]
+class QuestCasesView(metrics.SerializerTimingMixin, APIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = 7
 
+    pagination_class = QuestCasePagination
+
+    @cached_response
     def get(self, request, quest_id):
         try:
             quest = Quest.objects.get(id=quest_id)
@@ -235,15 +286,306 @@ class QuestCasesView(APIView):
         if not user_can_view_quest(request.user, quest):
             return Response({'error': 'You do not have permission to view this quest'}, status=403)
 
+        etag = make_etag('quest-cases', quest.id, quest.version, request.get_full_path(),
+                         request.accepted_media_type)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
         # Lista os cases associados à quest
-        cases = quest.quest_cases.all()
-        serializer = CaseSerializer(cases, many=True)
-        return Response(serializer.data)
+        fields = CaseSerializer.requested_fields(request)
+        cases = Case.objects.filter(quest_cases__quest=quest).annotate(
+            added_at=F('quest_cases__added_at'), quest_case_id=F('quest_cases__id'))
+        if fields is not None:
+            cases = CaseSerializer.restrict(cases, fields)
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(cases, request, view=self)
+        serializer = CaseSerializer(page, many=True, fields=fields)
+        response = paginator.get_paginated_response(self.serialize(serializer))
+        response['ETag'] = etag
+        response.cache_tags = {f'quest:{quest.id}'}
+        return response
     
+# Full-text search over the cases the user can see, best matches first, with
+# the matched words highlighted in a snippet of each case's content.
+class CaseSearchView(metrics.SerializerTimingMixin, APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    query_budget = 2
+
+    pagination_class = CaseSearchPagination
+
+    def get(self, request):
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({'error': 'Missing search text ("q")'}, status=400)
+
+        fields = CaseSearchSerializer.Meta.fields
+        cases = CaseSearchSerializer.restrict(Case.objects.visible_to(request.user).search(text), fields)
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(cases, request, view=self)
+        # headlines are costly, so only the page's are computed
+        snippets = Case.objects.filter(pk__in=[case.pk for case in page]).headlines(text) if page else {}
+        serializer = CaseSearchSerializer(page, many=True, context={'snippets': snippets})
+        return paginator.get_paginated_response(self.serialize(serializer))
+
+def professor_institution_id(user):
+    """
+    The institution of a professor, None for students and people without one.
+    """
+    person = getattr(user, 'person', None)
+    if person is None or person.role != 'professor':
+        return None
+    return get_quest_permissions(user).institution_id
+
+# The institution's case library for professors assembling quests, filtered by
+# complexity, specialty, institution and owner, with the count of cases behind
+# each complexity, specialty and institution value. Counts are grouped queries,
+# cached per institution and filters until a case (or what shares it) changes.
+class CaseCatalogView(metrics.SerializerTimingMixin, APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    query_budget = 11
+
+    pagination_class = KeysetPagination
+
+    # query parameter -> Case lookup
+    filters = {
+        'complexity': 'complexity',
+        'specialty': 'specialty',
+        'institution': 'case_owner__institution_id',
+        'owner': 'case_owner_id',
+    }
+    facets = ('complexity', 'specialty', 'institution')
+    # filters given as IDs -> the primary key they are compared with
+    id_filters = {
+        'institution': Institution._meta.pk,
+        'owner': User._meta.pk,
+    }
+
+    @staticmethod
+    def parse_id(value, field):
+        # isdigit() lets through '²' and IDs no column can hold, int() other
+        # scripts' digits ('١') as well
+        if not value.isascii():
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+        _, largest = connection.ops.integer_field_range(field.get_internal_type())
+        return value if 0 < value <= largest else None
+
+    def get(self, request):
+        institution_id = professor_institution_id(request.user)
+        if institution_id is None:
+            return Response({'error': 'Only professors of an institution can browse the case catalog'}, status=403)
+
+        filters = {name: request.query_params[name] for name in self.filters if request.query_params.get(name)}
+        for name, field in self.id_filters.items():
+            if name in filters:
+                filters[name] = self.parse_id(filters[name], field)
+                if filters[name] is None:
+                    return Response({'error': f'"{name}" must be an ID'}, status=400)
+        catalog = Case.objects.in_catalog_of(institution_id)
+
+        cases = CaseSerializer.restrict(self.filtered(catalog, filters), CaseSerializer.summary_fields)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(cases, request, view=self)
+        serializer = CaseSerializer(page, many=True, fields=CaseSerializer.summary_fields)
+
+        digest = hashlib.sha256(repr(sorted(filters.items())).encode()).hexdigest()
+        facets = get_or_build(f'catalog-facets:{institution_id}:{digest}', set(catalog_tags(institution_id)),
+                              lambda: self.count_facets(catalog, filters))
+        response = paginator.get_paginated_response(self.serialize(serializer))
+        response.data['facets'] = facets
+        return response
+
+    def filtered(self, cases, filters, exclude=None):
+        return cases.filter(**{self.filters[name]: value for name, value in filters.items() if name != exclude})
+
+    def count_facets(self, catalog, filters):
+        """
+        Each facet is counted under the other facets' filters, so its values
+        stay selectable as alternatives to the one chosen.
+        """
+        resolver = get_domain_resolver()
+        facets = {}
+        for facet in self.facets:
+            lookup = self.filters[facet]
+            rows = (self.filtered(catalog, filters, exclude=facet).order_by()
+                    .values(lookup).annotate(count=Count('pk')).order_by('-count', lookup))
+            facets[facet] = [{'value': row[lookup], 'count': row['count']} for row in rows]
+        for row in facets['institution']:
+            institution = resolver.institution(row['value'])
+            row['name'] = institution.name if institution is not None else None
+        return facets
+
+# Creates the cases of an NDJSON body (one JSON object per line), owned by the
+# professor sending it, in batches; lines that do not validate are reported.
+class CaseImportView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    # a few queries per batch of IMPORT_BATCH_SIZE lines
+    query_budget = UNLIMITED
+
+    max_reported_errors = 1000
+
+    def post(self, request):
+        if professor_institution_id(request.user) is None:
+            return Response({'error': 'Only professors of an institution can import cases'}, status=403)
+
+        errors = []
+        def report(line, line_errors):
+            if len(errors) < self.max_reported_errors:
+                errors.append({'line': line, 'errors': line_errors})
+
+        # read line by line from the request stream, never as a whole body
+        lines = request.stream if request.stream is not None else []
+        created, failed = import_cases(lines, request.user.person, on_error=report)
+        return Response({'created': created, 'failed': failed, 'errors': errors},
+                        status=201 if created else 400 if failed else 200)
+
+# Streams the institution's case library as NDJSON
+class CaseExportView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    query_budget = 5
+
+    def get(self, request):
+        institution_id = professor_institution_id(request.user)
+        if institution_id is None:
+            return Response({'error': 'Only professors of an institution can export cases'}, status=403)
+
+        response = StreamingHttpResponse(export_cases(Case.objects.in_catalog_of(institution_id)),
+                                         content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="cases.ndjson"'
+        return response
+
+# Serves a case's image derivatives. Their names are hashes of their content, so
+# a URL always means the same bytes and the browser may keep them forever; shared
+# caches may not, as they are patients' scans. The URLs served with a case are
+# signed (see harena.images), which is how <img> tags load them; otherwise the
+# caller needs an API token and has to be able to see the case.
+class CaseImageDerivativeView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [AllowAny]
+    query_budget = 2
+
+    def get(self, request, case_id, name):
+        path = f'{images.DERIVED_DIR}/{name}'
+        content_type = IMAGE_CONTENT_TYPES.get(name.rsplit('.', 1)[-1])
+        if content_type is None:
+            raise Http404
+        if not images.is_signed(case_id, name, request.query_params):
+            if not request.user.is_authenticated:
+                raise NotAuthenticated
+            derivatives = (Case.objects.visible_to(request.user).filter(pk=case_id)
+                           .values_list('image_derivatives', flat=True).first())
+            if derivatives is None or path not in {served for formats in derivatives.values()
+                                                   for served in formats.values()}:
+                raise Http404
+        if not default_storage.exists(path):
+            raise Http404
+        response = FileResponse(default_storage.open(path, 'rb'), content_type=content_type)
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+
+IMAGE_CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+def upload_error_response(error):
+    response = Response({'error': error.message, **error.extra}, status=error.status)
+    if 'retry_after' in error.extra:
+        response['Retry-After'] = str(error.extra['retry_after'])
+    return response
+
+def upload_state(upload):
+    return {'id': upload.id, 'case': upload.case_id, 'offset': upload.offset, 'size': upload.size,
+            'completed': upload.completed_at is not None}
+
+# Starts a resumable upload of a case's image: {"filename", "size", "sha256"}.
+# The bytes are then PUT to the upload, see ImageUploadView.
+class CaseImageUploadsView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    query_budget = 5
+
+    def post(self, request, case_id):
+        try:
+            case = Case.objects.only('case_owner').get(id=case_id)
+        except Case.DoesNotExist:
+            return Response({'error': 'Case not found'}, status=404)
+        if case.case_owner_id != request.user.pk:
+            return Response({'error': 'Only the owner of a case can change its image'}, status=403)
+
+        try:
+            upload = uploads.start_upload(case, request.user.person, request.data.get('filename'),
+                                          request.data.get('size'), request.data.get('sha256'))
+        except uploads.UploadError as e:
+            return upload_error_response(e)
+        return Response(upload_state(upload), status=201)
+
+# One resumable upload. GET tells how many bytes were received (where to resume),
+# PUT sends the next chunk as the raw body with an Upload-Offset header, and
+# DELETE gives up. The chunk that reaches the declared size completes the upload.
+class ImageUploadView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    query_budget = {'get': 2, 'put': 9, 'delete': 4}
+
+    def get_upload(self, request, upload_id):
+        try:
+            upload = ImageUpload.objects.get(id=upload_id)
+        except ImageUpload.DoesNotExist:
+            return None
+        return upload if upload.owner_id == request.user.pk else None
+
+    def get(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload is None:
+            return Response({'error': 'Upload not found'}, status=404)
+        return Response(upload_state(upload))
+
+    def put(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload is None:
+            return Response({'error': 'Upload not found'}, status=404)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset and Content-Length headers are required'}, status=400)
+
+        try:
+            uploads.write_chunk(upload, offset, request.stream, length)
+        except uploads.UploadError as e:
+            return upload_error_response(e)
+        return Response(upload_state(upload))
+
+    def delete(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload is None:
+            return Response({'error': 'Upload not found'}, status=404)
+        upload.delete()
+        return Response(status=204)
+
+# Request metrics of every worker in the Prometheus text format, for staff
+# (a scraper authenticates with a staff user's token)
+class MetricsView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAdminUser]
+    query_budget = 1
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # Adds a case to a quest
 class AddCaseToQuestView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = 11
 
     def post(self, request, quest_id):
         try:
@@ -272,8 +614,9 @@ class AddCaseToQuestView(APIView):
 
 # Remove a case from a quest
 class RemoveCaseFromQuestView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    query_budget = 11
 
     def post(self, request, quest_id, case_id):
         try:
@@ -289,7 +632,96 @@ class RemoveCaseFromQuestView(APIView):
         except Case.DoesNotExist:
             return Response({'error': 'Case not found'}, status=404)
 
-        QuestCase.objects.filter(quest=quest, case=case).delete()
+        quest.quest_cases.filter(case=case).delete()
         return Response({'success': f'Case {case.name} removed from quest {quest.name}'}, status=200)
 
 
+
+
+# Adds and removes many cases of a quest in one request and one transaction.
+# Body: {"add": [case ids], "remove": [case ids]}. Answers the outcome of every id.
+class QuestCasesBatchView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    query_budget = 14
+
+    max_batch_size = 500
+
+    @staticmethod
+    def parse_ids(values):
+        valid, invalid = [], []
+        for value in values:
+            try:
+                valid.append(uuid.UUID(str(value)))
+            except ValueError:
+                invalid.append(value)
+        return valid, invalid
+
+    def post(self, request, quest_id):
+        try:
+            quest = Quest.objects.get(id=quest_id)
+        except Quest.DoesNotExist:
+            return Response({'error': 'Quest not found'}, status=404)
+
+        if not user_can_edit_quest(request.user, quest):
+            return Response({'error': 'You do not have permission to change the cases of this quest'}, status=403)
+
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected an object with "add" and "remove" lists'}, status=400)
+        add = request.data.get('add', [])
+        remove = request.data.get('remove', [])
+        if not isinstance(add, list) or not isinstance(remove, list):
+            return Response({'error': '"add" and "remove" must be lists of case IDs'}, status=400)
+        if not add and not remove:
+            return Response({'error': 'Case IDs are required'}, status=400)
+        if len(add) + len(remove) > self.max_batch_size:
+            return Response({'error': f'At most {self.max_batch_size} case IDs per request'}, status=400)
+
+        add_ids, invalid_add = self.parse_ids(add)
+        remove_ids, invalid_remove = self.parse_ids(remove)
+        if set(add_ids) & set(remove_ids):
+            return Response({'error': 'A case cannot be added and removed in the same request'}, status=400)
+
+        # one IN query tells which cases exist and which are already in the quest
+        in_quest = dict(
+            Case.objects.filter(id__in=add_ids + remove_ids)
+            .annotate(in_quest=Exists(QuestCase.objects.filter(quest=quest, case=OuterRef('pk'))))
+            .values_list('id', 'in_quest')
+        )
+
+        added = {str(value): 'invalid' for value in invalid_add}
+        removed = {str(value): 'invalid' for value in invalid_remove}
+        to_add, to_remove = [], []
+        for case_id in add_ids:
+            if case_id not in in_quest:
+                added[str(case_id)] = 'not_found'
+            elif in_quest[case_id]:
+                added[str(case_id)] = 'already_in_quest'
+            else:
+                added[str(case_id)] = 'added'
+                to_add.append(case_id)
+        for case_id in remove_ids:
+            if case_id not in in_quest:
+                removed[str(case_id)] = 'not_found'
+            elif not in_quest[case_id]:
+                removed[str(case_id)] = 'not_in_quest'
+            else:
+                removed[str(case_id)] = 'removed'
+                to_remove.append(case_id)
+
+        with transaction.atomic(), deferred_version_bumps():
+            if to_add:
+                # a concurrent request adding the same case is absorbed by unique_quest_case
+                QuestCase.objects.bulk_create(
+                    [QuestCase(quest=quest, case_id=case_id) for case_id in to_add],
+                    ignore_conflicts=True,
+                )
+                # bulk_create sends no post_save
+                bump_quests(quest.id)
+                invalidate_tags(f'quest:{quest.id}',
+                                *catalog_tags(quest.institution_id if quest.visible_to_institution else None))
+            if to_remove:
+                # through the quest, so the receivers find it on the rows
+                quest.quest_cases.filter(case_id__in=to_remove).delete()
+
+        return Response({'add': added, 'remove': removed}, status=200)
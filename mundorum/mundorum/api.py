@@ -2,6 +2,9 @@ from rest_framework import routers, serializers, viewsets
 
 from django.contrib.auth.models import User
 from harena.api import router as harena_router
+from harena.metrics import TimedViewSetMixin
+from harena.models import institution_of
+from harena.pagination import UserPagination
 
 # Serializers define the API representation.
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -10,9 +13,15 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['url', 'username', 'email', 'is_staff']
 
 # ViewSets define the view behavior.
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(TimedViewSetMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = UserPagination
+    query_budget = {'get': 2}
+
+    def get_queryset(self):
+        # only the users of the caller's institution
+        return super().get_queryset().filter(person__institution_id=institution_of(self.request.user))
 
 # Routers provide an easy way of automatically determining the URL conf.
 router = routers.DefaultRouter()
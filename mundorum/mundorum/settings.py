@@ -29,6 +29,10 @@ SECRET_KEY = os.getenv('DJANGO_SECRET_KEY')
 
 # Google OAuth settings
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+# Where Google's token signing certificates are fetched from (overridable for tests and benchmarks)
+GOOGLE_CERTS_URL = os.getenv('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+# Seconds an already verified ID token is accepted without checking its signature again
+GOOGLE_TOKEN_CACHE_TTL = 60
 
 CLIENT_URL = os.getenv('CLIENT_URL')
 SERVER_URL = os.getenv('SERVER_URL')
@@ -57,6 +61,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'harena.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -104,6 +109,38 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# 'default' is per process; 'shared' is seen by every worker (see harena/caching.py):
+# files under SHARED_CACHE_DIR, which the workers of one host share, or Redis with
+# SHARED_CACHE_URL (e.g. redis://localhost:6379/0) when they run on several hosts.
+SHARED_CACHE_DIR = os.getenv('SHARED_CACHE_DIR', BASE_DIR / '.cache' / 'shared')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'harena-local',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('SHARED_CACHE_URL'),
+    } if os.getenv('SHARED_CACHE_URL') else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': SHARED_CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# Seconds API read responses stay cached in each process and in the shared cache
+RESPONSE_CACHE_LOCAL_TIMEOUT = 30
+RESPONSE_CACHE_SHARED_TIMEOUT = 300
+
+# Spreads cache invalidations to every worker (harena/bus.py): LISTEN/NOTIFY on
+# PostgreSQL, a table polled every INVALIDATION_BUS_POLL_INTERVAL seconds elsewhere
+INVALIDATION_BUS = os.getenv('INVALIDATION_BUS', 'True') == 'True'
+INVALIDATION_BUS_POLL_INTERVAL = 1.0
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -140,6 +177,45 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded files (case images and their derivatives); uploads have always been
+# stored under the project directory
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR)
+MEDIA_URL = 'media/'
+
+# Threads per process building case image derivatives (harena/images.py)
+IMAGE_DERIVATIVE_WORKERS = 2
+# Seconds the signed derivative URLs served with a case stay the same; each
+# works for one to two of these
+IMAGE_DERIVATIVE_URL_LIFETIME = 3600
+
+# Resumable case image uploads (harena/uploads.py): where partial files are kept,
+# the largest image and chunk accepted (bytes), uploads in progress per person
+# and chunks received at once per process
+IMAGE_UPLOAD_DIR = os.getenv('IMAGE_UPLOAD_DIR', BASE_DIR / '.uploads')
+IMAGE_UPLOAD_MAX_SIZE = 512 * 1024 * 1024
+IMAGE_UPLOAD_MAX_CHUNK = 16 * 1024 * 1024
+IMAGE_UPLOAD_MAX_ACTIVE = 3
+IMAGE_UPLOAD_MAX_WRITERS = 4
+
+# Per-view request metrics served at /metrics (harena/metrics.py): each worker
+# writes its own file here every METRICS_FLUSH_INTERVAL seconds and a scrape adds
+# them up. Clear the directory when deploying.
+METRICS_DIR = os.getenv('METRICS_DIR', BASE_DIR / '.metrics')
+METRICS_FLUSH_INTERVAL = 5.0
+
+# Slow-query log (harena/slowlog.py, browsable in the admin): the slowest
+# statements of requests longer than SLOW_REQUEST_THRESHOLD seconds (unset to
+# turn it off), with an EXPLAIN (ANALYZE, BUFFERS) plan for a sample of them.
+# Only the latest SLOW_QUERY_LOG_SIZE statements are kept.
+SLOW_REQUEST_THRESHOLD = os.getenv('SLOW_REQUEST_THRESHOLD', '1.0')
+SLOW_REQUEST_THRESHOLD = float(SLOW_REQUEST_THRESHOLD) if SLOW_REQUEST_THRESHOLD else None
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+SLOW_QUERY_LOG_SIZE = 1000
+
+# Fails requests that run more queries than their view's query budget
+# (harena/budgets.py), listing them; on in development and in the tests
+ENFORCE_QUERY_BUDGETS = DEBUG
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -147,11 +223,13 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'harena.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
-    ]
+    ],
+    # cursor pages over indexed keys, never a COUNT(*); views set their own ordering
+    'DEFAULT_PAGINATION_CLASS': 'harena.pagination.KeysetPagination',
 }
 
 # Allow requests from your React app
@@ -161,3 +239,12 @@ CORS_ALLOWED_ORIGINS = [
 
 # If you want to allow credentials (cookies, etc.)
 CORS_ALLOW_CREDENTIALS = True
+
+# Seconds a user's effective quest permissions stay cached in each process
+QUEST_PERMISSION_CACHE_TTL = 300
+
+# Resolved API tokens kept in memory per process (seconds, entries)
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_SIZE = 10000
+# Seconds an API token stays valid after creation; None keeps tokens forever
+TOKEN_LIFETIME = None